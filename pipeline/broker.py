@@ -0,0 +1,110 @@
+# broker.py
+# > starts a pool of warm llama-servers once per node, which the shards of extraction.py then share.
+#
+# Loading the 70B model takes minutes. Instead of every shard starting (and loading) its own server,
+# run the broker once per node and start the shards with --broker-registry:
+#
+#   python broker.py start --registry /path/to/servers.json --devices CUDA0,CUDA1 --parallel 4
+#   python extraction.py --broker-registry /path/to/servers.json --total-shards 8 --shard-id 0 --run-id ...
+#
+# Servers that are already running elsewhere can be added to the same registry with `register`.
+# Shards pick up servers that are registered after they started (e.g. while the broker's other servers still
+# load the model). With --prompt-layout prefix, each shard reserves --concurrency slots of a server for itself.
+import argparse
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from src.xllm.broker import ServerRegistry, wait_until_ready, warmup
+from src.xllm.endpoints import MODEL
+
+
+def start(args):
+    registry = ServerRegistry(args.registry)
+    host = socket.gethostname()
+    devices = [device.strip() for device in args.devices.split(",") if device.strip()]
+
+    servers = {}
+    for i, device in enumerate(devices):
+        port = args.base_port + i
+        # the server writes to its own copy of the file handle, the broker doesn't need to keep it open
+        with open(f"broker.{host}.{port}.log", "w") as log_file:
+            process = subprocess.Popen(
+                ["sh", "llama3.3.sh", "--port", str(port), "--parallel", str(args.parallel), "--device", device],
+                stderr=log_file,
+            )
+        servers[f"http://{host}:{port}/v1"] = process
+        print(f"starting server on {device}, port {port}...")
+
+    try:
+        # the servers load in parallel, register each one as soon as it's ready and warmed up
+        for url, process in servers.items():
+            if not wait_until_ready(url, args.timeout, is_alive=lambda: process.poll() is None):
+                print(f"\nServer {url} did not start within {args.timeout} seconds.")
+                process.terminate()
+                continue
+            warmup(url, MODEL)
+            registry.register(url, slots=args.parallel, pid=process.pid)
+            print(f"\nServer {url} is ready.")
+
+        # keep the servers running until the broker is stopped, drop the ones that exit
+        while any(process.poll() is None for process in servers.values()):
+            for url, process in servers.items():
+                if process.poll() is not None and any(server["url"] == url for server in registry.servers()):
+                    print(f"Server {url} exited with code {process.returncode}.")
+                    registry.unregister(url)
+            time.sleep(10)
+    finally:
+        for url, process in servers.items():
+            registry.unregister(url)
+            process.terminate()
+        print("Servers terminated.")
+
+
+def register(args):
+    registry = ServerRegistry(args.registry)
+    for url in [url.strip() for url in args.endpoints.split(",") if url.strip()]:
+        if not wait_until_ready(url, args.timeout):
+            print(f"\nServer {url} is not ready, skipping it.")
+            continue
+        warmup(url, MODEL)
+        registry.register(url, slots=args.parallel)
+        print(f"\nServer {url} is ready.")
+
+
+def status(args):
+    for server in ServerRegistry(args.registry).servers():
+        reserved = ", ".join(f"{client_id} {slots}" for client_id, slots in server.get("reserved", {}).items())
+        print(f"{server['url']}: {server['slots']} slots, attached: {', '.join(server['attached']) or '-'}, reserved: {reserved or '-'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start and share warm LLM servers between the shards of the extraction pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    start_parser = subparsers.add_parser("start", help="Start one server per device and keep them running until stopped.")
+    start_parser.add_argument("--registry", type=str, required=True, help="Registry file the shards attach through.")
+    start_parser.add_argument("--devices", type=str, default="CUDA0", help="Comma-separated devices, one server each.")
+    start_parser.add_argument("--base-port", type=int, default=5912, help="Port of the first server, the others count up.")
+    start_parser.add_argument("--parallel", type=int, default=1, help="Number of parallel slots per server.")
+    start_parser.add_argument("--timeout", type=float, default=1800, help="Seconds to wait for a server to load the model.")
+    start_parser.set_defaults(func=start)
+
+    register_parser = subparsers.add_parser("register", help="Add already running servers to the registry.")
+    register_parser.add_argument("--registry", type=str, required=True, help="Registry file the shards attach through.")
+    register_parser.add_argument("--endpoints", type=str, required=True, help="Comma-separated OpenAI-compatible base urls, e.g. http://node1:5912/v1")
+    register_parser.add_argument("--parallel", type=int, default=1, help="Number of parallel slots per server.")
+    register_parser.add_argument("--timeout", type=float, default=1800, help="Seconds to wait for a server to be ready.")
+    register_parser.set_defaults(func=register)
+
+    status_parser = subparsers.add_parser("status", help="List the registered servers and the shards attached to them.")
+    status_parser.add_argument("--registry", type=str, required=True, help="Registry file the shards attach through.")
+    status_parser.set_defaults(func=status)
+
+    args = parser.parse_args()
+
+    # turn SIGTERM into a regular exit, so the servers are unregistered and terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    args.func(args)
@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import shutil
+
+from src.xllm import utils
+from src.xllm.variables import parse_date_keys
+
+
+def convert_notes(notes_file: str, out_dir: str, n_buckets: int, row_group_size: int):
+    """
+    Converts the notes CSV into a notes store: a Parquet dataset partitioned into n_buckets buckets by MRN
+    (MRN_BUCKET=MRN % n_buckets). Deduplication and sorting are done once here with get_notes, the length of
+    every stripped text is stored as NOTE_LENGTH and the parsed NOTE_DATE as NOTE_DATE_KEY (see parse_date_keys),
+    so shards only read the notes (or lengths) of their own mrns and don't parse the dates again.
+    Within a bucket the notes stay sorted by MRN, so the row groups of small row_group_size cover narrow MRN ranges.
+    """
+    pq = utils.import_parquet()
+    import pyarrow as pa
+
+    print(f"Reading and deduplicating {notes_file}...")
+    notes = utils.get_notes(notes_file)
+    notes["NOTE_LENGTH"] = notes["NOTE_TEXT"].str.strip().str.len()
+    notes["NOTE_DATE_KEY"] = parse_date_keys(notes["NOTE_DATE"])
+    print(f"  - {len(notes)} notes of {notes['MRN'].nunique()} patients")
+
+    buckets = notes["MRN"] % n_buckets
+    for bucket in sorted(buckets.unique()):
+        bucket_dir = os.path.join(out_dir, f"MRN_BUCKET={bucket}")
+        os.makedirs(bucket_dir, exist_ok=True)
+        table = pa.Table.from_pandas(notes[buckets == bucket], preserve_index=False)
+        pq.write_table(table, os.path.join(bucket_dir, "part-0.parquet"), row_group_size=row_group_size)
+
+    with open(os.path.join(out_dir, utils.NOTES_STORE_INFO), "w", encoding="utf-8") as f:
+        json.dump({"buckets": n_buckets, "notes": len(notes), "source": notes_file}, f, indent=2)
+    print(f"  - Written {buckets.nunique()} buckets to {out_dir}")
+
+
+def convert_patient_meta(patients_meta_file: str, out_path: str):
+    """ Converts the patient meta CSV into a single Parquet file."""
+    pq = utils.import_parquet()
+    import pyarrow as pa
+
+    meta = utils.get_patient_meta(patients_meta_file)
+    pq.write_table(pa.Table.from_pandas(meta, preserve_index=False), out_path)
+    print(f"  - Written {len(meta)} patients to {out_path}")
+
+
+def main(notes_file: str, patients_meta_file: str, out_dir: str, n_buckets: int, row_group_size: int, overwrite: bool):
+    """
+    Writes the notes store used by extraction.py --notes-store:
+    <out_dir>/notes (see convert_notes) and <out_dir>/patient_meta.parquet.
+    """
+    if os.path.exists(out_dir):
+        if not overwrite:
+            print(f"{out_dir} already exists. Use --overwrite to replace it.")
+            return
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    convert_notes(notes_file, os.path.join(out_dir, "notes"), n_buckets, row_group_size)
+    convert_patient_meta(patients_meta_file, os.path.join(out_dir, "patient_meta.parquet"))
+    print("Conversion complete.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the notes and patient meta CSVs into a Parquet notes store.")
+    parser.add_argument("--notes", type=str, required=True, help="The notes CSV.")
+    parser.add_argument("--patients-meta", type=str, required=True, help="The patient meta CSV.")
+    parser.add_argument("--out-dir", type=str, required=True, help="Directory of the notes store.")
+    parser.add_argument("--buckets", type=int, default=64, help="Number of MRN buckets (files) the notes are partitioned into.")
+    parser.add_argument("--row-group-size", type=int, default=10_000, help="Max. notes per Parquet row group, the unit of predicate pushdown.")
+    parser.add_argument("--overwrite", action="store_true", help="Replace an existing notes store.")
+    args = parser.parse_args()
+    main(args.notes, args.patients_meta, args.out_dir, args.buckets, args.row_group_size, args.overwrite)
@@ -9,22 +9,50 @@
 #                         │ extract stage 2 vars ├─┘                             
 #                         └──────────────────────┘                               
 import argparse
+import asyncio
 from enum import Enum
 import json
-from typing import List, Dict, Any, TypedDict, Union, Optional
-from pydantic import BaseModel, TypeAdapter
+from typing import Callable, Iterator, List, Dict, Any, TypedDict, Union, Optional
+from pydantic import ValidationError
 import numpy as np
-from openai import OpenAI
+import pandas as pd
 import subprocess
 import requests
 import time
 from src.xllm import utils
 from src.xllm import variables
 from src.xllm.utils import Chunk, MRNChunks
+from src.xllm.scheduling import PrioritySemaphore, SlotPool
+from src.xllm.sharding import ShardPlan, estimate_patient_costs, partition_by_cost
+from src.xllm.telemetry import MetricsWriter, RequestMetric
+from src.xllm.workqueue import WorkQueue
+from src.xllm.broker import ServerRegistry, wait_until_ready, warmup
+from src.xllm.cache import ResponseCache
+from src.xllm.endpoints import EndpointPool, MODEL, RETRYABLE_ERRORS
+from src.xllm.grammar import GrammarCache
+from src.xllm.incremental import (
+    PreviousRun,
+    changed_variables,
+    chunk_hash,
+    is_unchanged,
+    match_runs,
+    missing_variables,
+    variable_fingerprints,
+)
+from src.xllm.journal import PatientJournal, JournalRun
+from src.xllm.notes import NoteIndex
+from src.xllm.resolution import Finding, PatientResolution
+from src.xllm.retrieval import PrefilterStats, estimate_tokens, prefilter_chunks
+from src.xllm.tokens import LocalTokenizer, ServerTokenizer, get_chunk_token_budget, get_server_context_size
+from src.xllm.writer import JsonlWriter
 import traceback
 from tqdm import tqdm
 from contextlib import contextmanager
+from dataclasses import dataclass, field
 import os
+import signal
+import socket
+import sys
 
 
 files = {
@@ -42,43 +70,408 @@ set = "study"
 NOTES_FILE = files[set]["notes"]
 PATIENTS_META_FILE = files[set]["patients_meta"]
 
-def process_chunk(
-    client: OpenAI, chunk: Chunk, clean_schema: Dict, response_format: Any, patient_meta: Optional[utils.PatientMeta] = None
-):
+DEFAULT_CONTEXT_SIZE = 16384 # context size per slot in llama3.3.sh
+REGISTRY_REFRESH_SECONDS = 60
+""" How often a shard attached to a broker picks up the servers registered (or unregistered) since."""
+SAMPLING_SETTINGS: Dict[str, Any] = {}
+""" Sampling parameters sent with every request. Empty means the server's defaults are used."""
+
+
+PROMPT_INSTRUCTIONS = (
+    "You're a medical professional tasked with extracting structured data from medical notes. "
+    + "NEVER use newlines or \t in your output. Use the schema provided to extract the data. "
+    + "If you can't find the information about one of the fields, return null. E.g. when the notes don't mention an appendectomy, don't return false, but null for the whole field. "
+    # + "When adding citations to the values, only cite the fewest words possible."
+    + "When adding citations to the values, only cite the relevant words."
+    + "When replying with a date, ALWAYS use ISO format (YYYY-MM-DD, YYYY-MM or YYYY)."
+    # + " Don't include the family members history if asked about the personal history."
+)
+
+
+class PromptLayout(str, Enum):
+    default = "default"
+    """ instructions + patient meta + schema + chunk text"""
+    prefix = "prefix"
+    """
+    instructions + patient meta + chunk text + schema. Orders the prompt from the most to the least shared part:
+    all requests of a patient share instructions + patient meta, and the Stage I and Stage II requests of the same
+    chunk share everything but the schema, so the server's prompt cache can skip most of the prefill.
+    """
+
+
+@dataclass
+class PromptCacheStats:
+    """ Prompt tokens reused from the server's KV cache vs. evaluated, as reported in llama-server's timings."""
+    cached_tokens: int = 0
+    evaluated_tokens: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.cached_tokens + self.evaluated_tokens
+        return self.cached_tokens / total if total > 0 else 0.0
+
+
+@dataclass
+class LLMSession:
+    pool: EndpointPool
+    """ The LLM endpoints requests are routed to."""
+    model_id: str = MODEL
+    """ Id of the model actually served by the endpoint. Part of the response cache key."""
+    cache: Optional[ResponseCache] = None
+    """ Optional on-disk cache in front of the LLM."""
+    prompt_layout: PromptLayout = PromptLayout.default
+    prompt_cache: PromptCacheStats = field(default_factory=PromptCacheStats)
+    metrics: Optional[MetricsWriter] = None
+    """ Optional per-request metrics log."""
+    grammars: Optional[GrammarCache] = None
+    """ If set, requests send a precompiled GBNF grammar instead of a JSON schema response format."""
+
+
+def build_prompt(
+    chunk: Chunk,
+    schema_str: str,
+    patient_meta: Optional[utils.PatientMeta] = None,
+    layout: PromptLayout = PromptLayout.default,
+) -> str:
     patient_meta_str = utils.get_patient_meta_prompt(patient_meta) if patient_meta is not None else ""
+    schema_str = f"\n<schema>{schema_str}</schema>"
+
+    if layout == PromptLayout.prefix:
+        return PROMPT_INSTRUCTIONS + patient_meta_str + chunk["text"] + schema_str
+    return PROMPT_INSTRUCTIONS + patient_meta_str + schema_str + chunk["text"]
+
+
+async def process_chunk(
+    llm: LLMSession,
+    chunk: Chunk,
+    record: variables.RecordSchema,
+    patient_meta: Optional[utils.PatientMeta] = None,
+    slot: Optional[int] = None,
+    metric: Optional[RequestMetric] = None,
+):
+    """
+    Extracts the variables of the record class from one chunk.
+    If slot is given, the request is pinned to that slot (numbered across all endpoints of the pool),
+    so it can reuse the slot's prompt cache.
+    If metric is given, it is completed with the request's latency and token counts and recorded to llm.metrics.
+    """
+    prompt = build_prompt(chunk, record.schema_str, patient_meta, llm.prompt_layout)
+
+    cache_key = None
+    if llm.cache is not None:
+        # the grammar (mode and max. string length) constrains the response as much as the schema does
+        grammar_key = llm.grammars.key(record.clean_schema) if llm.grammars is not None else None
+        cache_key = ResponseCache.make_key(prompt, record.clean_schema, llm.model_id, SAMPLING_SETTINGS, grammar_key)
+        cached = llm.cache.get(cache_key)
+        if cached is not None:
+            try:
+                parsed = record.cls.model_validate_json(cached)
+                if metric is not None and llm.metrics is not None:
+                    metric["cache_hit"] = True
+                    llm.metrics.record(metric)
+                return parsed
+            except ValidationError:
+                print("Warning: Ignoring cached response that does not match the schema.")
+
+    # with slot affinity, the patient is pinned to one slot of one endpoint
+    preferred_endpoint = slot // llm.pool.slots if slot is not None else None
+
+    start = time.time()
+
+    # retry on another endpoint if the endpoint (not the request) fails
+    failed_endpoints = []
+    for attempt in range(len(llm.pool)):
+        endpoint = llm.pool.acquire(preferred_endpoint, exclude=failed_endpoints)
+        pinned = preferred_endpoint is not None and endpoint is llm.pool.endpoints[preferred_endpoint]
 
-    completion = client.beta.chat.completions.parse(
-        model="google/gemma-3-27b-it", # this does nothing when using llama.cpp, but is required
-        messages=[
+        # llama-server specific parameters
+        extra_body = (
+            {"id_slot": endpoint.id_slot(slot % llm.pool.slots), "cache_prompt": True}
+            if pinned and slot is not None
+            else None
+        )
+        messages = [
             {
                 "role": "user",
-                "content": "You're a medical professional tasked with extracting structured data from medical notes. "
-                + "NEVER use newlines or \t in your output. Use the schema provided to extract the data. "
-                + "If you can't find the information about one of the fields, return null. E.g. when the notes don't mention an appendectomy, don't return false, but null for the whole field. "
-                # + "When adding citations to the values, only cite the fewest words possible."
-                + "When adding citations to the values, only cite the relevant words."
-                + "When replying with a date, ALWAYS use ISO format (YYYY-MM-DD, YYYY-MM or YYYY)."
-                # + " Don't include the family members history if asked about the personal history."
-                + patient_meta_str
-                + f"\n<schema>{json.dumps(clean_schema)}</schema>"
-                + chunk["text"],
+                "content": prompt,
             },
-        ],
-        response_format=response_format,
-    )
-    return completion.choices[0].message.parsed
+        ]
+
+        failed = False
+        try:
+            if llm.grammars is not None:
+                # the grammar is compiled once per schema, so the server doesn't convert the schema on every request
+                completion = await endpoint.client.chat.completions.create(
+                    model=MODEL,
+                    messages=messages,
+                    extra_body={**(extra_body or {}), "grammar": llm.grammars.get(record.clean_schema)},
+                    **SAMPLING_SETTINGS,
+                )
+            else:
+                completion = await endpoint.client.beta.chat.completions.parse(
+                    model=MODEL,
+                    messages=messages,
+                    response_format=record.cls,
+                    extra_body=extra_body,
+                    **SAMPLING_SETTINGS,
+                )
+            break
+        except RETRYABLE_ERRORS as e:
+            failed = True
+            failed_endpoints.append(endpoint)
+            if attempt == len(llm.pool) - 1:
+                raise
+            print(f"Warning: Request to {endpoint.base_url} failed ({e}). Retrying on another endpoint.")
+        finally:
+            llm.pool.release(endpoint, failed)
+
+    latency = time.time() - start
+    message = completion.choices[0].message
+
+    if metric is not None and llm.metrics is not None:
+        usage = completion.usage
+        metric["endpoint"] = endpoint.base_url
+        metric["start"] = start
+        metric["latency_s"] = latency
+        metric["prompt_tokens"] = usage.prompt_tokens if usage is not None else 0
+        metric["completion_tokens"] = usage.completion_tokens if usage is not None else 0
+        metric["tokens_per_s"] = metric["completion_tokens"] / latency if latency > 0 else 0.0
+        llm.metrics.record(metric)
+
+    # llama-server reports how much of the prompt was served from its cache
+    timings = (completion.model_extra or {}).get("timings") or {}
+    llm.prompt_cache.cached_tokens += timings.get("cache_n", 0)
+    llm.prompt_cache.evaluated_tokens += timings.get("prompt_n", 0)
+
+    parsed = message.parsed if llm.grammars is None else record.cls.model_validate_json(message.content or "")
+
+    if llm.cache is not None and cache_key is not None and message.content is not None:
+        # off the event loop, a write that evicts scans the cache directory
+        await asyncio.to_thread(llm.cache.put, cache_key, message.content)
+
+    return parsed
+
+
+async def process_chunks(
+    llm: LLMSession,
+    semaphore: PrioritySemaphore,
+    priority: int,
+    mrnChunk: MRNChunks,
+    record: variables.RecordSchema,
+    patient_meta: Optional[utils.PatientMeta],
+    progress: tqdm,
+    slot: Optional[int] = None,
+    reverse: bool = False,
+    stage: int = 1,
+    chunk_indices: Optional[List[int]] = None,
+) -> List[Any]:
+    """
+    Sends all chunks of one patient to the LLM concurrently. The semaphore bounds the number of requests
+    in flight across all patients; requests with a lower priority value are admitted first.
+    If reverse is set, the last chunk is admitted first.
+    stage and chunk_indices (the indices of the chunks among all chunks of the patient) tag the request metrics.
+    Returns the parsed results in the order of the patient's chunks.
+    """
+    n_chunks = len(mrnChunk["chunks"])
+
+    async def run(chunk_idx: int, chunk: Chunk):
+        order = n_chunks - 1 - chunk_idx if reverse else chunk_idx
+        queued = time.time()
+        async with semaphore.slot((priority, order)):
+            metric: Optional[RequestMetric] = None
+            if llm.metrics is not None:
+                metric = {
+                    "shard": llm.metrics.shard,
+                    "mrn": mrnChunk["MRN"],
+                    "stage": stage,
+                    "chunk": chunk_indices[chunk_idx] if chunk_indices is not None else chunk_idx,
+                    "endpoint": None,
+                    "cache_hit": False,
+                    "start": time.time(),
+                    "queue_wait_s": time.time() - queued,
+                    "latency_s": 0.0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "tokens_per_s": 0.0,
+                }
+            result = await process_chunk(llm, chunk, record, patient_meta, slot, metric)
+        progress.update(1)
+        return result
+
+    # asyncio.gather keeps the order of its arguments, so results line up with the chunks
+    return list(await asyncio.gather(*[run(i, chunk) for i, chunk in enumerate(mrnChunk["chunks"])]))
+
+
+class ProcessedPatient(TypedDict):
+    mrn: int
+    findings: List[Finding]
+    dateOfBirth: Union[str, None]  # Assuming dateOfBirth is a string in ISO format
+    firstName: Union[str, None]  # Optional to allow for missing data
+    lastName: Union[str, None]
+    gender: Union[str, None]
+
+def build_processed_patient(
+    mrn: int, resolution: PatientResolution, patient_meta: Optional[utils.PatientMeta]
+) -> ProcessedPatient:
+    """
+    Resolves all variables of one patient and collects the evidence for each of them.
+    Variables already resolved (for the Stage II activation) are not resolved again.
+    """
+    pp: ProcessedPatient = {
+        "mrn": mrn,
+        "findings": [],
+        "dateOfBirth": patient_meta.date_of_birth if  patient_meta else None,
+        "firstName": patient_meta.first_name if  patient_meta else None,
+        "lastName": patient_meta.last_name if  patient_meta else None,
+        "gender": patient_meta.gender if  patient_meta else None,
+    }
+
+    for var_id, var_def in variables.LM_VARIABLES.items():
+        pp["findings"].append(resolution.finding(var_id, var_def))
+    return pp
+
+
+def get_token_counter(args, llm_endpoint: str) -> Callable[[str], int]:
+    """
+    Returns a function counting tokens with the tokenizer of the served model:
+    a local tokenizer if --tokenizer is given, otherwise the server's /tokenize endpoint.
+    """
+    if args.tokenizer is not None:
+        return LocalTokenizer(args.tokenizer).count_tokens
+    return ServerTokenizer(llm_endpoint).count_tokens
 
 
-def main(args, llm_endpoint: str):
-    client = OpenAI(
-        base_url=llm_endpoint,
-        # api_key=os.environ.get("OPENAI_API_KEY"),
-        api_key="ollama",  # required, but unused
+def get_chunk_max_tokens(
+    args, llm_endpoint: str, count_tokens: Callable[[str], int], s1_record: variables.RecordSchema, layout: PromptLayout
+) -> int:
+    """
+    Computes how many tokens of notes fit into one chunk, given the server's context size per slot
+    and the measured token cost of the rest of the prompt and the expected output.
+    """
+    context_size = args.context_size or get_server_context_size(llm_endpoint) or DEFAULT_CONTEXT_SIZE
+
+    # the largest possible Stage II schema, when all stage 2 variables are active
+    s2_record = variables.get_record_schema(
+        key for key, value in variables.LM_VARIABLES.items() if value.is_active is not None
+    )
+
+    prompt_overhead = max(
+        (get_prompt_overhead(record, layout) for record in [s1_record, s2_record]),
+        key=len,
     )
+    return get_chunk_token_budget(count_tokens, context_size, prompt_overhead, args.max_output_tokens)
+
+
+def get_prompt_overhead(record: variables.RecordSchema, layout: PromptLayout) -> str:
+    """ Returns everything of a request's prompt but the chunk text, with placeholder patient meta."""
+    empty_chunk: Chunk = {"text": "", "source_note_ids": []}
+    placeholder_meta = utils.PatientMeta(last_name="", first_name="", date_of_birth="YYYY-MM-DD", gender="")
+    return build_prompt(empty_chunk, record.schema_str, placeholder_meta, layout)
+
+
+def get_patient_costs(all_mrns: np.ndarray, s1_record: variables.RecordSchema, layout: PromptLayout) -> Dict[int, int]:
+    """
+    Predicts the cost of each patient (see estimate_patient_costs) from the lengths of its notes.
+    Always uses the character-based chunks and estimated tokens, so it doesn't need a server and is the same for every shard.
+    """
+    request_overhead = estimate_tokens(get_prompt_overhead(s1_record, layout))
+    note_lengths = utils.get_notes(NOTES_FILE, all_mrns, text_lengths_only=True)
+    return estimate_patient_costs(note_lengths, 18000, request_overhead)
+
+
+def get_shard_plans(args, all_mrns: np.ndarray, s1_record: variables.RecordSchema, layout: PromptLayout) -> List[ShardPlan]:
+    """
+    Splits the sorted MRNs into args.total_shards shards: either in contiguous blocks of equal size,
+    or balanced by the predicted cost of each patient (see partition_by_cost).
+    """
+    if args.partition == "balanced":
+        costs = get_patient_costs(all_mrns, s1_record, layout)
+        return partition_by_cost([int(mrn) for mrn in all_mrns], costs, args.total_shards)
+
+    return [
+        {"mrns": [int(mrn) for mrn in mrn_shard], "cost": 0}
+        for mrn_shard in np.array_split(all_mrns, args.total_shards)
+    ]
+
+
+def get_output_dir(run_id: str) -> str:
+    return f"/sc/arion/projects/hpims-hpi/user/janssm02/data_extraction_w_LLM/data/processed/shards/{run_id}/"
+
+
+def get_reserved_slots(args) -> Optional[int]:
+    """
+    Number of slots the shard reserves on each server of a broker: with the prefix layout, requests are pinned to
+    slots, which must not be shared with other shards. Without pinning, the servers' slots are shared.
+    """
+    return args.concurrency if args.prompt_layout == PromptLayout.prefix.value else None
+
+
+async def main(
+    args,
+    llm_endpoints: List[str],
+    registry: Optional[ServerRegistry] = None,
+    client_id: Optional[str] = None,
+    slot_ids: Optional[List[Optional[List[int]]]] = None,
+):
+    """
+    Runs the extraction of the shard (or queue worker) against the LLM endpoints.
+    With a broker registry, the client_id is attached to the endpoints (using the server slots in slot_ids for
+    pinned requests), and the endpoints follow the registry while the shard runs.
+    """
+    pool = EndpointPool(llm_endpoints, slots=args.concurrency, slot_ids=slot_ids)
+    if await pool.check_health() == 0:
+        raise RuntimeError(f"None of the LLM endpoints is healthy: {llm_endpoints}")
+    # used for the requests that need a single server (model id, tokenizer, context size)
+    llm_endpoint = llm_endpoints[0]
+
+    cache = None
+    model_id = MODEL
+    if args.cache_dir is not None:
+        cache = ResponseCache(args.cache_dir, int(args.cache_max_gb * 1024**3))
+        try:
+            # the server reports the model it actually serves, which is part of the cache key
+            model_id = (await pool.endpoints[0].client.models.list()).data[0].id
+        except Exception as e:
+            print(f"Warning: Could not get the served model id ({e}). Using {MODEL} as cache key.")
+    llm = LLMSession(pool=pool, model_id=model_id, cache=cache, prompt_layout=PromptLayout(args.prompt_layout))
+    if args.grammar:
+        grammar_dir = os.path.join(args.cache_dir, "grammars") if args.cache_dir is not None else None
+        llm.grammars = GrammarCache(grammar_dir, args.grammar_max_string)
+
+    # bounds the number of chunk requests in flight, across all patients and both stages
+    semaphore = PrioritySemaphore(args.concurrency * len(pool))
+    # with the prefix layout, each patient is pinned to one server slot, which then bounds its requests instead
+    slot_pool = SlotPool(args.concurrency * len(pool)) if llm.prompt_layout == PromptLayout.prefix else None
+    # called with the number of new slots when a server joins
+    on_pool_growth: List[Callable[[int], None]] = [semaphore.grow]
+    if slot_pool is not None:
+        on_pool_growth.append(slot_pool.grow)
+
+    async def follow_registry():
+        """
+        Re-attaches to the broker's registry every REGISTRY_REFRESH_SECONDS: servers registered since (e.g. the
+        ones that loaded the model after the shard started) join the pool, unregistered ones are retired.
+        """
+        assert registry is not None and client_id is not None
+        while True:
+            await asyncio.sleep(REGISTRY_REFRESH_SECONDS)
+            try:
+                servers = await asyncio.to_thread(registry.attach, client_id, None, get_reserved_slots(args))
+            except Exception as e:
+                print(f"Warning: Could not read the broker registry ({e}).")
+                continue
+            urls = [server["url"] for server in servers]
+            for endpoint in pool.endpoints:
+                if endpoint.base_url not in urls:
+                    pool.retire(endpoint.base_url)
+            for server in servers:
+                if pool.add(server["url"], server.get("reserved", {}).get(client_id)):
+                    print(f"Server {server['url']} joined the pool.")
+                    for grow in on_pool_growth:
+                        grow(args.concurrency)
 
     np.random.seed(42)
 
-    notes = utils.get_notes(NOTES_FILE)
     patients_meta = utils.get_patient_meta_dict(PATIENTS_META_FILE)
 
     # take mrns from patients_meta:
@@ -103,14 +496,32 @@ def main(args, llm_endpoint: str):
     # all_mrns = notes["MRN"].unique()
     all_mrns.sort()
 
-    mrn_shards = np.array_split(all_mrns, args.total_shards)
-    mrns = mrn_shards[args.shard_id]
+    stage_1_vars = {
+        key: value
+        for key, value in variables.LM_VARIABLES.items()
+        if value.is_active is None
+    }
+    s1_record = variables.get_record_schema(stage_1_vars)
+
+    queue = None
+    shard_plans = None
+    if args.queue is not None:
+        # workers pull patients from the queue instead of processing a fixed shard
+        queue = WorkQueue(args.queue, args.lease_seconds, max_attempts=args.max_attempts)
+        costs = get_patient_costs(all_mrns, s1_record, llm.prompt_layout) if args.partition == "balanced" else None
+        queue.populate([int(mrn) for mrn in all_mrns], costs)
+        # any patient can be claimed, so the worker needs the notes of the whole cohort
+        notes = utils.get_notes(NOTES_FILE, all_mrns)
+        print(f"Pulling patients from work queue {args.queue}: {queue.counts()}")
+    else:
+        shard_plans = get_shard_plans(args, all_mrns, s1_record, llm.prompt_layout)
+        mrns = shard_plans[args.shard_id]["mrns"]
 
-    if len(mrns) == 0:
-        print(f"Shard {args.shard_id} has no MRNs to process. Exiting.")
-        return
+        if len(mrns) == 0:
+            print(f"Shard {args.shard_id} has no MRNs to process. Exiting.")
+            return
 
-    print(f"Processing {len(mrns)} MRNs for this shard (from a total of {len(all_mrns)}).")
+        print(f"Processing {len(mrns)} MRNs for this shard (from a total of {len(all_mrns)}).")
 
     # mrns = notes["MRN"].unique()
     # mrns = np.random.choice(mrns, 3)
@@ -119,67 +530,231 @@ def main(args, llm_endpoint: str):
     # mrns = np.array([3137583])
     # mrns_str = mrns.astype(str)
 
-    notes = notes[notes["MRN"].isin(mrns)]
-    chunks = utils.chunk_notes(notes, 18000)
+    count_tokens: Callable[[str], int] = estimate_tokens
+    chunk_max_tokens = None
+    if args.token_budget:
+        count_tokens = get_token_counter(args, llm_endpoint)
+        chunk_max_tokens = get_chunk_max_tokens(args, llm_endpoint, count_tokens, s1_record, llm.prompt_layout)
+        print(f"Chunking notes with a budget of {chunk_max_tokens} tokens per chunk.")
 
-    stage_1_vars = {
-        key: value
-        for key, value in variables.LM_VARIABLES.items()
-        if value.is_active is None
-    }
-    StageOneVarCls = variables.create_medical_record_class(stage_1_vars)
-    s1_clean_schema = utils.strip_titles_and_refs(TypeAdapter(StageOneVarCls).json_schema())
-
-    class PatientRun(TypedDict):
-        mrn: int
-        runs: List[StageOneVarCls]
-
-    runsByPatient: List[PatientRun] = []
-
-    for mrnChunk in tqdm(chunks, desc="Patients Stage I", position=0):
-        processed_chunks = []
-        patient_meta = patients_meta.get(mrnChunk["MRN"], None)
-
-        for chunk in tqdm(mrnChunk["chunks"], desc="Chunk n of patient", position=1):
-            processed_chunk = process_chunk(client, chunk, s1_clean_schema, StageOneVarCls, patient_meta)
-            processed_chunks.append(processed_chunk)
-
-        runsByPatient.append({"mrn": mrnChunk["MRN"], "runs": processed_chunks})
-
-    for patient in tqdm(runsByPatient, desc="Patients Stage II", position=0):
-        mrn = patient["mrn"]
-        # runs = patient["runs"]
-        resolved_vars: Dict[str, Any] = {}
-
-        # 1. for each variable
-        for var_id, var in stage_1_vars.items():
-            resolved = None
-            individual_values: List[variables.MedicalFact] = [
-                run.__dict__[var_id]
-                for run in patient["runs"]
-                if  var_id in run.__dict__ and run.__dict__[var_id] is not None
-            ]
-            if len(individual_values) > 0 and var.resolver is not None:
-                # 2. resolve the variable from runs
-                chunk_values: List[variables.ChunkValue] = []
-                for v in individual_values:
-                    matching_notes = notes[notes["NOTE_ID"] == v.note_id]
-
-                    if matching_notes.empty:
-                        print("Warning: No matching note found for NOTE_ID", v.note_id)
-                        continue
-
-                    chunk_values.append(
-                        variables.ChunkValue(
-                            date=variables.PartialDate.parse(
-                                matching_notes["NOTE_DATE"].iloc[0]
-                            ),
-                            value=v.value,
-                        )
-                    )
+    if queue is None:
+        # only the notes of the shard are loaded
+        notes = utils.get_notes(NOTES_FILE, mrns)
+        # the patients with notes, in the order they are chunked
+        patient_mrns = [int(mrn) for mrn in np.sort(notes["MRN"].unique())]
 
-                resolved = var.resolver(chunk_values)
-            resolved_vars[var_id] = resolved
+    # evidence dates are looked up by NOTE_ID when resolving variables
+    note_index = NoteIndex(notes)
+
+    # in incremental mode, the stored runs of unchanged chunks are reused instead of querying them again
+    previous_run: Optional[PreviousRun] = None
+    if args.previous_run_id is not None:
+        previous_run = PreviousRun(get_output_dir(args.previous_run_id), patient_mrns if queue is None else all_mrns)
+        print(
+            f"Incremental run: found {len(previous_run)} patients of this shard in the {previous_run.n_journals} "
+            + f"journals of run {args.previous_run_id}."
+        )
+    incremental_stats = {"patients_reused": 0, "chunks_reused": 0, "chunks_partial": 0, "chunks_queried": 0}
+    # variables whose definition changed since the previous run, their stored values are extracted again.
+    # changes of the schema or prompt are detected per patient from the journaled fingerprints, these are added
+    changed_var_ids = [var_id.strip() for var_id in (args.changed_variables or "").split(",") if var_id.strip()]
+    unknown_var_ids = [var_id for var_id in changed_var_ids if var_id not in variables.LM_VARIABLES]
+    if len(unknown_var_ids) > 0:
+        raise ValueError(f"Unknown variables in --changed-variables: {unknown_var_ids}")
+    fingerprints = variable_fingerprints(variables.LM_VARIABLES)
+    # number of patients each variable was detected as changed for
+    detected_changes: Dict[str, int] = {}
+
+    output_dir = get_output_dir(args.run_id)
+
+    # make sure folder exists:
+    os.makedirs(output_dir, exist_ok=True)
+
+    # completed patients are journaled, so a restarted shard continues where it stopped
+    journal = PatientJournal(output_dir + f"journal_shard_{args.shard_id}_of_{args.total_shards}.jsonl")
+    journaled = journal.offsets()
+    if queue is None:
+        n_done = sum(1 for mrn in patient_mrns if mrn in journaled)
+        if n_done > 0:
+            print(f"Resuming from journal: {n_done} of {len(patient_mrns)} patients are already done.")
+        patients_progress = tqdm(total=len(patient_mrns), initial=n_done, desc="Patients", position=0)
+    else:
+        # unique per process, so leases of an earlier run of this worker expire instead of being renewed
+        worker_id = f"{args.shard_id}/{socket.gethostname()}/{os.getpid()}"
+        # patients journaled by an earlier run of this worker are done, even if their lease expired since
+        queue.complete(worker_id, list(journaled))
+        patients_progress = tqdm(initial=len(journaled), desc="Patients", position=0)
+
+    prefilter_stats = PrefilterStats()
+    llm.metrics = MetricsWriter(output_dir + f"metrics_shard_{args.shard_id}_of_{args.total_shards}.jsonl", args.shard_id)
+
+    chunks_progress = tqdm(desc="Chunks", position=1)
+
+    # patients and their notes are written as soon as they are finalized, so they don't pile up in memory
+    output_suffix = ".jsonl.gz" if args.compress_output else ".jsonl"
+    patients_writer = JsonlWriter(output_dir + f"patients_shard_{args.shard_id}_of_{args.total_shards}{output_suffix}")
+    notes_writer = JsonlWriter(output_dir + f"notes_shard_{args.shard_id}_of_{args.total_shards}{output_suffix}")
+    note_mrns = notes["MRN"].to_numpy()  # notes are sorted by MRN
+
+    def get_patient_notes(mrn: int) -> pd.DataFrame:
+        return notes.iloc[np.searchsorted(note_mrns, mrn, "left") : np.searchsorted(note_mrns, mrn, "right")]
+
+    def write_patient(patient: ProcessedPatient):
+        patients_writer.write(patient)
+        notes_writer.write_lines(
+            get_patient_notes(patient["mrn"]).drop(columns="NOTE_DATE_KEY", errors="ignore").rename(
+                columns={
+                    "NOTE_ID": "id",
+                    "MRN": "mrn",
+                    "NOTE_DATE": "date",
+                    "NOTE_TEXT": "text",
+                }
+            ).to_json(orient="records", lines=True)
+        )
+
+    # a shard writes its patients in MRN order whatever order they complete in, so the same input gives the
+    # same output: completed patients wait in memory for the ones before them (requests are prioritized by
+    # position, so few do), patients resumed from the journal are read back from it when it's their turn.
+    # queue workers claim their patients in no fixed order and write them as they complete
+    completed: Dict[int, ProcessedPatient] = {}
+    next_position = 0
+
+    def complete_patient(mrn: int, patient: ProcessedPatient):
+        if queue is None:
+            completed[mrn] = patient
+            write_completed()
+        else:
+            write_patient(patient)
+
+    def write_completed():
+        """ Writes the completed and journaled patients up to the first one that is still in progress."""
+        nonlocal next_position
+        while next_position < len(patient_mrns):
+            next_mrn = patient_mrns[next_position]
+            if next_mrn in completed:
+                write_patient(completed.pop(next_mrn))
+            elif next_mrn in journaled:
+                write_patient(journal.read(journaled[next_mrn])["patient"])
+            else:
+                break
+            next_position += 1
+
+    if queue is None:
+        write_completed()
+    else:
+        # the patients resumed from the journal are written again, a worker only exports the patients with notes in it
+        exported: Dict[int, bool] = {}
+        for record in journal.iter_records():
+            if record["mrn"] not in exported and len(get_patient_notes(record["mrn"])) > 0:
+                write_patient(record["patient"])
+                exported[record["mrn"]] = True
+
+    async def process_patient(patient_idx: int, mrnChunk: MRNChunks):
+        """
+        Runs Stage I and Stage II for one patient. Stage II is queued as soon as the patient's own
+        Stage I is done, so both stages overlap across the patients of the shard.
+        Requests are prioritized by the patient's position, so started patients finish first.
+        The finalized patient is appended to the journal and written to the output, then its runs are freed.
+        """
+        mrn = mrnChunk["MRN"]
+        patient_meta = patients_meta.get(mrn, None)
+
+        chunks = mrnChunk["chunks"]
+        previous = previous_run.pop(mrn) if previous_run is not None else None
+        journal_runs: List[JournalRun] = []
+
+        patient_changed_var_ids = changed_var_ids
+        if previous is not None:
+            detected = [var_id for var_id in changed_variables(previous, fingerprints) if var_id not in changed_var_ids]
+            for var_id in detected:
+                detected_changes[var_id] = detected_changes.get(var_id, 0) + 1
+            patient_changed_var_ids = changed_var_ids + detected
+
+        async def run_stage(
+            stage: int, chunk_indices: List[int], record: variables.RecordSchema, var_ids: List[str], reverse: bool = False
+        ) -> List[Any]:
+            """
+            Returns the runs of the given chunks. For chunks unchanged since the previous run, the stored results
+            are reused, and only the variables missing in them (new, changed or newly activated) are queried,
+            with a record of just those variables. Changed chunks are queried for all variables.
+            """
+            matches = match_runs(chunks, previous["runs"], stage) if previous is not None else {}
+            missing_by_chunk = {i: missing_variables(matches.get(i), var_ids, patient_changed_var_ids) for i in chunk_indices}
+
+            # chunks that miss the same variables are queried together
+            groups: Dict[tuple, List[int]] = {}
+            for i in chunk_indices:
+                if len(missing_by_chunk[i]) > 0:
+                    groups.setdefault(tuple(missing_by_chunk[i]), []).append(i)
+
+            async def query(missing: tuple, indices: List[int]) -> List[Any]:
+                group_record = record if len(missing) == len(var_ids) else variables.get_record_schema(missing)
+                return await process_chunks(
+                    llm, patient_semaphore, patient_idx, {"MRN": mrn, "chunks": [chunks[i] for i in indices]},
+                    group_record, patient_meta, chunks_progress, slot, reverse=reverse, stage=stage, chunk_indices=indices,
+                )
+
+            group_runs = await asyncio.gather(*[query(missing, indices) for missing, indices in groups.items()])
+            queried = {i: run for indices, runs in zip(groups.values(), group_runs) for i, run in zip(indices, runs)}
+
+            stage_runs = []
+            for i in chunk_indices:
+                if i in queried and len(missing_by_chunk[i]) == len(var_ids):
+                    run = queried[i]
+                    incremental_stats["chunks_queried"] += 1
+                else:
+                    # the stored values of the variables that are still current, plus the newly queried ones
+                    stored = matches[i]["result"]
+                    result = {var_id: stored[var_id] for var_id in var_ids if var_id in stored}
+                    if i in queried:
+                        result.update(queried[i].model_dump(mode="json"))
+                        incremental_stats["chunks_partial"] += 1
+                    else:
+                        incremental_stats["chunks_reused"] += 1
+                    run = record.cls.model_validate(result)
+                stage_runs.append(run)
+
+            journal_runs.extend(
+                {
+                    "stage": stage,
+                    "chunk": i,
+                    "note_ids": chunks[i]["source_note_ids"],
+                    "result": run.model_dump(mode="json"),
+                    "hash": chunk_hash(chunks[i]),
+                }
+                for i, run in zip(chunk_indices, stage_runs)
+            )
+            return stage_runs
+
+        if previous is not None and is_unchanged(
+            chunks,
+            previous,
+            match_runs(chunks, previous["runs"], 1),
+            list(variables.LM_VARIABLES),
+            patient_changed_var_ids,
+        ):
+            # same chunks and variables as in the previous run: same runs and findings, nothing to query or resolve
+            for run in previous["runs"]:
+                run["hash"] = chunk_hash(chunks[run["chunk"]])
+            journal.append(
+                {"mrn": mrn, "runs": previous["runs"], "patient": previous["patient"], "fingerprints": fingerprints}
+            )
+            complete_patient(mrn, previous["patient"])
+            incremental_stats["patients_reused"] += 1
+            patients_progress.update(1)
+            return
+
+        slot = None
+        patient_semaphore = semaphore
+        if slot_pool is not None:
+            slot = slot_pool.assign(len(mrnChunk["chunks"]))
+            patient_semaphore = slot_pool.semaphores[slot]
+
+        runs = await run_stage(1, list(range(len(chunks))), s1_record, list(stage_1_vars))
+
+        # the runs are inverted per variable once, and each variable is resolved once for activation and export
+        resolution = PatientResolution(note_index, runs)
+        resolved_vars = resolution.resolve_all(stage_1_vars)
 
         # 3. compute activation function for all vars where is_active is not None
         stage_2_vars = {
@@ -190,156 +765,156 @@ def main(args, llm_endpoint: str):
 
         if len(stage_2_vars) == 0:
             print(f"No active variables for MRN {mrn}. Skipping stage 2.")
-            continue
+        else:
+            # 4. get the class with activated vars (built once per set of activated vars)
+            s2_record = variables.get_record_schema(stage_2_vars)
 
-        # 4. create new class with activated vars
-        StageTwoVarCls = variables.create_medical_record_class(stage_2_vars)
-        s2_clean_schema = utils.strip_titles_and_refs(
-            TypeAdapter(StageTwoVarCls).json_schema()
+            # 5. for each chunk that can mention an active variable, invoke the llm again.
+            chunk_indices = list(range(len(chunks)))
+            if args.prefilter:
+                chunk_indices = prefilter_chunks(chunks, stage_2_vars, args.prefilter_recall, prefilter_stats)
+
+            # in reverse, so the first request can reuse the last Stage I chunk still cached in the slot
+            stage_2_runs = await run_stage(2, chunk_indices, s2_record, list(stage_2_vars), reverse=slot is not None)
+            resolution.add_runs(stage_2_runs)
+
+        processed_patient = build_processed_patient(mrn, resolution, patient_meta)
+        journal.append(
+            {"mrn": mrn, "runs": journal_runs, "patient": dict(processed_patient), "fingerprints": fingerprints}
         )
+        complete_patient(mrn, processed_patient)
+        patients_progress.update(1)
 
-        # 5. for each chunk, invoke the llm again
-        mrnChunk: MRNChunks = next((item for item in chunks if item["MRN"] == mrn))
-        processed_chunks = []
-        patient_meta = patients_meta.get(mrn, None)
-        for chunk in tqdm(mrnChunk["chunks"], desc="Chunk n of patient", position=1):
-            processed_chunk = process_chunk(client, chunk, s2_clean_schema, StageTwoVarCls, patient_meta)
-            processed_chunks.append(processed_chunk)
-
-        patient["runs"].extend(processed_chunks)
-
-    class Evidence(TypedDict):
-        source_note_id: int
-        citation: str
-        value: Union[str, int, float, bool, None]
-        confidence: float
-
-    class Finding(TypedDict):
-        varId: str
-        redcap_name: Optional[str]
-        value: Union[str, int, float, bool, None]
-        evidence: List[Evidence]
-        confidence: float
-
-
-    class ProcessedPatient(TypedDict):
-        mrn: int
-        findings: List[Finding]
-        dateOfBirth: Union[str, None]  # Assuming dateOfBirth is a string in ISO format
-        firstName: Union[str, None]  # Optional to allow for missing data
-        lastName: Union[str, None]
-        gender: Union[str, None]
-
-    def get_value(obj):
-        if obj is None:
-            return None
-        elif isinstance(obj, Enum):
-            return obj.value
-        elif hasattr(obj, "value"):
-            if isinstance(obj.value, Enum):
-                return obj.value.value
-            else:
-                return obj.value
-        elif isinstance(obj, list):
-            return [get_value(item) for item in obj]
-        elif isinstance(obj, BaseModel):
-            return obj.model_dump()
-        else:
-            return obj
+    async def next_patient(patients: Iterator[MRNChunks]) -> Optional[MRNChunks]:
+        """
+        Returns the next chunked patient, None if there are no more. With a token budget, chunking tokenizes every
+        note (with the server's tokenizer, one /tokenize request per note), so it runs in a worker thread and
+        doesn't block the requests of the patients already started.
+        """
+        if args.token_budget:
+            return await asyncio.to_thread(next, patients, None)
+        return next(patients, None)
 
-    used_vars = {key: value for key, value in variables.LM_VARIABLES.items()}
+    async def run_queue_worker():
+        """
+        Claims one patient at a time from the queue and processes it, in several lanes so that the
+        LLM slots stay busy. Leases are renewed while the patients are in progress.
+        Returns once the queue has nothing left to claim.
+        """
+        assert queue is not None
+        in_progress: List[int] = []  # (the module shadows the builtin set)
+        claim_order = iter(range(len(all_mrns)))
 
-    processed_patients: List[ProcessedPatient] = []
-    for p in runsByPatient:
-        patient_meta = patients_meta.get(p["mrn"], None)
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(args.lease_seconds / 3)
+                await asyncio.to_thread(queue.heartbeat, worker_id, list(in_progress))
 
-        pp: ProcessedPatient = {
-            "mrn": p["mrn"],
-            "findings": [],
-            "dateOfBirth": patient_meta.date_of_birth if  patient_meta else None,
-            "firstName": patient_meta.first_name if  patient_meta else None,
-            "lastName": patient_meta.last_name if  patient_meta else None,
-            "gender": patient_meta.gender if  patient_meta else None,
-        }
-       
-        for var_id, var_def in used_vars.items():
-            # get a list of all the values for the variable in all runs
-            run_values: List[variables.MedicalFact] = [
-                run.__dict__[var_id]
-                for run in p["runs"]
-                if var_id in run.__dict__ and run.__dict__[var_id] is not None
-            ]
-            resolved_value = None
-            if len(run_values) > 0 and var_def.resolver is not None:
-                chunk_values = []
-                for v in run_values:
-                    matching_notes = notes[notes["NOTE_ID"] == v.note_id]
-                    if matching_notes.empty:
-                        print("Warning: No matching note found for NOTE_ID", v.note_id)
-                        continue
-
-                    chunk_values.append(
-                        variables.ChunkValue(
-                            date=variables.PartialDate.parse(
-                                matching_notes["NOTE_DATE"].iloc[0]
-                            ),
-                            value=v.value,
-                        )
-                    )
-                resolved_value = var_def.resolver(chunk_values)
-
-            evidence = []
-            for run in p["runs"]:
-                if var_id in run.__dict__ and run.__dict__[var_id] is not None:
-                    var_in_run = run.__dict__[var_id]
-
-                    # v = var_in_run.value.value if isinstance(var_in_run, Enum) else var_in_run.value
-                    # print(var_in_run,)
-                    # if isinstance(v, variables.RelativeCancerInfo):
-                    evidence.append(
-                        {
-                            "source_note_id": var_in_run.note_id,
-                            "citation": var_in_run.citation,
-                            "value": get_value(var_in_run.value),
-                            "confidence": 1.0,
-                        }
+        lanes: List[asyncio.Task] = []
+
+        def add_lanes(n_slots: int):
+            # twice the slots, so a patient between its stages doesn't leave a slot idle
+            lanes.extend(asyncio.create_task(lane()) for _ in range(2 * n_slots))
+
+        async def lane():
+            while True:
+                claimed = await asyncio.to_thread(queue.claim, worker_id)
+                if len(claimed) == 0:
+                    return
+                mrn = claimed[0]
+                in_progress.append(mrn)
+                try:
+                    # patients without notes have no chunks and are not exported, as in a shard
+                    mrnChunk = await next_patient(
+                        utils.iter_chunk_notes(get_patient_notes(mrn), 18000, chunk_max_tokens, count_tokens)
                     )
-            # add finding to processed patient
-            pp["findings"].append(
-                {
-                    "varId": var_id,
-                    "redcap_name": var_def.redcap_id,
-                    "value": get_value(resolved_value),
-                    "evidence": evidence,
-                    "confidence": 1.0,
-                }
-            )
-        processed_patients.append(pp)
+                    if mrnChunk is not None:
+                        await process_patient(next(claim_order), mrnChunk)
+                except Exception:
+                    # counts as an attempt of this patient, the other patients in progress are released
+                    in_progress.remove(mrn)
+                    await asyncio.to_thread(queue.fail, worker_id, [mrn])
+                    raise
+                await asyncio.to_thread(queue.complete, worker_id, [mrn])
+                in_progress.remove(mrn)
 
-    output_dir = (
-        f"/sc/arion/projects/hpims-hpi/user/janssm02/data_extraction_w_LLM/data/processed/shards/{args.run_id}/"
-    )
+        heartbeat_task = asyncio.create_task(heartbeat())
+        try:
+            add_lanes(args.concurrency * len(pool))
+            on_pool_growth.append(add_lanes)
+            # lanes are added while running, when servers join the pool
+            while len(pending := [task for task in lanes if not task.done()]) > 0:
+                await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+                for task in lanes:
+                    if task.done() and not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+        finally:
+            for task in lanes:
+                task.cancel()
+            heartbeat_task.cancel()
+            queue.release(worker_id)
 
-    # make sure folder exists:
-    os.makedirs(output_dir, exist_ok=True)
+    registry_task = asyncio.create_task(follow_registry()) if registry is not None else None
+    try:
+        if queue is None:
+            tasks = []
+            patients = utils.iter_chunk_notes(notes, 18000, chunk_max_tokens, count_tokens)
+            i = 0
+            while (mrnChunk := await next_patient(patients)) is not None:
+                if mrnChunk["MRN"] not in journaled:
+                    tasks.append(asyncio.create_task(process_patient(i, mrnChunk)))
+                i += 1
+                # let the first requests go out while the remaining patients are chunked
+                await asyncio.sleep(0)
+            await asyncio.gather(*tasks)
+        else:
+            await run_queue_worker()
+    except BaseException:
+        if queue is None:
+            # without the unfinished patients the output is incomplete, the journal has the finished ones
+            patients_writer.discard()
+            notes_writer.discard()
+        else:
+            # the queue marked the written patients done, no other worker processes them again
+            patients_writer.close()
+            notes_writer.close()
+        raise
+    finally:
+        if registry_task is not None:
+            registry_task.cancel()
+        llm.metrics.close()
+    patients_progress.close()
+    chunks_progress.close()
 
-    patients_output_filename = f"patients_shard_{args.shard_id}_of_{args.total_shards}.json"
-    with open(output_dir + patients_output_filename, "w") as f:
-        json.dump(processed_patients, f)
-        print(f"Saved processed patients to {output_dir + patients_output_filename}")
-
-    notes_output_filename = f"notes_shard_{args.shard_id}_of_{args.total_shards}.json"
-    notes_dict = notes.rename(
-        columns={
-            "NOTE_ID": "id",
-            "MRN": "mrn",
-            "NOTE_DATE": "date",
-            "NOTE_TEXT": "text",
-        }
-    ).to_json(orient="records")
-    with open(output_dir + notes_output_filename, "w") as f:
-        f.write(notes_dict)
-        print(f"Saved notes for this shard to {output_dir + notes_output_filename}")
+    if cache is not None:
+        print(f"Response cache: {cache.hits} hits, {cache.misses} misses.")
+    if previous_run is not None:
+        print(
+            f"Incremental: reused {incremental_stats['patients_reused']} unchanged patients and "
+            + f"{incremental_stats['chunks_reused']} chunks, queried {incremental_stats['chunks_partial']} chunks "
+            + f"for new or changed variables only and {incremental_stats['chunks_queried']} chunks for all variables."
+        )
+        if len(detected_changes) > 0:
+            print(
+                "Incremental: variables whose schema or prompt changed since the previous run (patients): "
+                + ", ".join(f"{var_id} ({n})" for var_id, n in detected_changes.items())
+            )
+    if args.prefilter:
+        print(
+            f"Prefilter: skipped {prefilter_stats.chunks_skipped} of {prefilter_stats.chunks_total} Stage II chunks "
+            + f"(~{prefilter_stats.tokens_skipped} of ~{prefilter_stats.tokens_total} tokens)."
+        )
+    print(
+        f"Server prompt cache: {llm.prompt_cache.hit_rate:.1%} of prompt tokens reused "
+        + f"({llm.prompt_cache.cached_tokens} cached, {llm.prompt_cache.evaluated_tokens} evaluated)."
+    )
+
+    patients_writer.close()
+    print(f"Saved {patients_writer.count} processed patients to {patients_writer.path}")
+    notes_writer.close()
+    print(f"Saved {notes_writer.count} notes for this shard to {notes_writer.path}")
+    if queue is not None:
+        print(f"Work queue: {queue.counts()}")
 
     # run metadata if shard_id == 0
     if args.shard_id == 0:
@@ -351,38 +926,34 @@ def main(args, llm_endpoint: str):
                 "notes_file": NOTES_FILE,
                 "patients_meta_file": PATIENTS_META_FILE,
                 "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "partition": {"method": args.partition, "shards": shard_plans},
+                "queue": args.queue,
+                "previous_run_id": args.previous_run_id,
+                "changed_variables": args.changed_variables,
+                "output": {"format": "jsonl", "compression": "gzip" if args.compress_output else None},
             }, f)
 
 
 @contextmanager
-def init_server(log_file_path, shard_id: int):
+def init_server(log_file_path, shard_id: int, parallel: int = 1, timeout: float = 1800):
     print("starting inference server...")
     port = 5912 + shard_id
     with open(log_file_path, "w") as log_file:
         server_process = subprocess.Popen(
             # ["sh", "medgemma.sh", "--port", str(port)],
-            ["sh", "llama3.3.sh", "--port", str(port)], 
+            ["sh", "llama3.3.sh", "--port", str(port), "--parallel", str(parallel)], 
             stderr=log_file
         )
         try:
-            # wait for the server to start
-            url = f"http://localhost:{port}/health"
-            start_time = time.time()
-            while True:
-                if time.time() - start_time > 120:  # timeout after 120 seconds
-                    print("Server did not start in time. Exiting.")
-                    server_process.terminate()
-                    yield (None, None)
-                    return
-                try:
-                    res = requests.get(url)
-                    if res.status_code == 200:
-                        print("Server is running")
-                        break
-                except Exception as e:
-                    print(".", end="")
-                time.sleep(1)
-            yield (server_process, f"http://localhost:{port}/v1")
+            # wait for the server to load the model, or give up if it exits or takes too long
+            llm_endpoint = f"http://localhost:{port}/v1"
+            if not wait_until_ready(llm_endpoint, timeout, is_alive=lambda: server_process.poll() is None):
+                print(f"Server did not start within {timeout} seconds. Exiting.")
+                yield (None, None)
+                return
+            print("Server is running")
+            warmup(llm_endpoint, MODEL)
+            yield (server_process, llm_endpoint)
         finally:
             server_process.terminate()
             print("Server process terminated.")
@@ -393,28 +964,100 @@ if __name__ == "__main__":
     parser.add_argument("--total-shards", type=int, required=True, help="The total number of parallel jobs (shards).")
     parser.add_argument("--shard-id", type=int, required=True, help="The 0-indexed ID of this job's shard.")
     parser.add_argument("--run-id", type=str, required=True, help="The run ID for this job, used for logging and tracking.")
+    parser.add_argument("--partition", type=str, choices=["contiguous", "balanced"], default="contiguous", help="How MRNs are split into shards: contiguous blocks of equal size, or balanced by the predicted cost (chunks and tokens) of each patient. All shards of a run must use the same method.")
+    parser.add_argument("--queue", type=str, default=None, help="SQLite work queue file on the shared filesystem. If set, the workers pull patients from it until the cohort is done, instead of processing a fixed shard. --shard-id is then the worker id and --total-shards the number of workers. A worker that fails keeps the patients it completed in its output; the patients of a killed worker are recovered from its journal by merge.py (restart it with the same id to also export their notes).")
+    parser.add_argument("--max-attempts", type=int, default=3, help="With --queue, how often a patient is claimed (and failed, or its worker died) before it is marked failed instead of handed out again.")
+    parser.add_argument("--lease-seconds", type=float, default=600, help="How long a claimed patient stays leased to a worker without a heartbeat, before other workers can claim it.")
+    parser.add_argument("--concurrency", type=int, default=None, help="Max. number of chunk requests in flight per LLM endpoint. Also used as the number of parallel slots of the llama-server. Defaults to the slots of the broker's servers (1 with the prefix layout, whose slots are reserved per shard), or 1.")
+    parser.add_argument("--endpoints", type=str, default=None, help="Comma-separated OpenAI-compatible base urls (e.g. http://node1:5912/v1) of running LLM servers. If set, no local server is started and requests are balanced across them.")
+    parser.add_argument("--prompt-layout", type=str, choices=[layout.value for layout in PromptLayout], default=PromptLayout.default.value, help="Order of the prompt parts. 'prefix' puts the chunk text before the schema and pins each patient to one server slot, to maximize prompt cache reuse. With --broker-registry, the shard reserves --concurrency slots of each server, so shards sharing a server don't pin to the same slots.")
+    parser.add_argument("--token-budget", action="store_true", help="Chunk notes by a token budget derived from the server's context size, instead of by 18000 characters. Every note is tokenized: without --tokenizer that is one /tokenize request per note to the server (done in a background thread while the extraction runs), so prefer a local --tokenizer for large shards.")
+    parser.add_argument("--tokenizer", type=str, default=None, help="Local tokenizer.json or Hugging Face model id used to count tokens. Defaults to the server's /tokenize endpoint.")
+    parser.add_argument("--context-size", type=int, default=None, help="Context size per server slot in tokens. Defaults to the size reported by the server's /props.")
+    parser.add_argument("--max-output-tokens", type=int, default=2048, help="Tokens reserved for the LLM's response when computing the token budget.")
+    parser.add_argument("--prefilter", action="store_true", help="Skip Stage II chunks that don't contain any query term of the active variables.")
+    parser.add_argument("--prefilter-recall", type=float, default=0.95, help="Share of each active variable's BM25 score mass the kept chunks must cover. 1.0 keeps every chunk with any matching term.")
+    parser.add_argument("--grammar", action="store_true", help="Constrain the output with a GBNF grammar compiled once per schema (and cached in --cache-dir), instead of a JSON schema response format the server converts on every request.")
+    parser.add_argument("--grammar-max-string", type=int, default=None, help="With --grammar, max. number of characters of every string in the output: citations and string values alike, so leave room for the longest value.")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Directory of the on-disk LLM response cache. Can be shared by all shards. Disabled if not set.")
+    parser.add_argument("--broker-registry", type=str, default=None, help="Registry file of a server broker (see broker.py). If set, the shard attaches to the broker's warm servers instead of starting its own, and picks up servers registered while it runs.")
+    parser.add_argument("--server-timeout", type=float, default=1800, help="Seconds to wait for the own server to load the model, or for the broker to register a server.")
+    parser.add_argument("--notes-store", type=str, default=None, help="Notes store made by convert_notes.py. If set, the notes and patient meta are read from it instead of the CSVs.")
+    parser.add_argument("--previous-run-id", type=str, default=None, help="Incremental mode: reuse the journaled runs of this earlier run for chunks that are unchanged, and only query the new or changed chunks (e.g. after new notes arrived).")
+    parser.add_argument("--changed-variables", type=str, default=None, help="With --previous-run-id, comma-separated ids of variables to extract again from every chunk, in addition to the ones detected automatically: variables whose schema or prompt changed (by the fingerprints journaled with the previous run) and the ones the previous run didn't extract. Use it for changes the fingerprints don't cover, or for previous runs journaled without fingerprints. The stored values of all other variables are reused.")
+    parser.add_argument("--compress-output", action="store_true", help="Write the patients and notes of the shard gzip-compressed (.jsonl.gz).")
+    parser.add_argument("--cache-max-gb", type=float, default=10.0, help="Max. size of the response cache in GB.")
     args = parser.parse_args()
 
+    if args.previous_run_id is not None and args.previous_run_id.strip() == args.run_id.strip():
+        raise ValueError("The previous run of an incremental run must have a different run ID.")
+    if args.changed_variables is not None and args.previous_run_id is None:
+        raise ValueError("--changed-variables needs the --previous-run-id to compare with.")
+
     if args.shard_id >= args.total_shards:
         raise ValueError(f"Shard ID ({args.shard_id}) must be less than total shards ({args.total_shards}).")
 
     print(f"--- Running shard {args.shard_id} of {args.total_shards} ---")
 
-    print("running extraction pipeline...")
+    if args.notes_store is not None:
+        NOTES_FILE = os.path.join(args.notes_store, "notes")
+        PATIENTS_META_FILE = os.path.join(args.notes_store, "patient_meta.parquet")
 
-    with init_server(f"output.{args.shard_id}.log", args.shard_id) as (server_process, llm_endpoint):
-        if server_process is None or llm_endpoint is None:
-            print("Failed to start the server. Exiting.")
-            exit(1)
+    # turn SIGTERM (e.g. on preemption) into a regular exit, so the server is terminated cleanly.
+    # patients completed so far are already in the journal and are skipped when the shard is restarted.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
 
-        print("Server started successfully. Running extraction pipeline...")
+    print("running extraction pipeline...")
 
+    if args.concurrency is not None and args.concurrency < 1:
+        raise ValueError(f"Concurrency ({args.concurrency}) must be at least 1.")
+
+    if args.endpoints is not None or args.broker_registry is not None:
+        registry = ServerRegistry(args.broker_registry) if args.broker_registry is not None else None
+        client_id = f"{args.run_id}/{args.shard_id}/{os.getpid()}"
+        if registry is not None:
+            print(f"Attaching to the servers of broker {args.broker_registry}...")
+            if args.prompt_layout == PromptLayout.prefix.value and args.concurrency is None:
+                # the slots are reserved per shard, so by default every shard of the broker gets a share
+                args.concurrency = 1
+            servers = registry.wait_and_attach(client_id, args.server_timeout, n_slots=get_reserved_slots(args))
+            if len(servers) == 0:
+                print(f"The broker registered no server (with free slots) within {args.server_timeout} seconds. Exiting.")
+                exit(1)
+            llm_endpoints = [server["url"] for server in servers]
+            slot_ids = [server.get("reserved", {}).get(client_id) for server in servers]
+            if args.concurrency is None:
+                args.concurrency = min(server["slots"] for server in servers)
+        else:
+            llm_endpoints = [url.strip() for url in args.endpoints.split(",") if url.strip()]
+            slot_ids = None
+        if args.concurrency is None:
+            args.concurrency = 1
+        print(f"Using {len(llm_endpoints)} existing LLM endpoint(s). Running extraction pipeline...")
         try:
-            main(args, llm_endpoint)    
+            asyncio.run(main(args, llm_endpoints, registry, client_id, slot_ids))
         except Exception as e:
             traceback.print_exc()
             print(f"An error occurred during the extraction pipeline: {e}")
         finally:
-            print("main pipeline finished, terminating server...")
+            if registry is not None:
+                registry.release(client_id)
+    else:
+        if args.concurrency is None:
+            args.concurrency = 1
+        with init_server(f"output.{args.shard_id}.log", args.shard_id, args.concurrency, args.server_timeout) as (server_process, llm_endpoint):
+            if server_process is None or llm_endpoint is None:
+                print("Failed to start the server. Exiting.")
+                exit(1)
+
+            print("Server started successfully. Running extraction pipeline...")
+
+            try:
+                asyncio.run(main(args, [llm_endpoint]))
+            except Exception as e:
+                traceback.print_exc()
+                print(f"An error occurred during the extraction pipeline: {e}")
+            finally:
+                print("main pipeline finished, terminating server...")
 
-    print("server terminated successfully.")
\ No newline at end of file
+        print("server terminated successfully.")
\ No newline at end of file
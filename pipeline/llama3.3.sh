@@ -7,14 +7,24 @@ ml load cuda/12
 export HF_HUB_CACHE=/sc/arion/projects/hpims-hpi/user/janssm02/vllm/hub
 export LLAMA_CACHE=/sc/arion/projects/hpims-hpi/user/janssm02/llama
 
-# Parse port argument (default: 5912)
+# Parse port, parallel slots and device arguments (default: 5912, 1 slot, CUDA0)
 PORT=5912
+PARALLEL=1
+DEVICE=CUDA0
 while [[ $# -gt 0 ]]; do
   case $1 in
     --port)
       PORT="$2"
       shift 2
       ;;
+    --parallel)
+      PARALLEL="$2"
+      shift 2
+      ;;
+    --device)
+      DEVICE="$2"
+      shift 2
+      ;;
     *)
       shift
       ;;
@@ -30,10 +40,13 @@ forward_sigterm() {
 # Trap SIGTERM and call forward_sigterm
 trap forward_sigterm SIGTERM
 
+# The context is split evenly between the slots, so every slot keeps 16384 tokens
+CTX_SIZE=$((16384 * PARALLEL))
+
 # Start your process in the background
 ../llama.cpp/build/bin/llama-server \
   -hf unsloth/Llama-3.3-70B-Instruct-GGUF:Q4_K_M \
-  -c 16384 -ngl 100 --no-mmap --device CUDA0 --flash-attn --port "$PORT" --host 0.0.0.0 &
+  -c "$CTX_SIZE" -np "$PARALLEL" -ngl 100 --no-mmap --device "$DEVICE" --flash-attn --port "$PORT" --host 0.0.0.0 &
 
 # Save the PID of the background process
 child=$!
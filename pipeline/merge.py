@@ -2,95 +2,200 @@ import os
 import json
 import glob
 import argparse
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
 
+from src.xllm.journal import PatientJournal
+from src.xllm.records import IdSet, iter_json_records
+from src.xllm.writer import JsonArrayWriter, JsonlWriter
 
-def merge_json_shards(file_paths, output_path):
+SHARD_SUFFIXES = [".jsonl.gz", ".jsonl", ".json.gz", ".json"]
+""" File extensions of shard files, in order of preference if a shard has more than one."""
+
+
+def merge_json_shards(
+    file_paths,
+    output_path,
+    key: Optional[str] = None,
+    output_format: str = "json",
+    journal_paths: Sequence[str] = (),
+):
     """
-    Reads a list of JSON files, each containing a list of objects,
-    and merges them into a single list in a new JSON file.
+    Streams the records of a list of shard files (JSON arrays or JSONL, optionally gzip-compressed)
+    into a single output file, one record at a time, so memory doesn't grow with the size of the shards.
 
     Args:
-        file_paths (list): A list of full paths to the JSON shard files.
-        output_path (str): The full path for the merged output JSON file.
+        file_paths (list): A list of full paths to the shard files, in the order they are merged.
+        output_path (str): The full path for the merged output file (gzip-compressed if it ends in .gz).
+            It is only written if all shards could be read, otherwise the error is raised.
+        key (str): If set, records with a key value that was already merged are dropped (the first one is kept).
+        output_format (str): "json" for a JSON array with one record per line, or "jsonl".
+        journal_paths (list): Journals of shards without output file, whose journaled patients are merged after the shards.
     """
-    merged_data = []
-    
-    # Sort files for deterministic order, although not strictly necessary
-    for file_path in sorted(file_paths):
-        print(f"  - Reading {os.path.basename(file_path)}...")
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                # Load the JSON data, which is expected to be a list
-                data = json.load(f)
-                if isinstance(data, list):
-                    # Extend the main list with the list from the file
-                    merged_data.extend(data)
-                else:
-                    print(f"    - WARNING: File did not contain a list. Skipping: {file_path}")
-        except json.JSONDecodeError:
-            print(f"    - ERROR: Could not decode JSON. File may be corrupt. Skipping: {file_path}")
-        except Exception as e:
-            print(f"    - ERROR: An unexpected error occurred with file {file_path}: {e}")
-
-    print(f"Total objects merged: {len(merged_data)}")
-    print(f"Writing merged data to: {output_path}")
-
     # Ensure the output directory exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    # Write the merged list to the output file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        # Use indent for a human-readable output file
-        json.dump(merged_data, f, indent=2)
+    writer = JsonArrayWriter(output_path) if output_format == "json" else JsonlWriter(output_path)
+    seen = IdSet() if key is not None else None
+    n_duplicates = 0
+
+    # a shard that can't be read aborts the merge, the output isn't written with only part of its records
+    with writer:
+        for file_path in file_paths:
+            print(f"  - Reading {os.path.basename(file_path)}...")
+            try:
+                for record in iter_json_records(file_path):
+                    if seen is not None and not seen.add(record[key]):
+                        n_duplicates += 1
+                        continue
+                    writer.write(record)
+            except json.JSONDecodeError:
+                print(f"    - ERROR: Could not decode JSON. File may be corrupt: {file_path}")
+                raise
+            except Exception as e:
+                print(f"    - ERROR: An unexpected error occurred with file {file_path}: {e}")
+                raise
+
+        for journal_path in journal_paths:
+            print(f"  - Recovering patients from {os.path.basename(journal_path)}...")
+            for record in PatientJournal(journal_path).iter_records():
+                if seen is not None and not seen.add(record["patient"][key]):
+                    n_duplicates += 1
+                    continue
+                writer.write(record["patient"])
+
+        print(f"Writing merged data to: {output_path}")
+    print(f"Total objects merged: {writer.count}")
+    if key is not None:
+        print(f"Dropped {n_duplicates} duplicate objects (by {key}).")
 
     print("Write complete.")
 
-def main(run_id: str):
+
+def find_shard_files(inp_dir: str, kind: str) -> Tuple[List[str], List[int]]:
+    """
+    Returns the shard files of the given kind ("patients" or "notes") in the order of the shards,
+    and the ids of the shards that are missing. The expected shards are taken from the run's metadata.json.
+    """
+    metadata_path = os.path.join(inp_dir, "metadata.json")
+    if not os.path.exists(metadata_path):
+        print(f"WARNING: No metadata.json in {inp_dir}, can't check that all shards are present.")
+        return sorted(
+            path for suffix in SHARD_SUFFIXES for path in glob.glob(os.path.join(inp_dir, f"{kind}_shard_*{suffix}"))
+        ), []
+
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        total_shards = json.load(f)["total_shards"]
+
+    file_paths = []
+    missing = []
+    for shard_id in range(total_shards):
+        base_path = os.path.join(inp_dir, f"{kind}_shard_{shard_id}_of_{total_shards}")
+        candidates = [base_path + suffix for suffix in SHARD_SUFFIXES if os.path.exists(base_path + suffix)]
+        if len(candidates) == 0:
+            missing.append(shard_id)
+            continue
+        if len(candidates) > 1:
+            print(f"WARNING: Shard {shard_id} has several {kind} files, using {os.path.basename(candidates[0])}")
+        file_paths.append(candidates[0])
+    return file_paths, missing
+
+
+def find_orphan_journals(inp_dir: str) -> Dict[int, str]:
+    """
+    Returns the journals of the shards (or queue workers) that have no patients file, by shard id,
+    e.g. of a worker that was killed. Their journals hold the patients they completed.
+    """
+    journals = {}
+    for path in sorted(glob.glob(os.path.join(inp_dir, "journal_shard_*_of_*.jsonl"))):
+        match = re.fullmatch(r"journal_shard_(\d+)_of_(\d+)\.jsonl", os.path.basename(path))
+        if match is None:
+            continue
+        base_path = os.path.join(inp_dir, f"patients_shard_{match.group(1)}_of_{match.group(2)}")
+        if not any(os.path.exists(base_path + suffix) for suffix in SHARD_SUFFIXES):
+            journals[int(match.group(1))] = path
+    return journals
+
+
+def main(run_id: str, output_format: str = "json", compress: bool = False, allow_missing: bool = False):
   """
-  Finds all 'notes' and 'patients' JSON shards, and merges each type
-  into a single, consolidated JSON file.
+  Finds all 'notes' and 'patients' shards, checks that every shard of the run is present,
+  and merges each type into a single, consolidated file.
+  Notes are deduplicated by id, and patients by mrn (e.g. if two queue workers processed the same patient).
   """
   # in the folder are two types of files: - patient and note
-  # e.g. notes_shard_0_of_20.json and patients_shard_0_of_20.json
-  # find all files, and merge them into one file in the OUT_DIR
-  # both are arrays of objects.
+  # e.g. notes_shard_0_of_20.jsonl and patients_shard_0_of_20.jsonl
+  # (or .jsonl.gz, or .json arrays from older runs)
 
-  # Use glob to easily find all files matching a pattern
   #           /sc/arion/projects/hpims-hpi/user/janssm02/data_extraction_w_LLM/data/processed/shards/193082461
   INP_DIR = f"/sc/arion/projects/hpims-hpi/user/janssm02/data_extraction_w_LLM/data/processed/shards/{run_id}"
   OUT_DIR  = f"/sc/arion/projects/hpims-hpi/user/janssm02/data_extraction_w_LLM/data/processed/merged_shards/{run_id}"
+  suffix = (".json" if output_format == "json" else ".jsonl") + (".gz" if compress else "")
 
-
-  note_files = glob.glob(os.path.join(INP_DIR, "notes_shard_*.json"))
-  patient_files = glob.glob(os.path.join(INP_DIR, "patients_shard_*.json"))
+  note_files, missing_notes = find_shard_files(INP_DIR, "notes")
+  patient_files, missing_patients = find_shard_files(INP_DIR, "patients")
+  orphan_journals = find_orphan_journals(INP_DIR)
 
   print(f"Found {len(note_files)} note files and {len(patient_files)} patient files in {INP_DIR}\n")
 
-  # --- Merge Note Files ---
-  if note_files:
-    print("Starting merge for NOTE files...")
-    notes_output_path = os.path.join(OUT_DIR, "notes.json")
-    merge_json_shards(note_files, notes_output_path)
-  else:
-    print("No note files found to merge.")
-
-  print("-" * 40)
-
-  # --- Merge Patient Files ---
-  if patient_files:
-    print("Starting merge for PATIENT files...")
-    patients_output_path = os.path.join(OUT_DIR, "patients.json")
-    merge_json_shards(patient_files, patients_output_path)
-  else:
-    print("No patient files found to merge.")
-    
+  metadata_path = os.path.join(INP_DIR, "metadata.json")
+  is_queue_run = False
+  if os.path.exists(metadata_path):
+    with open(metadata_path, "r", encoding="utf-8") as f:
+      is_queue_run = json.load(f).get("queue") is not None
+  if orphan_journals and (is_queue_run or not os.path.exists(metadata_path)):
+    # the queue marked the patients of a dead worker as done, nobody else processes them again:
+    # their journal is the only place they are in
+    print(f"Recovering the patients of workers without output from their journals: {sorted(orphan_journals)}")
+    print("WARNING: Their notes are not recovered. Restart the workers with these --shard-id to export them.")
+    missing_patients = [shard_id for shard_id in missing_patients if shard_id not in orphan_journals]
+    missing_notes = [shard_id for shard_id in missing_notes if shard_id not in orphan_journals]
+  elif not allow_missing:
+    # an unfinished shard's journal only holds part of its patients
+    orphan_journals = {}
+
+  if missing_notes or missing_patients:
+    print(f"Missing note files of shards: {missing_notes}")
+    print(f"Missing patient files of shards: {missing_patients}")
+    if not allow_missing:
+      print("Not merging an incomplete run. Rerun the missing shards, or use --allow-missing.")
+      exit(1)
+
+  try:
+    # --- Merge Note Files ---
+    if note_files:
+      print("Starting merge for NOTE files...")
+      notes_output_path = os.path.join(OUT_DIR, "notes" + suffix)
+      merge_json_shards(note_files, notes_output_path, key="id", output_format=output_format)
+    else:
+      print("No note files found to merge.")
+
+    print("-" * 40)
+
+    # --- Merge Patient Files ---
+    if patient_files or orphan_journals:
+      print("Starting merge for PATIENT files...")
+      patients_output_path = os.path.join(OUT_DIR, "patients" + suffix)
+      merge_json_shards(
+        patient_files, patients_output_path, key="mrn", output_format=output_format,
+        journal_paths=list(orphan_journals.values()),
+      )
+    else:
+      print("No patient files found to merge.")
+  except json.JSONDecodeError:
+    print("Merge aborted, the merged file was not written. Rerun the shard of the corrupt file.")
+    exit(1)
+
   print("\nScript finished successfully.")
 
 
 if __name__ == "__main__":
-  parser = argparse.ArgumentParser(description="Run a shard of the extraction pipeline.")
+  parser = argparse.ArgumentParser(description="Merge the shards of an extraction run.")
   parser.add_argument("--run-id", type=str, required=True, help="The run ID for this job, used for logging and tracking.")
+  parser.add_argument("--format", type=str, choices=["json", "jsonl"], default="json", help="Output a JSON array (one record per line) or JSONL.")
+  parser.add_argument("--compress", action="store_true", help="Write the merged files gzip-compressed (.gz).")
+  parser.add_argument("--allow-missing", action="store_true", help="Merge even if shards of the run are missing.")
   args = parser.parse_args()
   args.run_id = args.run_id.strip()  # Ensure no leading/trailing whitespace
   print(f"Running merge script for run ID: {args.run_id}")
-  main(args.run_id)
\ No newline at end of file
+  main(args.run_id, args.format, args.compress, args.allow_missing)
@@ -0,0 +1,52 @@
+import argparse
+import glob
+import os
+
+from src.xllm.telemetry import read_metrics, summarize
+
+
+def main(run_id: str, per_shard: bool):
+    """
+    Summarizes the per-request LLM metrics of all shards of a run:
+    latency percentiles and aggregate throughput, to size GPU allocations from real numbers.
+    """
+    INP_DIR = f"/sc/arion/projects/hpims-hpi/user/janssm02/data_extraction_w_LLM/data/processed/shards/{run_id}"
+
+    metric_files = sorted(glob.glob(os.path.join(INP_DIR, "metrics_shard_*.jsonl")))
+    print(f"Found {len(metric_files)} metrics files in {INP_DIR}\n")
+    if not metric_files:
+        return
+
+    metrics = read_metrics(metric_files)
+    groups = {"run": metrics}
+    if per_shard:
+        for shard in sorted({metric["shard"] for metric in metrics}):
+            groups[f"shard {shard}"] = [metric for metric in metrics if metric["shard"] == shard]
+
+    for name, group in groups.items():
+        summary = summarize(group)
+        print(f"--- {name} ---")
+        print(f"  requests:    {summary['requests']} ({summary['cache_hits']} response cache hits)")
+        if "latency_p50_s" not in summary:
+            continue
+        print(
+            f"  latency:     p50 {summary['latency_p50_s']:.2f}s, p95 {summary['latency_p95_s']:.2f}s, "
+            + f"p99 {summary['latency_p99_s']:.2f}s"
+        )
+        print(
+            f"  queue wait:  p50 {summary['queue_wait_p50_s']:.2f}s, p95 {summary['queue_wait_p95_s']:.2f}s, "
+            + f"p99 {summary['queue_wait_p99_s']:.2f}s"
+        )
+        print(f"  tokens:      {summary['prompt_tokens']} prompt, {summary['completion_tokens']} completion")
+        print(
+            f"  throughput:  {summary['requests_per_s']:.2f} requests/s, {summary['prompt_tokens_per_s']:.1f} prompt tokens/s, "
+            + f"{summary['completion_tokens_per_s']:.1f} completion tokens/s over {summary['wall_s']:.0f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the LLM request metrics of a run.")
+    parser.add_argument("--run-id", type=str, required=True, help="The run ID of the extraction run.")
+    parser.add_argument("--per-shard", action="store_true", help="Also summarize every shard on its own.")
+    args = parser.parse_args()
+    main(args.run_id.strip(), args.per_shard)
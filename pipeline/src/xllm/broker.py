@@ -0,0 +1,165 @@
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NotRequired, Optional, TypedDict
+
+import requests
+
+from src.xllm.tokens import get_server_root
+
+
+class ServerEntry(TypedDict):
+    url: str
+    """ OpenAI-compatible base url, e.g. http://node1:5912/v1"""
+    pid: Optional[int]
+    """ Process id of the server on the broker's node, None for servers the broker didn't start."""
+    slots: int
+    """ Number of parallel slots of the server."""
+    attached: List[str]
+    """ Ids of the shards currently using the server."""
+    reserved: NotRequired[Dict[str, List[int]]]
+    """ Slots reserved by the shards that pin their requests to slots (the prefix layout), by shard id."""
+
+
+def backoff_delays(initial: float = 1.0, max_delay: float = 30.0, factor: float = 2.0) -> Iterator[float]:
+    """ Yields exponentially growing delays, capped at max_delay."""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, max_delay)
+
+
+def wait_until_ready(llm_endpoint: str, timeout: float, is_alive=lambda: True) -> bool:
+    """
+    Polls the /health route of a llama-server with exponential backoff until it reports ready (it returns 503
+    while the model is loading). Returns False if the server isn't ready after timeout seconds or is_alive()
+    turns False, e.g. because the server process exited.
+    """
+    url = get_server_root(llm_endpoint) + "/health"
+    deadline = time.time() + timeout
+    for delay in backoff_delays():
+        try:
+            if requests.get(url, timeout=10).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        if not is_alive() or time.time() + delay > deadline:
+            return False
+        print(".", end="", flush=True)
+        time.sleep(delay)
+    return False
+
+
+def warmup(llm_endpoint: str, model: str, timeout: float = 600.0):
+    """
+    Sends a minimal chat request, so the first real request doesn't pay for the server's lazy initialization
+    (e.g. allocating buffers and compiling kernels).
+    """
+    res = requests.post(
+        llm_endpoint.rstrip("/") + "/chat/completions",
+        json={"model": model, "messages": [{"role": "user", "content": "Hi"}], "max_tokens": 1},
+        timeout=timeout,
+    )
+    res.raise_for_status()
+
+
+def free_slots(server: ServerEntry) -> List[int]:
+    """ Ids of the server's slots that no client reserved."""
+    reserved = {slot for slots in server.get("reserved", {}).values() for slot in slots}
+    return [slot for slot in range(server["slots"]) if slot not in reserved]
+
+
+class ServerRegistry:
+    """
+    JSON file listing the warm LLM servers of a broker, shared between the broker and the shards.
+
+    The broker registers servers once they're ready and warmed up, shards attach to them for the duration
+    of their run and release them afterwards. All access goes through an exclusive lock on a sidecar file,
+    so the broker and any number of shards (also on other nodes of a shared filesystem) can update it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def _locked(self) -> Iterator[List[ServerEntry]]:
+        """ Yields the servers under an exclusive lock and writes them back afterwards."""
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                servers = self._read()
+                yield servers
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(servers, f, indent=2)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> List[ServerEntry]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def servers(self) -> List[ServerEntry]:
+        with self._locked() as servers:
+            return [ServerEntry(**server) for server in servers]
+
+    def register(self, url: str, slots: int, pid: Optional[int] = None):
+        with self._locked() as servers:
+            servers[:] = [server for server in servers if server["url"] != url]
+            servers.append(ServerEntry(url=url, pid=pid, slots=slots, attached=[]))
+
+    def unregister(self, url: str):
+        with self._locked() as servers:
+            servers[:] = [server for server in servers if server["url"] != url]
+
+    def attach(self, client_id: str, max_servers: Optional[int] = None, n_slots: Optional[int] = None) -> List[ServerEntry]:
+        """
+        Attaches the client to the least used servers (all of them if max_servers is None) and returns them.
+        Attaching again keeps the servers the client is already attached to, so it can be used to pick up
+        servers registered since.
+
+        If n_slots is given, the client reserves that many slots of each server, and only servers with enough
+        slots not reserved by other clients are used. The reserved slot ids are in the returned entries'
+        "reserved", so clients pinning requests to slots don't evict each other's prompt caches.
+        """
+        with self._locked() as servers:
+            candidates = [
+                server
+                for server in servers
+                if client_id in server["attached"] or n_slots is None or len(free_slots(server)) >= n_slots
+            ]
+            chosen = sorted(
+                candidates, key=lambda server: (client_id not in server["attached"], len(server["attached"]))
+            )[:max_servers]
+            for server in chosen:
+                if client_id not in server["attached"]:
+                    server["attached"].append(client_id)
+                    if n_slots is not None:
+                        server.setdefault("reserved", {})[client_id] = free_slots(server)[:n_slots]
+            return [ServerEntry(**server) for server in chosen]
+
+    def release(self, client_id: str):
+        with self._locked() as servers:
+            for server in servers:
+                server["attached"] = [attached for attached in server["attached"] if attached != client_id]
+                server.get("reserved", {}).pop(client_id, None)
+
+    def wait_and_attach(
+        self, client_id: str, timeout: float, max_servers: Optional[int] = None, n_slots: Optional[int] = None
+    ) -> List[ServerEntry]:
+        """
+        Attaches the client like attach(), waiting with exponential backoff for the broker to register
+        at least one server (with n_slots free slots). Returns an empty list after timeout seconds.
+        """
+        deadline = time.time() + timeout
+        for delay in backoff_delays():
+            attached = self.attach(client_id, max_servers, n_slots)
+            if len(attached) > 0 or time.time() + delay > deadline:
+                return attached
+            time.sleep(delay)
+        return []
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class ResponseCache:
+    """
+    On-disk, content-addressed cache of raw LLM responses.
+
+    Entries are keyed by a hash of everything that determines the response (rendered prompt, schema,
+    grammar, model and sampling settings) and stored as one small JSON file each, in 256 sub-directories.
+    Files are written to a temporary name and atomically renamed, so several shards can share the same
+    cache directory (also on a network filesystem) without locks: readers either see a complete entry or none.
+
+    The cache is bounded by max_bytes. Hits bump the file's mtime, and eviction removes the least recently
+    used files until the cache is below 90% of max_bytes again. The directory is only scanned at startup and
+    when evicting, in between the size is kept as a running total of the writes. Entries written by other
+    shards are picked up by the next scan, so a shared cache can exceed max_bytes by what the others wrote since.
+    put() may be called from worker threads (e.g. via asyncio.to_thread), the running total is updated under a lock.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._scan())
+
+    @staticmethod
+    def make_key(
+        prompt: str, clean_schema: Dict, model: str, sampling: Dict[str, Any], grammar: Optional[str] = None
+    ) -> str:
+        """
+        grammar identifies the GBNF grammar the response was constrained with (e.g. GrammarCache.key()),
+        None for the JSON schema response format. It is left out of the key then, so existing entries stay valid.
+        """
+        fields = {"prompt": prompt, "schema": clean_schema, "model": model, "sampling": sampling}
+        if grammar is not None:
+            fields["grammar"] = grammar
+        payload = json.dumps(fields, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached response content for key, or None if there is no (readable) entry.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = json.load(f)["content"]
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return content
+
+    def put(self, key: str, content: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"content": content, "created": time.time()}, f)
+        size = os.path.getsize(tmp_path)
+        try:
+            size -= os.path.getsize(path)  # replaces an existing entry
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size += size
+            full = self._size > self.max_bytes
+        if full:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is below 90% of max_bytes.
+        Scans the directory, so the size afterwards also accounts for the entries written by other shards.
+        """
+        with self._lock:
+            entries = sorted(self._scan(), key=lambda entry: entry[2])
+            size = sum(entry_size for _, entry_size, _ in entries)
+            target = int(self.max_bytes * 0.9)
+            for path, entry_size, _ in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # already evicted by another shard
+                size -= entry_size
+            self._size = size
+
+    def _scan(self) -> List[Tuple[str, int, float]]:
+        """
+        Lists all entries as (path, size, mtime).
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
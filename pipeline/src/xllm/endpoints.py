@@ -0,0 +1,147 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import openai
+import requests
+from openai import AsyncOpenAI
+
+from src.xllm.tokens import get_server_root
+
+MODEL = "google/gemma-3-27b-it"
+""" Model name sent with the requests. llama.cpp ignores it (it serves the model it was started with), but it is required."""
+
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+""" Errors caused by the endpoint rather than the request. The request is retried on another endpoint."""
+
+
+@dataclass
+class Endpoint:
+    base_url: str
+    """ OpenAI-compatible base url, e.g. http://localhost:5912/v1"""
+    client: AsyncOpenAI
+    outstanding: int = 0
+    """ Number of requests currently in flight on this endpoint."""
+    failures: int = 0
+    """ Consecutive failed requests."""
+    down_until: float = 0.0
+    """ Time until which the endpoint is out of rotation."""
+    slot_ids: Optional[List[int]] = None
+    """ Server slots that pinned requests use (e.g. the ones reserved in a broker registry), None for all of them."""
+    retired: bool = False
+    """ Whether the endpoint left the pool (e.g. its server was unregistered). Only used if no other one is left."""
+
+    def is_up(self, now: float) -> bool:
+        return now >= self.down_until and not self.retired
+
+    def id_slot(self, slot: int) -> int:
+        """ The server's id of the endpoint's slot-th slot."""
+        return self.slot_ids[slot] if self.slot_ids is not None else slot
+
+
+class EndpointPool:
+    """
+    Client-side pool of OpenAI-compatible LLM endpoints (e.g. several llama-servers).
+
+    Each request is routed to the endpoint with the fewest outstanding requests. An endpoint that fails
+    max_failures requests in a row (or its health check) is taken out of rotation for cooldown seconds,
+    after which it gets another chance.
+    """
+
+    def __init__(
+        self,
+        base_urls: List[str],
+        slots: int = 1,
+        max_failures: int = 3,
+        cooldown: float = 60.0,
+        slot_ids: Optional[List[Optional[List[int]]]] = None,
+    ):
+        if len(base_urls) == 0:
+            raise ValueError("The endpoint pool needs at least one endpoint.")
+        self.endpoints: List[Endpoint] = []
+        for i, url in enumerate(base_urls):
+            self.add(url, slot_ids[i] if slot_ids is not None else None)
+        self.slots = slots
+        """ Number of parallel slots of each endpoint."""
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def add(self, base_url: str, slot_ids: Optional[List[int]] = None) -> bool:
+        """
+        Adds an endpoint to the pool (e.g. a server registered after the run started), or puts a retired one
+        back into rotation. Endpoints keep their index, so patients pinned to a slot stay on their endpoint.
+        Returns whether the endpoint is new.
+        """
+        for endpoint in self.endpoints:
+            if endpoint.base_url == base_url:
+                endpoint.slot_ids = slot_ids
+                endpoint.retired = False
+                return False
+        # api key required, but unused
+        client = AsyncOpenAI(base_url=base_url, api_key="ollama")
+        self.endpoints.append(Endpoint(base_url=base_url, client=client, slot_ids=slot_ids))
+        return True
+
+    def retire(self, base_url: str):
+        """ Takes the endpoint out of rotation until it is added again."""
+        for endpoint in self.endpoints:
+            if endpoint.base_url == base_url and not endpoint.retired:
+                print(f"Warning: Endpoint {base_url} left the pool, taking it out of rotation.")
+                endpoint.retired = True
+
+    async def check_health(self, timeout: float = 5.0) -> int:
+        """
+        Probes the /health route of all endpoints, takes failing ones out of rotation,
+        and returns the number of healthy endpoints.
+        """
+
+        def probe(endpoint: Endpoint) -> bool:
+            try:
+                res = requests.get(get_server_root(endpoint.base_url) + "/health", timeout=timeout)
+                return res.status_code == 200
+            except Exception:
+                return False
+
+        results = await asyncio.gather(*[asyncio.to_thread(probe, endpoint) for endpoint in self.endpoints])
+        now = time.time()
+        for endpoint, healthy in zip(self.endpoints, results):
+            if healthy:
+                endpoint.failures = 0
+                endpoint.down_until = 0.0
+            else:
+                print(f"Warning: Endpoint {endpoint.base_url} is not healthy, taking it out of rotation.")
+                endpoint.down_until = now + self.cooldown
+        return sum(results)
+
+    def acquire(self, preferred: Optional[int] = None, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        """
+        Returns the endpoint for the next request and counts the request as outstanding on it.
+        The preferred endpoint (by index) is used if it is in rotation. Endpoints in exclude
+        (e.g. the ones a request already failed on) are only used if there is no other one. Must be paired with release().
+        """
+        now = time.time()
+        if preferred is not None and self.endpoints[preferred].is_up(now) and self.endpoints[preferred] not in exclude:
+            endpoint = self.endpoints[preferred]
+        else:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.is_up(now) and endpoint not in exclude]
+            if len(candidates) == 0:
+                # no endpoint is left, try the one that comes back first rather than failing right away
+                candidates = [min(self.endpoints, key=lambda endpoint: (endpoint.retired, endpoint.down_until))]
+            endpoint = min(candidates, key=lambda endpoint: endpoint.outstanding)
+        endpoint.outstanding += 1
+        return endpoint
+
+    def release(self, endpoint: Endpoint, failed: bool = False):
+        endpoint.outstanding -= 1
+        if not failed:
+            endpoint.failures = 0
+            return
+
+        endpoint.failures += 1
+        if endpoint.failures >= self.max_failures and endpoint.is_up(time.time()):
+            print(f"Warning: Endpoint {endpoint.base_url} failed {endpoint.failures} times, taking it out of rotation.")
+            endpoint.down_until = time.time() + self.cooldown
@@ -16,7 +16,7 @@ from sklearn.metrics import (
     cohen_kappa_score
 )
 from sklearn.preprocessing import MultiLabelBinarizer
-from src.xllm.utils import normalize_date
+from src.xllm.utils import normalize_date, normalize_dates
 
 def get_var_type(var_id):
     var_type = variables.LM_VARIABLES[var_id].type
@@ -140,9 +140,9 @@ def eval_multilabel(
 
 def norm_date(y_true: Sequence[str | None], y_pred: Sequence[str | None]) -> Tuple[List[str], List[str]]:
     """ Normalize date strings to ISO format, treating None as missing."""
-    y_true = [normalize_date(x) or "" for x in y_true]
-    y_pred = [normalize_date(x) or "" for x in y_pred]
-    # normalize_date returns empty string for None, so we can keep it as is
+    y_true = normalize_dates(y_true, default="")
+    y_pred = normalize_dates(y_pred, default="")
+    # normalize_dates returns empty string for None, so we can keep it as is
     return y_true, y_pred
 
 
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import uuid
+from typing import Any, Dict, List, Optional
+
+PRIMITIVE_RULES = {
+    # no newlines or indentation, the output is compact JSON
+    "space": '" "?',
+    "boolean": '("true" | "false") space',
+    "null": '"null" space',
+    "integral-part": "[0] | [1-9] [0-9]{0,15}",
+    "integer": '("-"? integral-part) space',
+    "decimal-part": "[0-9]{1,16}",
+    "number": '("-"? integral-part) ("." decimal-part)? ([eE] [-+]? integral-part)? space',
+    "char": '[^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})',
+    "string": '"\\"" char* "\\"" space',
+}
+""" GBNF rules of the JSON primitives, as in llama.cpp's json_schema_to_grammar."""
+
+PRIMITIVE_DEPENDENCIES = {
+    "boolean": ["space"],
+    "null": ["space"],
+    "integer": ["integral-part", "space"],
+    "number": ["integral-part", "decimal-part", "space"],
+    "string": ["char", "space"],
+}
+
+INVALID_RULE_CHARS = re.compile(r"[^a-zA-Z0-9-]+")
+
+
+def gbnf_literal(text: str) -> str:
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+class SchemaConverter:
+    """
+    Converts the JSON schemas of the pipeline's variable classes into GBNF grammars for llama-server.
+
+    Supports the subset of JSON schema pydantic produces for them (after strip_titles_and_refs): objects with
+    properties, arrays, anyOf, enum/const and the primitive types. All properties of an object are generated,
+    in the order of the schema, since the variables are nullable anyway. Identical sub-schemas (e.g. the fact
+    object shared by many variables) share one rule.
+    If max_string_length is set, every string is limited to that many characters: citations as well as string
+    values (e.g. dates or free text), so it must leave room for the longest expected value.
+    """
+
+    def __init__(self, max_string_length: Optional[int] = None):
+        self.max_string_length = max_string_length
+        self.rules: Dict[str, str] = {}
+        self._names_by_body: Dict[str, str] = {}
+
+    def convert(self, schema: Dict[str, Any]) -> str:
+        self.rules = {}
+        self._names_by_body = {}
+        root_body = self._body(schema, "root")
+        rules = {"root": root_body, **self.rules}
+        return "\n".join(f"{name} ::= {body}" for name, body in rules.items()) + "\n"
+
+    def _primitive(self, name: str) -> str:
+        for dependency in PRIMITIVE_DEPENDENCIES.get(name, []):
+            self.rules.setdefault(dependency, PRIMITIVE_RULES[dependency])
+        self.rules.setdefault(name, PRIMITIVE_RULES[name])
+        return name
+
+    def _rule(self, schema: Dict[str, Any], name: str) -> str:
+        """ Returns the name of a rule for the schema, reusing the rule of an identical schema."""
+        body = self._body(schema, name)
+        if body in self._names_by_body:
+            return self._names_by_body[body]
+        if body in PRIMITIVE_RULES.keys():
+            return body
+
+        rule_name = INVALID_RULE_CHARS.sub("-", name)
+        i = 1
+        while rule_name in self.rules or rule_name in PRIMITIVE_RULES:
+            rule_name = f"{INVALID_RULE_CHARS.sub('-', name)}-{i}"
+            i += 1
+        self.rules[rule_name] = body
+        self._names_by_body[body] = rule_name
+        return rule_name
+
+    def _body(self, schema: Dict[str, Any], name: str) -> str:
+        if "anyOf" in schema or "oneOf" in schema:
+            alternatives: List[Dict[str, Any]] = schema.get("anyOf", schema.get("oneOf"))
+            return " | ".join(self._rule(alternative, f"{name}-{i}") for i, alternative in enumerate(alternatives))
+
+        if "const" in schema:
+            return f"{gbnf_literal(json.dumps(schema['const']))} space"
+
+        if "enum" in schema:
+            self._primitive("space")
+            return "(" + " | ".join(gbnf_literal(json.dumps(value)) for value in schema["enum"]) + ") space"
+
+        schema_type = schema.get("type")
+        if isinstance(schema_type, list):
+            return " | ".join(self._rule({**schema, "type": t}, f"{name}-{t}") for t in schema_type)
+
+        if schema_type == "object" or "properties" in schema:
+            self._primitive("space")
+            properties: Dict[str, Any] = schema.get("properties", {})
+            if schema.get("additionalProperties") not in (None, False) or ("properties" not in schema):
+                raise ValueError(f"Free-form objects are not supported in grammars ({name}).")
+            members = [
+                f'{gbnf_literal(json.dumps(key))} space ":" space {self._rule(value, f"{name}-{key}")}'
+                for key, value in properties.items()
+            ]
+            return '"{" space ' + ' "," space '.join(members) + (" " if members else "") + '"}" space'
+
+        if schema_type == "array":
+            self._primitive("space")
+            item = self._rule(schema.get("items", {}), f"{name}-item") if schema.get("items") else None
+            if item is None:
+                raise ValueError(f"Arrays without items schema are not supported in grammars ({name}).")
+            return f'"[" space ({item} ("," space {item})*)? "]" space'
+
+        if schema_type == "string":
+            if self.max_string_length is None:
+                return self._primitive("string")
+            self._primitive("char")
+            self._primitive("space")
+            return f'"\\"" char{{0,{self.max_string_length}}} "\\"" space'
+
+        if schema_type in ("integer", "number", "boolean", "null"):
+            return self._primitive(schema_type)
+
+        raise ValueError(f"Unsupported schema in grammar ({name}): {json.dumps(schema)[:200]}")
+
+
+class GrammarCache:
+    """
+    Compiles each distinct schema into a GBNF grammar once. Grammars are kept in memory and, if cache_dir
+    is given, on disk keyed by the hash of the schema, so other shards and later runs don't compile them again.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_string_length: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_string_length = max_string_length
+        self._grammars: Dict[str, str] = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, clean_schema: Dict[str, Any]) -> str:
+        payload = json.dumps({"schema": clean_schema, "max_string_length": self.max_string_length}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, clean_schema: Dict[str, Any]) -> str:
+        key = self.key(clean_schema)
+        if key in self._grammars:
+            return self._grammars[key]
+
+        path = os.path.join(self.cache_dir, key + ".gbnf") if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                grammar = f.read()
+        else:
+            grammar = SchemaConverter(self.max_string_length).convert(clean_schema)
+            if path is not None:
+                tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(grammar)
+                os.replace(tmp_path, path)
+
+        self._grammars[key] = grammar
+        return grammar
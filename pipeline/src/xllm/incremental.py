@@ -0,0 +1,119 @@
+import glob
+import hashlib
+import json
+import os
+from typing import Collection, Dict, Iterable, List, Optional
+
+from pydantic import TypeAdapter
+
+from src.xllm.journal import JournalRecord, JournalRun, PatientJournal
+from src.xllm.utils import Chunk, strip_titles_and_refs
+from src.xllm.variables import LMVariable, create_medical_record_class
+
+
+def chunk_hash(chunk: Chunk) -> str:
+    """ Hash of the chunk's text, which identifies a chunk across runs (the text includes the note ids)."""
+    return hashlib.sha256(chunk["text"].encode("utf-8")).hexdigest()
+
+
+def variable_fingerprints(lm_variables: Dict[str, LMVariable]) -> Dict[str, str]:
+    """
+    Hash of each variable's definition as the LLM sees it: its clean sub-schema (type and description) and prompt.
+    Journaled with every patient, so a later incremental run can tell which variables changed since.
+    """
+    fingerprints: Dict[str, str] = {}
+    for var_id, var in lm_variables.items():
+        schema = strip_titles_and_refs(TypeAdapter(create_medical_record_class({var_id: var})).json_schema())
+        payload = json.dumps({"schema": schema["properties"][var_id], "prompt": var.prompt}, sort_keys=True)
+        fingerprints[var_id] = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return fingerprints
+
+
+def changed_variables(previous: JournalRecord, fingerprints: Dict[str, str]) -> List[str]:
+    """
+    The variables whose fingerprint differs from the one journaled with the patient in the previous run.
+    Variables without a journaled fingerprint (new ones, or all in journals of older runs) don't count as changed.
+    """
+    stored = previous.get("fingerprints", {})
+    return [var_id for var_id, fingerprint in fingerprints.items() if stored.get(var_id, fingerprint) != fingerprint]
+
+
+class PreviousRun:
+    """
+    The journaled runs of an earlier run, as the manifest of what was extracted from which chunks.
+    Only the records of the given mrns are loaded, from the journals of all of its shards (or workers),
+    so the sharding of the earlier run doesn't matter.
+    """
+
+    def __init__(self, output_dir: str, mrns: Iterable[int]):
+        self.output_dir = output_dir
+        wanted = {int(mrn) for mrn in mrns}
+        self._records: Dict[int, JournalRecord] = {}
+        journal_paths = sorted(glob.glob(os.path.join(output_dir, "journal_shard_*.jsonl")))
+        for path in journal_paths:
+            for record in PatientJournal(path).iter_records():
+                if record["mrn"] in wanted:
+                    self._records[record["mrn"]] = record
+        self.n_journals = len(journal_paths)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def pop(self, mrn: int) -> Optional[JournalRecord]:
+        """ Returns the record of the patient and drops it, since every patient is only processed once."""
+        return self._records.pop(mrn, None)
+
+
+def match_runs(chunks: List[Chunk], previous_runs: List[JournalRun], stage: int) -> Dict[int, JournalRun]:
+    """
+    Maps the index of every chunk that is unchanged since the previous run to its stored run of the given stage.
+    A chunk is unchanged if its hash matches, or for runs journaled without hash, if it has the same notes.
+    """
+    by_hash: Dict[str, JournalRun] = {}
+    by_note_ids: Dict[tuple, JournalRun] = {}
+    for run in previous_runs:
+        if run["stage"] != stage:
+            continue
+        if "hash" in run:
+            by_hash.setdefault(run["hash"], run)
+        else:
+            by_note_ids.setdefault(tuple(run["note_ids"]), run)
+
+    matches: Dict[int, JournalRun] = {}
+    for i, chunk in enumerate(chunks):
+        run = by_hash.get(chunk_hash(chunk)) or by_note_ids.get(tuple(chunk["source_note_ids"]))
+        if run is not None:
+            matches[i] = run
+    return matches
+
+
+def missing_variables(
+    run: Optional[JournalRun], var_ids: Iterable[str], changed_var_ids: Collection[str] = ()
+) -> List[str]:
+    """
+    The variables of var_ids that still have to be extracted from a chunk with the given stored run (None if
+    the chunk changed): the ones the run didn't extract (e.g. new or newly activated variables), and the changed ones.
+    """
+    if run is None:
+        return list(var_ids)
+    return [var_id for var_id in var_ids if var_id not in run["result"] or var_id in changed_var_ids]
+
+
+def is_unchanged(
+    chunks: List[Chunk],
+    previous: JournalRecord,
+    stage_1_matches: Dict[int, JournalRun],
+    var_ids: Collection[str],
+    changed_var_ids: Collection[str] = (),
+) -> bool:
+    """
+    Whether the patient's chunks are exactly those of the previous run, in the same order, and the variables
+    (var_ids, all of LM_VARIABLES) are the same as well. Then the Stage I results, and with them the activation and
+    the Stage II runs, are the same, and the stored patient can be reused.
+    """
+    if len(changed_var_ids) > 0 or sorted(finding["varId"] for finding in previous["patient"]["findings"]) != sorted(var_ids):
+        return False
+    previous_stage_1 = [run for run in previous["runs"] if run["stage"] == 1]
+    return len(previous_stage_1) == len(chunks) and all(
+        i in stage_1_matches and stage_1_matches[i]["chunk"] == i for i in range(len(chunks))
+    )
@@ -0,0 +1,99 @@
+import json
+import os
+from typing import Any, Dict, Iterator, List, NotRequired, TypedDict
+
+
+class JournalRun(TypedDict):
+    stage: int
+    chunk: int
+    """ Index of the chunk within the patient's chunks."""
+    note_ids: List[int]
+    result: Dict[str, Any]
+    """ The parsed LLM response, dumped to JSON-compatible values."""
+    hash: NotRequired[str]
+    """ Hash of the chunk (see incremental.chunk_hash), missing in journals of older runs."""
+
+
+class JournalRecord(TypedDict):
+    mrn: int
+    runs: List[JournalRun]
+    patient: Dict[str, Any]
+    """ The finalized patient (findings and meta data), as exported to the patients shard file."""
+    fingerprints: NotRequired[Dict[str, str]]
+    """
+    Fingerprints of the variable definitions the runs were extracted with (see incremental.variable_fingerprints),
+    missing in journals of older runs.
+    """
+
+
+class PatientJournal:
+    """
+    Append-only JSONL journal of the patients a shard has completed.
+
+    Every completed patient is appended as one line and flushed to disk right away, so a shard that
+    is killed or preempted loses at most the patients that were in progress. A restarted shard reads
+    the journaled MRNs and only processes the patients that are not in it yet.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def iter_records(self) -> Iterator[JournalRecord]:
+        """
+        Yields the journaled records one at a time, in the order they were appended.
+        A truncated last line (from a crash while writing) is skipped.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record: JournalRecord = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Warning: Skipping unreadable line {line_no} of journal {self.path}")
+                    continue
+                yield record
+
+    def offsets(self) -> Dict[int, int]:
+        """
+        Returns the byte offsets of the journaled records by MRN (the first one if a patient is journaled twice),
+        so single records can be read back with read() without keeping them all in memory.
+        """
+        offsets: Dict[int, int] = {}
+        if not os.path.exists(self.path):
+            return offsets
+
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line_no, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        offsets.setdefault(json.loads(line)["mrn"], offset)
+                    except json.JSONDecodeError:
+                        print(f"Warning: Skipping unreadable line {line_no} of journal {self.path}")
+                offset += len(line)
+        return offsets
+
+    def read(self, offset: int) -> JournalRecord:
+        """ Reads the record at a byte offset returned by offsets()."""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def append(self, record: JournalRecord):
+        line = json.dumps(record) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            # a previous crash can leave a partial line behind, start on a fresh one
+            if f.tell() > 0 and not self._ends_with_newline():
+                f.write("\n")
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
@@ -0,0 +1,44 @@
+from typing import Dict, NamedTuple, Optional
+
+import pandas as pd
+
+from src.xllm.variables import PartialDate, parse_date_keys
+
+
+class NoteRef(NamedTuple):
+    date: Optional[PartialDate]
+    """ The parsed NOTE_DATE, None if it can't be parsed."""
+
+
+class NoteIndex:
+    """
+    Maps NOTE_ID to the note's parsed date, built once from the notes DataFrame.
+    Replaces scanning the DataFrame for every extracted value when resolving evidence dates.
+    If a NOTE_ID occurs more than once, the first note wins, like .iloc[0] on the matching rows.
+    """
+
+    def __init__(self, notes: pd.DataFrame):
+        self._notes: Dict[int, NoteRef] = {}
+        # the dates are parsed into sort keys all at once (or read from a notes store that has them parsed already),
+        # and note dates repeat a lot: one PartialDate per key
+        if "NOTE_DATE_KEY" in notes.columns:
+            date_keys = notes["NOTE_DATE_KEY"].tolist()
+        else:
+            date_keys = parse_date_keys(notes["NOTE_DATE"]).tolist()
+        dates: Dict[int, Optional[PartialDate]] = {}
+
+        note_ids = notes["NOTE_ID"].to_numpy()
+        for position in range(len(notes)):
+            note_id = int(note_ids[position])
+            if note_id in self._notes:
+                continue
+            key = date_keys[position]
+            if key not in dates:
+                dates[key] = PartialDate.from_key(key)
+            self._notes[note_id] = NoteRef(dates[key])
+
+    def __len__(self) -> int:
+        return len(self._notes)
+
+    def get(self, note_id: int) -> Optional[NoteRef]:
+        return self._notes.get(note_id)
@@ -0,0 +1,89 @@
+import gzip
+import json
+from typing import Any, IO, Iterator
+
+import numpy as np
+
+READ_SIZE = 1 << 20
+""" Characters read at a time when streaming a JSON array."""
+
+
+def open_text(path: str) -> IO[str]:
+    """ Opens a (gzip-compressed, if the path ends in .gz) text file for reading."""
+    return gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, "r", encoding="utf-8")
+
+
+def iter_json_records(path: str) -> Iterator[Any]:
+    """
+    Yields the records of a JSON array file or a JSONL file (both optionally gzip-compressed) one at a time,
+    without loading the whole file. The format is detected from the first character.
+    """
+    decoder = json.JSONDecoder()
+    with open_text(path) as f:
+        buffer = f.read(READ_SIZE).lstrip()
+        if not buffer.startswith("["):
+            # JSONL: one record per line
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        pos = 1
+        eof = False
+        while True:
+            # skip whitespace and the comma between records
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos >= len(buffer):
+                    raise json.JSONDecodeError("Buffer exhausted", buffer, pos)
+                record, end = decoder.raw_decode(buffer, pos)
+                if end == len(buffer) and not eof:
+                    # a number at the end of the buffer may continue in the next read
+                    raise json.JSONDecodeError("Record may continue", buffer, end)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # the record continues beyond the buffer, drop what was consumed and read more
+                more = f.read(READ_SIZE)
+                eof = len(more) == 0
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield record
+            pos = end
+
+
+class IdSet:
+    """
+    Set of integer ids that needs about 8 bytes per id, for deduplicating records by id in constant memory per id.
+    New ids are collected in a small set, which is merged into a sorted array once it holds buffer_size ids.
+    """
+
+    def __init__(self, buffer_size: int = 1_000_000):
+        self.buffer_size = buffer_size
+        self._sorted = np.empty(0, dtype=np.int64)
+        self._recent = set()
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def __contains__(self, id: int) -> bool:
+        if id in self._recent:
+            return True
+        i = np.searchsorted(self._sorted, id)
+        return bool(i < len(self._sorted) and self._sorted[i] == id)
+
+    def add(self, id: int) -> bool:
+        """ Adds the id, returns False if it was already in the set."""
+        if id in self:
+            return False
+        self._recent.add(id)
+        if len(self._recent) >= self.buffer_size:
+            recent = np.fromiter(self._recent, dtype=np.int64, count=len(self._recent))
+            self._sorted = np.sort(np.concatenate([self._sorted, recent]))
+            self._recent = set()
+        return True
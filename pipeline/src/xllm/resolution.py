@@ -0,0 +1,113 @@
+from enum import Enum
+from typing import Any, Dict, Iterable, List, Optional, TypedDict, Union
+
+from pydantic import BaseModel
+
+from src.xllm import variables
+from src.xllm.notes import NoteIndex
+
+
+class Evidence(TypedDict):
+    source_note_id: int
+    citation: str
+    value: Union[str, int, float, bool, None]
+    confidence: float
+
+class Finding(TypedDict):
+    varId: str
+    redcap_name: Optional[str]
+    value: Union[str, int, float, bool, None]
+    evidence: List[Evidence]
+    confidence: float
+
+
+def get_value(obj):
+    if obj is None:
+        return None
+    elif isinstance(obj, Enum):
+        return obj.value
+    elif hasattr(obj, "value"):
+        if isinstance(obj.value, Enum):
+            return obj.value.value
+        else:
+            return obj.value
+    elif isinstance(obj, list):
+        return [get_value(item) for item in obj]
+    elif isinstance(obj, BaseModel):
+        return obj.model_dump()
+    else:
+        return obj
+
+
+class PatientResolution:
+    """
+    Resolves the variables of one patient from its runs.
+
+    The runs are inverted once into the extracted facts of each variable (in the order of the runs), and every
+    variable is resolved at most once: the values resolved for the Stage II activation are reused for the export.
+    Adding runs later (e.g. the Stage II runs) only invalidates the variables they contain.
+    """
+
+    def __init__(self, note_index: NoteIndex, runs: Iterable[BaseModel] = ()):
+        self.note_index = note_index
+        self._facts: Dict[str, List[variables.MedicalFact]] = {}
+        self._resolved: Dict[str, Any] = {}
+        self.add_runs(runs)
+
+    def add_runs(self, runs: Iterable[BaseModel]):
+        for run in runs:
+            for var_id, fact in run.__dict__.items():
+                if fact is None:
+                    continue
+                self._facts.setdefault(var_id, []).append(fact)
+                self._resolved.pop(var_id, None)
+
+    def facts(self, var_id: str) -> List[variables.MedicalFact]:
+        """ The values extracted for the variable in all runs, in the order of the runs."""
+        return self._facts.get(var_id, [])
+
+    def resolve(self, var_id: str, var: variables.LMVariable) -> Any:
+        """
+        Resolves the variable from its extracted values with the variable's resolver.
+        Variables without any extracted value (or without resolver) resolve to None.
+        """
+        if var_id in self._resolved:
+            return self._resolved[var_id]
+
+        resolved = None
+        facts = self.facts(var_id)
+        if len(facts) > 0 and var.resolver is not None:
+            chunk_values: List[variables.ChunkValue] = []
+            for fact in facts:
+                note = self.note_index.get(fact.note_id)
+                if note is None:
+                    print("Warning: No matching note found for NOTE_ID", fact.note_id)
+                    continue
+                chunk_values.append(variables.ChunkValue(date=note.date, value=fact.value))
+            resolved = var.resolver(chunk_values)
+
+        self._resolved[var_id] = resolved
+        return resolved
+
+    def resolve_all(self, vars_to_resolve: Dict[str, variables.LMVariable]) -> Dict[str, Any]:
+        return {var_id: self.resolve(var_id, var) for var_id, var in vars_to_resolve.items()}
+
+    def evidence(self, var_id: str) -> List[Evidence]:
+        return [
+            {
+                "source_note_id": fact.note_id,
+                "citation": fact.citation,
+                "value": get_value(fact.value),
+                "confidence": 1.0,
+            }
+            for fact in self.facts(var_id)
+        ]
+
+    def finding(self, var_id: str, var: variables.LMVariable) -> Finding:
+        return {
+            "varId": var_id,
+            "redcap_name": var.redcap_id,
+            "value": get_value(self.resolve(var_id, var)),
+            "evidence": self.evidence(var_id),
+            "confidence": 1.0,
+        }
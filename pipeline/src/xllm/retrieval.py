@@ -0,0 +1,122 @@
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from src.xllm.utils import Chunk
+from src.xllm.variables import LMVariable
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token estimate (~4 characters per token) for reporting, when no tokenizer is at hand."""
+    return len(text) // CHARS_PER_TOKEN
+
+
+class ChunkIndex:
+    """
+    BM25 index over the chunks of one patient, used to rank chunks by how much they talk about a topic.
+
+    Query terms are matched as lowercase prefixes of the words in the chunk, so "cholangit" matches
+    both "cholangitis" and "cholangitic".
+    """
+
+    def __init__(self, chunks: List[Chunk], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(TOKEN_PATTERN.findall(chunk["text"].lower())) for chunk in chunks]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    def _term_frequencies(self, term: str) -> List[int]:
+        return [
+            sum(count for word, count in counts.items() if word.startswith(term))
+            for counts in self.term_counts
+        ]
+
+    def score(self, terms: List[str]) -> List[float]:
+        """
+        Returns the BM25 score of every chunk for the given query terms. 0 means no term occurs in the chunk.
+        """
+        n_chunks = len(self.term_counts)
+        scores = [0.0] * n_chunks
+        for term in {term.lower() for term in terms}:
+            frequencies = self._term_frequencies(term)
+            doc_freq = sum(1 for tf in frequencies if tf > 0)
+            if doc_freq == 0:
+                continue
+            idf = math.log((n_chunks - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+            for i, tf in enumerate(frequencies):
+                if tf == 0:
+                    continue
+                norm = 1 - self.b + self.b * self.lengths[i] / self.avg_length if self.avg_length > 0 else 1
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return scores
+
+
+def select_by_recall(scores: List[float], min_recall: float) -> List[int]:
+    """
+    Returns the indices of the highest scoring chunks whose summed score covers at least min_recall
+    of the total score. Chunks with a score of 0 are never selected.
+    """
+    total = sum(scores)
+    ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: (-scores[i], i))
+    selected = []
+    covered = 0.0
+    for i in ranked:
+        if covered >= min_recall * total:
+            break
+        selected.append(i)
+        covered += scores[i]
+    return selected
+
+
+@dataclass
+class PrefilterStats:
+    chunks_total: int = 0
+    chunks_skipped: int = 0
+    tokens_total: int = 0
+    tokens_skipped: int = 0
+
+
+def prefilter_chunks(
+    chunks: List[Chunk],
+    active_vars: Dict[str, LMVariable],
+    min_recall: float,
+    stats: Optional[PrefilterStats] = None,
+) -> List[int]:
+    """
+    Returns the indices (in order) of the chunks worth sending to the LLM for the active Stage II variables.
+
+    For each active variable, its query_terms rank the chunks, and the top chunks covering min_recall of the
+    variable's score are kept. A chunk is sent if it is kept for any variable. To stay recall-safe, all chunks
+    are kept if any active variable has no query terms, or if none of its terms occur in any chunk.
+    The tokens in stats are estimated, since they are only reported (the tokenizer may be a server round trip).
+    """
+    all_indices = list(range(len(chunks)))
+    selected = set()
+
+    if any(not var.query_terms for var in active_vars.values()):
+        selected.update(all_indices)
+    else:
+        index = ChunkIndex(chunks)
+        for var in active_vars.values():
+            var_selected = select_by_recall(index.score(var.query_terms or []), min_recall)
+            if len(var_selected) == 0:
+                selected.update(all_indices)
+                break
+            selected.update(var_selected)
+
+    kept = sorted(selected)
+
+    if stats is not None:
+        tokens = [estimate_tokens(chunk["text"]) for chunk in chunks]
+        stats.chunks_total += len(chunks)
+        stats.chunks_skipped += len(chunks) - len(kept)
+        stats.tokens_total += sum(tokens)
+        stats.tokens_skipped += sum(tokens) - sum(tokens[i] for i in kept)
+
+    return kept
@@ -0,0 +1,89 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import Any, List, Tuple
+
+
+class PrioritySemaphore:
+    """
+    An asyncio semaphore that hands free slots to the waiter with the lowest priority value first,
+    instead of in arrival order. Waiters with equal priority are served in arrival order.
+
+    Used to schedule chunk requests: by prioritizing on the patient's position in the shard,
+    a patient's Stage II requests overtake the Stage I requests of patients queued after it.
+    """
+
+    def __init__(self, value: int):
+        if value < 1:
+            raise ValueError(f"Semaphore value ({value}) must be at least 1.")
+        self._value = value
+        self._waiters: List[Tuple[Any, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: Any):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # the slot may have been handed to us right before the cancellation, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+    def grow(self, n: int):
+        """ Adds n slots, e.g. for the slots of a server that joined, and hands them to waiters first."""
+        for _ in range(n):
+            self.release()
+
+    @asynccontextmanager
+    async def slot(self, priority: Any):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class SlotPool:
+    """
+    Pins patients to the parallel slots of a llama-server, so all requests of a patient hit the same slot
+    and can reuse the prompt (KV) cache of that slot's previous request.
+
+    Every slot admits one request at a time, in priority order. A patient is assigned to the slot with the
+    least work assigned so far (weighted by the patient's number of chunks), ties go to the lowest slot id.
+    """
+
+    def __init__(self, n_slots: int):
+        self.semaphores = [PrioritySemaphore(1) for _ in range(n_slots)]
+        self._assigned = [0] * n_slots
+
+    def __len__(self):
+        return len(self.semaphores)
+
+    def grow(self, n: int):
+        """
+        Adds n slots, e.g. the slots of a server that joined. They start level with the least loaded slot,
+        so they share the coming patients instead of taking all of them until they caught up.
+        """
+        level = min(self._assigned, default=0)
+        self.semaphores.extend(PrioritySemaphore(1) for _ in range(n))
+        self._assigned.extend([level] * n)
+
+    def assign(self, weight: int) -> int:
+        slot = min(range(len(self._assigned)), key=lambda s: (self._assigned[s], s))
+        self._assigned[slot] += weight
+        return slot
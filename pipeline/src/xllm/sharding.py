@@ -0,0 +1,61 @@
+import heapq
+from typing import Dict, List, TypedDict
+
+import pandas as pd
+
+from src.xllm.retrieval import CHARS_PER_TOKEN
+from src.xllm.utils import NOTE_TAG_CHARS, get_chunk_bounds, get_mrn_bounds
+
+
+class ShardPlan(TypedDict):
+    mrns: List[int]
+    cost: int
+    """ Predicted cost of the shard, in estimated prompt tokens."""
+
+
+def estimate_patient_costs(note_lengths: pd.DataFrame, chunk_max_chars: int, request_overhead: int) -> Dict[int, int]:
+    """
+    Predicts the cost of each patient as the estimated prompt tokens of its Stage I requests: every chunk is
+    one request that carries the chunk's notes plus request_overhead tokens (instructions, patient meta and schema).
+    Stage II repeats (a subset of) the same requests, so it scales roughly with the same cost.
+
+    Only needs the note lengths (see get_notes(text_lengths_only=True)), sorted by MRN. The notes are packed into
+    chunks of chunk_max_chars characters like chunk_notes does.
+    """
+    sizes = (
+        note_lengths["NOTE_LENGTH"].fillna(0).astype(int) + note_lengths["NOTE_ID"].astype(str).str.len() + NOTE_TAG_CHARS
+    ).tolist()
+    mrns = note_lengths["MRN"].to_numpy()
+
+    costs: Dict[int, int] = {}
+    for start, end in get_mrn_bounds(mrns):
+        chunk_starts = get_chunk_bounds(sizes[start:end], chunk_max_chars)
+        costs[int(mrns[start])] = sum(
+            request_overhead + sum(sizes[start + lo : start + hi]) // CHARS_PER_TOKEN
+            for lo, hi in zip(chunk_starts[:-1], chunk_starts[1:])
+        )
+    return costs
+
+
+def partition_by_cost(mrns: List[int], costs: Dict[int, int], n_shards: int) -> List[ShardPlan]:
+    """
+    Assigns patients to shards so that the predicted cost per shard is balanced, using greedy LPT
+    (longest processing time first): patients are taken from the most to the least expensive, and each
+    goes to the shard with the lowest cost so far. Patients without a cost (e.g. without notes) count as 0.
+
+    The plan only depends on the MRNs and their costs (ties are broken by MRN and shard index), so every
+    shard computes the same plan independently. The MRNs of each shard are sorted.
+    """
+    shards: List[ShardPlan] = [{"mrns": [], "cost": 0} for _ in range(n_shards)]
+    loads = [(0, shard_idx) for shard_idx in range(n_shards)]
+    heapq.heapify(loads)
+
+    for mrn in sorted(mrns, key=lambda mrn: (-costs.get(mrn, 0), mrn)):
+        load, shard_idx = heapq.heappop(loads)
+        shards[shard_idx]["mrns"].append(int(mrn))
+        shards[shard_idx]["cost"] += costs.get(mrn, 0)
+        heapq.heappush(loads, (load + costs.get(mrn, 0), shard_idx))
+
+    for shard in shards:
+        shard["mrns"].sort()
+    return shards
@@ -0,0 +1,92 @@
+import json
+from typing import Dict, Iterable, List, Optional, TypedDict
+
+import numpy as np
+
+
+class RequestMetric(TypedDict):
+    shard: int
+    mrn: int
+    stage: int
+    chunk: int
+    """ Index of the chunk within the patient's chunks."""
+    endpoint: Optional[str]
+    """ Endpoint that answered the request, None for response cache hits."""
+    cache_hit: bool
+    """ Whether the response came from the on-disk response cache instead of the LLM."""
+    start: float
+    """ Unix time the request was sent (after the queue wait)."""
+    queue_wait_s: float
+    """ Seconds the request waited for a free slot before it was sent."""
+    latency_s: float
+    """ Wall time of the request, including retries on other endpoints."""
+    prompt_tokens: int
+    completion_tokens: int
+    tokens_per_s: float
+    """ Completion tokens per second of wall latency."""
+
+
+class MetricsWriter:
+    """
+    Streams one JSON line per LLM request to a metrics file next to the shard output.
+    Lines are flushed right away, so the metrics of a killed shard are kept too.
+    """
+
+    def __init__(self, path: str, shard: int):
+        self.path = path
+        self.shard = shard
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record(self, metric: RequestMetric):
+        self._file.write(json.dumps(metric) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_metrics(paths: Iterable[str]) -> List[RequestMetric]:
+    metrics: List[RequestMetric] = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    metrics.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # truncated last line of a killed shard
+    return metrics
+
+
+def summarize(metrics: List[RequestMetric]) -> Dict[str, float]:
+    """
+    Summarizes the LLM requests of a run: latency and queue wait percentiles over the requests
+    that went to the LLM, and the aggregate throughput over the wall time of the run.
+    Response cache hits only count towards the number of requests.
+    """
+    llm_metrics = [metric for metric in metrics if not metric["cache_hit"]]
+    summary: Dict[str, float] = {
+        "requests": len(metrics),
+        "cache_hits": len(metrics) - len(llm_metrics),
+    }
+    if len(llm_metrics) == 0:
+        return summary
+
+    latencies = np.array([metric["latency_s"] for metric in llm_metrics])
+    queue_waits = np.array([metric["queue_wait_s"] for metric in llm_metrics])
+    prompt_tokens = sum(metric["prompt_tokens"] for metric in llm_metrics)
+    completion_tokens = sum(metric["completion_tokens"] for metric in llm_metrics)
+    wall_s = max(metric["start"] + metric["latency_s"] for metric in llm_metrics) - min(
+        metric["start"] for metric in llm_metrics
+    )
+
+    for p in [50, 95, 99]:
+        summary[f"latency_p{p}_s"] = float(np.percentile(latencies, p))
+    for p in [50, 95, 99]:
+        summary[f"queue_wait_p{p}_s"] = float(np.percentile(queue_waits, p))
+    summary["prompt_tokens"] = prompt_tokens
+    summary["completion_tokens"] = completion_tokens
+    summary["wall_s"] = wall_s
+    summary["requests_per_s"] = len(llm_metrics) / wall_s if wall_s > 0 else 0.0
+    summary["prompt_tokens_per_s"] = prompt_tokens / wall_s if wall_s > 0 else 0.0
+    summary["completion_tokens_per_s"] = completion_tokens / wall_s if wall_s > 0 else 0.0
+    return summary
@@ -1,8 +1,38 @@
 # test_date_parser.py
 
 
+import argparse
+import asyncio
+import dataclasses
+import gzip
+import json
+import os
+import re
+import tempfile
+from types import SimpleNamespace
 import unittest
-from src.xllm.utils import normalize_date
+from unittest import mock
+import pandas as pd
+from src.xllm.utils import normalize_date, normalize_dates, chunk_notes, iter_chunk_notes, get_notes
+from src.xllm.variables import ChunkValue, PartialDate, parse_date_keys, UNKNOWN_DATE_KEY
+from src.xllm import variables
+from src.xllm.grammar import SchemaConverter
+from src.xllm import records
+from src.xllm.records import IdSet, iter_json_records
+from src.xllm.incremental import (
+    changed_variables,
+    chunk_hash,
+    is_unchanged,
+    match_runs,
+    missing_variables,
+    variable_fingerprints,
+)
+from src.xllm.workqueue import WorkQueue
+from src.xllm.cache import ResponseCache
+from src.xllm.endpoints import EndpointPool
+from src.xllm.sharding import partition_by_cost
+from merge import merge_json_shards
+import extraction
 
 class TestParseDate(unittest.TestCase):
     """
@@ -52,6 +82,603 @@ class TestParseDate(unittest.TestCase):
         # The 'if not date_str:' check correctly handles None input.
         self.assertIsNone(normalize_date(None), "Should return None for None input") # type: ignore
 
+    def test_vectorized(self):
+        """Tests that normalize_dates agrees with normalize_date and maps missing values to the default."""
+        dates = ['2020', '5/1/2022', '2023-02-30', '2020', None, float('nan')]
+        self.assertEqual(normalize_dates(dates, default=''), ['2020-01-01', '2022-05-01', '', '2020-01-01', '', ''])
+        self.assertEqual(normalize_dates(pd.Series(['2021-05'])), ['2021-05-01'])
+
+
+class TestChunkNotes(unittest.TestCase):
+    """
+    Test suite for the chunk_notes function.
+    """
+
+    def setUp(self):
+        self.notes = pd.DataFrame({
+            "NOTE_ID": [1, 2, 3, 4],
+            "MRN": [10, 10, 10, 20],
+            "NOTE_TEXT": ["a " * 10, "b " * 10, "c " * 10, "d"],
+            "NOTE_DATE": ["2020-01-01", "2020-02-01", "2020-03-01", "2020-01-01"],
+        })
+
+    def test_chunks_by_characters(self):
+        """Notes of one MRN are packed into chunks of at most chunk_max_chars characters."""
+        chunks = chunk_notes(self.notes, 60)
+        self.assertEqual([c["MRN"] for c in chunks], [10, 20])
+        self.assertEqual([c["source_note_ids"] for c in chunks[0]["chunks"]], [[1], [2], [3]])
+        self.assertEqual(chunks[1]["chunks"][0]["text"], '<note id="4">d</note>')
+
+        chunks = chunk_notes(self.notes, 100)
+        self.assertEqual([c["source_note_ids"] for c in chunks[0]["chunks"]], [[1, 2], [3]])
+
+    def test_chunks_by_tokens(self):
+        """With a token budget, chunk sizes are measured with the given token counter."""
+        count_words = lambda text: len(text.split())
+        chunks = chunk_notes(self.notes, 60, chunk_max_tokens=40, count_tokens=count_words)
+        self.assertEqual([c["source_note_ids"] for c in chunks[0]["chunks"]], [[1, 2, 3]])
+
+        chunks = chunk_notes(self.notes, 60, chunk_max_tokens=20, count_tokens=count_words)
+        self.assertEqual([c["source_note_ids"] for c in chunks[0]["chunks"]], [[1], [2], [3]])
+
+    def test_iter_chunks_per_mrn(self):
+        """The generator yields one entry per MRN; a note larger than a chunk gets a chunk of its own."""
+        notes = self.notes.iloc[::-1]  # unsorted input
+        chunks = iter_chunk_notes(notes, 10)
+        first = next(chunks)
+        self.assertEqual(first["MRN"], 10)
+        self.assertEqual(sorted(c["source_note_ids"][0] for c in first["chunks"]), [1, 2, 3])
+        self.assertEqual([c["MRN"] for c in chunks], [20])
+        self.assertEqual(list(iter_chunk_notes(self.notes.iloc[:0], 10)), [])
+
+    def test_iter_chunks_measures_per_mrn(self):
+        """Only the notes of the yielded MRN are measured before it is yielded."""
+        measured = []
+        count_tokens = lambda text: measured.append(text) or len(text.split())
+        chunks = iter_chunk_notes(self.notes, 60, chunk_max_tokens=40, count_tokens=count_tokens)
+        self.assertEqual(next(chunks)["MRN"], 10)
+        self.assertEqual(len(measured), 3)
+        self.assertEqual(next(chunks)["MRN"], 20)
+        self.assertEqual(len(measured), 4)
+
+
+class TestGetNotes(unittest.TestCase):
+    """
+    Test suite for reading the notes CSV in blocks.
+    """
+
+    def test_duplicates_across_blocks(self):
+        """A text seen in an earlier block is dropped, also if it belongs to an mrn that isn't requested."""
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "notes.csv")
+            pd.DataFrame({
+                "NOTE_ID": [1, 2, 3, 4, 5, 6],
+                "MRN": [20, 10, 10, 20, 10, 20],
+                "NOTE_TEXT": ["copied", "a", "b", "a", "copied", "c"],
+                "NOTE_DATE": ["2020-01-01", "2020-01-02", "2020-01-03", "2020-01-04", "2020-01-05", "2020-01-06"],
+            }).to_csv(path, index=False)
+
+            for chunksize in (2, 100):
+                self.assertEqual(get_notes(path, [10], chunksize=chunksize)["NOTE_ID"].tolist(), [2, 3])
+                self.assertEqual(get_notes(path, chunksize=chunksize)["NOTE_ID"].tolist(), [2, 3, 1, 6])
+
+
+class TestPartialDate(unittest.TestCase):
+    """
+    Test suite for the PartialDate ordering and the vectorized date parser.
+    """
+
+    def test_total_ordering(self):
+        """Partial dates sort before more precise dates of the same year or month; equal dates are equal."""
+        self.assertLess(PartialDate(2020), PartialDate(2020, 1))
+        self.assertLess(PartialDate(2020, 1), PartialDate(2020, 1, 1))
+        self.assertLess(PartialDate(2019, 12, 31), PartialDate(2020))
+        self.assertLessEqual(PartialDate(2020, 5), PartialDate(2020, 5))
+        self.assertGreaterEqual(PartialDate(2020, 5), PartialDate(2020, 5))
+        self.assertEqual(PartialDate.from_key(PartialDate(2020, 5).key), PartialDate(2020, 5))
+
+    def test_parse_date_keys(self):
+        """The vectorized parser agrees with PartialDate.parse, unparseable dates get UNKNOWN_DATE_KEY."""
+        dates = ["2020", "2020-01", "2020-01-05", "1899", "2020-13", "2020/01/01", "", None]
+        expected = [PartialDate.parse(d).key if d and PartialDate.parse(d) else UNKNOWN_DATE_KEY for d in dates]
+        self.assertEqual(parse_date_keys(pd.Series(dates, dtype=object)).tolist(), expected)
+
+    def test_resolvers_by_date(self):
+        """Values without a date don't win against dated values."""
+        chunks = [
+            ChunkValue(date=None, value="none"),
+            ChunkValue(date=PartialDate(2021), value="2021"),
+            ChunkValue(date=PartialDate(2020, 3), value="2020-03"),
+        ]
+        self.assertEqual(ChunkValue.get_most_recent(chunks), "2021")
+        self.assertEqual(ChunkValue.get_least_recent(chunks), "2020-03")
+        self.assertEqual(ChunkValue.get_least_recent(chunks[:1]), "none")
+
+
+class TestSchemaConverter(unittest.TestCase):
+    """
+    Test suite for the JSON schema to GBNF grammar converter.
+    """
+
+    FACT = {
+        "anyOf": [
+            {"type": "object", "properties": {"citation": {"type": "string"}, "note_id": {"type": "integer"}}},
+            {"type": "null"},
+        ]
+    }
+
+    @staticmethod
+    def rules(grammar):
+        return dict(line.split(" ::= ", 1) for line in grammar.splitlines())
+
+    def test_pipeline_schemas(self):
+        """The Stage I schema and the largest Stage II schema (all activatable variables) convert."""
+        stage_1 = {k: v for k, v in variables.LM_VARIABLES.items() if v.is_active is None}
+        stage_2 = {k: v for k, v in variables.LM_VARIABLES.items() if v.is_active is not None}
+        for stage_vars in (stage_1, stage_2):
+            schema = variables.get_record_schema(stage_vars).clean_schema
+            rules = self.rules(SchemaConverter().convert(schema))
+            self.assertIn("root", rules)
+            for var_id in stage_vars:
+                self.assertIn(f'"\\"{var_id}\\""', rules["root"])
+
+    def test_identical_schemas_share_a_rule(self):
+        """Identical sub-schemas are emitted once and referenced by every property using them."""
+        schema = {"type": "object", "properties": {"a": self.FACT, "b": self.FACT}}
+        rules = self.rules(SchemaConverter().convert(schema))
+        self.assertIn('"\\"a\\"" space ":" space root-a ', rules["root"])
+        self.assertIn('"\\"b\\"" space ":" space root-a ', rules["root"])
+        self.assertNotIn("root-b", rules)
+        self.assertEqual(len(rules.values()), len(set(rules.values())))
+
+    def test_max_string_length(self):
+        """Strings are bounded with char{0,N}, unbounded strings use the string primitive."""
+        schema = {"type": "object", "properties": {"a": {"type": "string"}}}
+        self.assertIn('"\\"" char{0,50} "\\"" space', SchemaConverter(50).convert(schema))
+        bounded_rules = self.rules(SchemaConverter(50).convert(schema))
+        self.assertNotIn("string", bounded_rules)
+        self.assertIn("string", self.rules(SchemaConverter().convert(schema)))
+
+    def test_unsupported_schemas(self):
+        """Free-form objects and arrays without items schema raise a ValueError."""
+        for schema in (
+            {"type": "object"},
+            {"type": "object", "properties": {}, "additionalProperties": True},
+            {"type": "object", "properties": {"a": {"type": "array"}}},
+        ):
+            with self.assertRaises(ValueError):
+                SchemaConverter().convert(schema)
+
+
+class TestJsonRecords(unittest.TestCase):
+    """
+    Test suite for streaming the records of shard files and deduplicating them by id.
+    """
+
+    RECORDS = [{"id": 1, "text": "a, [b] {c}"}, {"id": 22, "nested": {"list": [1, 2, 3]}}, 333, "four", None]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        # a tiny read size, so records span several reads
+        patcher = mock.patch.object(records, "READ_SIZE", 7)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with (gzip.open(path, "wt", encoding="utf-8") if name.endswith(".gz") else open(path, "w", encoding="utf-8")) as f:
+            f.write(content)
+        return path
+
+    def test_json_array(self):
+        """JSON arrays are read record by record, compact, indented and empty."""
+        for i, content in enumerate([json.dumps(self.RECORDS), json.dumps(self.RECORDS, indent=2), "[\n]\n", "  []"]):
+            expected = self.RECORDS if i < 2 else []
+            self.assertEqual(list(iter_json_records(self.write(f"{i}.json", content))), expected)
+
+    def test_jsonl(self):
+        """JSONL files are read line by line, blank lines are skipped."""
+        content = "\n".join(json.dumps(record) for record in self.RECORDS) + "\n\n"
+        self.assertEqual(list(iter_json_records(self.write("records.jsonl", content))), self.RECORDS)
+
+    def test_gzip(self):
+        """Both formats are read from gzip-compressed files."""
+        array = self.write("records.json.gz", json.dumps(self.RECORDS))
+        lines = self.write("records.jsonl.gz", "\n".join(json.dumps(record) for record in self.RECORDS))
+        self.assertEqual(list(iter_json_records(array)), self.RECORDS)
+        self.assertEqual(list(iter_json_records(lines)), self.RECORDS)
+
+    def test_truncated_array(self):
+        """A truncated JSON array raises a JSONDecodeError once the file is exhausted."""
+        path = self.write("truncated.json", json.dumps(self.RECORDS)[:-10])
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_records(path))
+
+    def test_merge_mixed_shards(self):
+        """Shards of both formats are merged into one file, records with an id that was merged already are dropped."""
+        shards = [
+            self.write("shard_0.json", json.dumps([{"mrn": 1, "v": "a"}, {"mrn": 2, "v": "b"}])),
+            self.write("shard_1.jsonl.gz", json.dumps({"mrn": 2, "v": "dup"}) + "\n" + json.dumps({"mrn": 3, "v": "c"})),
+        ]
+        for output_format in ("json", "jsonl"):
+            output_path = os.path.join(self.dir.name, "merged", f"patients.{output_format}")
+            merge_json_shards(shards, output_path, key="mrn", output_format=output_format)
+            self.assertEqual(
+                list(iter_json_records(output_path)), [{"mrn": 1, "v": "a"}, {"mrn": 2, "v": "b"}, {"mrn": 3, "v": "c"}]
+            )
+
+    def test_merge_corrupt_shard(self):
+        """A shard that can't be decoded aborts the merge without writing the output."""
+        shards = [
+            self.write("shard_0.jsonl", json.dumps({"mrn": 1}) + "\n"),
+            self.write("shard_1.json", json.dumps([{"mrn": 2}, {"mrn": 3}])[:-5]),
+        ]
+        output_path = os.path.join(self.dir.name, "merged", "patients.json")
+        with self.assertRaises(json.JSONDecodeError):
+            merge_json_shards(shards, output_path, key="mrn")
+        self.assertEqual(os.listdir(os.path.dirname(output_path)), [])
+
+    def test_id_set(self):
+        """Ids are deduplicated across the recent set and the sorted array they are merged into."""
+        ids = IdSet(buffer_size=3)
+        added = [ids.add(id) for id in [5, 1, 9, 1, 7, 5, 3, 9, 11, 7]]
+        self.assertEqual(added, [True, True, True, False, True, False, True, False, True, False])
+        self.assertEqual(len(ids), 6)
+        for id in [1, 3, 5, 7, 9, 11]:
+            self.assertIn(id, ids)
+        self.assertNotIn(4, ids)
+        self.assertNotIn(12, ids)
+
+
+class FakeCompletions:
+    """
+    Stands in for the LLM: extracts appendectomy, colorectal cancer and its diagnosis date by keyword,
+    from the first note of the chunk, and records the fields and prompt of every request.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def parse(self, model, messages, response_format, **kwargs):
+        prompt = messages[0]["content"]
+        self.calls.append((sorted(response_format.model_fields), prompt))
+        note_id, text = re.search(r'<note id="(\d+)">(.*?)</note>', prompt, re.DOTALL).groups()
+        fact = lambda value: {"citation": "c", "value": value, "note_id": int(note_id)}
+        values = {}
+        for field in response_format.model_fields:
+            if field == "appendectomy":
+                values[field] = fact("appendectomy" in text)
+            elif field == "pers_cancer_hx" and "colorectal" in text:
+                values[field] = fact(["colorectal"])
+            elif field == "date_dx_crc" and "diagnosed" in text:
+                values[field] = fact("2012-03")
+        parsed = response_format.model_validate(values)
+        message = SimpleNamespace(parsed=parsed, content=parsed.model_dump_json())
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=20)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage, model_extra={})
+
+
+class TestIncremental(unittest.TestCase):
+    """
+    Test suite for reusing the journaled runs of a previous run.
+    """
+
+    # every note is longer than half a chunk (18000 characters), so every note is a chunk of its own
+    FILLER = " x" * 5000
+    NOTES = [
+        (1, 10, "colorectal cancer, diagnosed 2012", "2012-03-01"),
+        (2, 10, "appendectomy", "2013-05-01"),
+        (3, 20, "appendectomy in 2014", "2014-01-01"),
+        (4, 20, "no findings", "2015-01-01"),
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        meta = [
+            dict(MRN=mrn, LAST_NAME="L", FIRST_NAME="F", DATE_OF_BIRTH="1970-01-01", GENDER="F") for mrn in (10, 20)
+        ]
+        pd.DataFrame(meta).to_csv(os.path.join(self.dir.name, "meta.csv"), index=False)
+        self.completions = FakeCompletions()
+        client = SimpleNamespace(
+            beta=SimpleNamespace(chat=SimpleNamespace(completions=self.completions)),
+            chat=SimpleNamespace(completions=self.completions),
+        )
+
+        async def check_health(pool, timeout=5.0):
+            return len(pool)
+
+        for patcher in [
+            mock.patch("src.xllm.endpoints.AsyncOpenAI", lambda **kwargs: client),
+            mock.patch("src.xllm.endpoints.EndpointPool.check_health", check_health),
+            mock.patch.object(extraction, "PATIENTS_META_FILE", os.path.join(self.dir.name, "meta.csv")),
+            mock.patch.object(extraction, "get_output_dir", lambda run_id: os.path.join(self.dir.name, run_id, "")),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_extraction(self, run_id, notes, previous_run_id=None):
+        """ Runs the extraction on the notes, returns the number of requests and the exported patients by MRN."""
+        notes_path = os.path.join(self.dir.name, f"notes_{run_id}.csv")
+        rows = [dict(NOTE_ID=i, MRN=mrn, NOTE_TEXT=text + self.FILLER, NOTE_DATE=date) for i, mrn, text, date in notes]
+        pd.DataFrame(rows).to_csv(notes_path, index=False)
+        args = argparse.Namespace(
+            total_shards=1, shard_id=0, run_id=run_id, concurrency=2, partition="contiguous", queue=None,
+            lease_seconds=600, grammar=False, grammar_max_string=None, cache_dir=None, cache_max_gb=1.0,
+            prompt_layout="default", token_budget=False, tokenizer=None, context_size=None, max_output_tokens=2048,
+            prefilter=False, prefilter_recall=0.95, compress_output=False, previous_run_id=previous_run_id,
+            changed_variables=None,
+        )
+        n_calls = len(self.completions.calls)
+        with mock.patch.object(extraction, "NOTES_FILE", notes_path):
+            asyncio.run(extraction.main(args, ["http://llm/v1"]))
+        patients_path = os.path.join(self.dir.name, run_id, "patients_shard_0_of_1.jsonl")
+        patients = {patient["mrn"]: patient for patient in iter_json_records(patients_path)}
+        return len(self.completions.calls) - n_calls, patients
+
+    @staticmethod
+    def chunk(note_ids, text="text"):
+        return {"text": text, "source_note_ids": note_ids}
+
+    def test_match_runs(self):
+        """Chunks match a stored run of the stage by hash, or by note ids for runs journaled without hash."""
+        chunks = [self.chunk([1], "a"), self.chunk([2], "b"), self.chunk([3], "c")]
+        runs = [
+            {"stage": 1, "chunk": 0, "note_ids": [1], "result": {}, "hash": chunk_hash(chunks[0])},
+            {"stage": 1, "chunk": 1, "note_ids": [2], "result": {}, "hash": chunk_hash(self.chunk([2], "changed"))},
+            {"stage": 1, "chunk": 2, "note_ids": [3], "result": {}},
+            {"stage": 2, "chunk": 0, "note_ids": [1], "result": {}, "hash": chunk_hash(chunks[0])},
+        ]
+        self.assertEqual(match_runs(chunks, runs, 1), {0: runs[0], 2: runs[2]})
+        self.assertEqual(match_runs(chunks, runs, 2), {0: runs[3]})
+
+    def test_missing_variables(self):
+        """Changed chunks need all variables, unchanged ones the variables not extracted yet and the changed ones."""
+        run = {"stage": 1, "chunk": 0, "note_ids": [1], "result": {"a": None, "b": None}}
+        self.assertEqual(missing_variables(None, ["a", "b"]), ["a", "b"])
+        self.assertEqual(missing_variables(run, ["a", "b", "c"]), ["c"])
+        self.assertEqual(missing_variables(run, ["a", "b", "c"], ["b"]), ["b", "c"])
+
+    def test_is_unchanged(self):
+        """A patient is unchanged if all its chunks match, in order, and the variables are the same."""
+        chunks = [self.chunk([1], "a"), self.chunk([2], "b")]
+        runs = [
+            {"stage": 1, "chunk": i, "note_ids": chunk["source_note_ids"], "result": {}, "hash": chunk_hash(chunk)}
+            for i, chunk in enumerate(chunks)
+        ]
+        previous = {"mrn": 1, "runs": runs, "patient": {"findings": [{"varId": "a"}, {"varId": "b"}]}}
+        self.assertTrue(is_unchanged(chunks, previous, match_runs(chunks, runs, 1), ["b", "a"]))
+        self.assertFalse(is_unchanged(chunks, previous, match_runs(chunks, runs, 1), ["a", "b"], ["a"]))
+        self.assertFalse(is_unchanged(chunks, previous, match_runs(chunks, runs, 1), ["a", "b", "c"]))
+        swapped = chunks[::-1]
+        self.assertFalse(is_unchanged(swapped, previous, match_runs(swapped, runs, 1), ["a", "b"]))
+        appended = chunks + [self.chunk([3], "c")]
+        self.assertFalse(is_unchanged(appended, previous, match_runs(appended, runs, 1), ["a", "b"]))
+
+    def test_changed_variables(self):
+        """Variables are changed if their schema or prompt differ from the journaled fingerprint."""
+        appendectomy = variables.LM_VARIABLES["appendectomy"]
+        previous = {"mrn": 1, "runs": [], "patient": {}}
+        previous["fingerprints"] = variable_fingerprints({"appendectomy": appendectomy, "psc_hx": appendectomy})
+        fingerprints = variable_fingerprints({
+            "appendectomy": appendectomy,
+            "psc_hx": dataclasses.replace(appendectomy, prompt="Has the patient had PSC?"),
+            "new": appendectomy,
+        })
+        self.assertEqual(changed_variables(previous, fingerprints), ["psc_hx"])
+        self.assertEqual(changed_variables({"mrn": 1, "runs": [], "patient": {}}, fingerprints), [])
+        changed_type = variable_fingerprints({"appendectomy": dataclasses.replace(appendectomy, type=str)})
+        self.assertEqual(changed_variables(previous, changed_type), ["appendectomy"])
+
+    def test_identical_notes(self):
+        """Rerunning on the same notes reuses every patient without any request."""
+        _, full = self.run_extraction("full", self.NOTES)
+        n_calls, patients = self.run_extraction("rerun", self.NOTES, previous_run_id="full")
+        self.assertEqual(n_calls, 0)
+        self.assertEqual(patients, full)
+
+    def test_appended_note(self):
+        """Only the chunk of a new note is queried, and the result matches a full run on the new notes."""
+        notes = self.NOTES + [(5, 10, "follow-up visit", "2016-01-01")]
+        self.run_extraction("previous", self.NOTES)
+        _, full = self.run_extraction("full", notes)
+        n_calls, patients = self.run_extraction("incremental", notes, previous_run_id="previous")
+        self.assertGreater(n_calls, 0)
+        for _, text in self.completions.calls[-n_calls:]:
+            self.assertEqual(re.findall(r'<note id="(\d+)">', text), ["5"])
+        self.assertEqual(patients, full)
+
+    def test_added_variable(self):
+        """A variable the previous run didn't have is queried on its own, and the result matches a full run."""
+        with mock.patch.dict(variables.LM_VARIABLES):
+            del variables.LM_VARIABLES["appendectomy"]
+            self.run_extraction("previous", self.NOTES)
+        _, full = self.run_extraction("full", self.NOTES)
+        n_calls, patients = self.run_extraction("incremental", self.NOTES, previous_run_id="previous")
+        self.assertEqual(n_calls, len(self.NOTES))
+        self.assertTrue(all(fields == ["appendectomy"] for fields, _ in self.completions.calls[-n_calls:]))
+        self.assertEqual(patients, full)
+
+    def test_changed_prompt(self):
+        """A variable whose prompt changed is detected and queried again on its own."""
+        self.run_extraction("previous", self.NOTES)
+        appendectomy = dataclasses.replace(variables.LM_VARIABLES["appendectomy"], prompt="Was the appendix removed?")
+        # the record schemas are built once per set of variables, not per definition
+        with (
+            mock.patch.dict(variables.LM_VARIABLES, {"appendectomy": appendectomy}),
+            mock.patch.dict(variables._RECORD_SCHEMAS, clear=True),
+        ):
+            n_calls, _ = self.run_extraction("incremental", self.NOTES, previous_run_id="previous")
+        self.assertEqual(n_calls, len(self.NOTES))
+        for fields, prompt in self.completions.calls[-n_calls:]:
+            self.assertEqual(fields, ["appendectomy"])
+            self.assertIn("Was the appendix removed?", prompt)
+
+
+class TestWorkQueue(unittest.TestCase):
+    """
+    Test suite for the lease protocol of the SQLite work queue, with a controlled clock.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.now = 1000.0
+        patcher = mock.patch("src.xllm.workqueue.time", SimpleNamespace(time=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = WorkQueue(os.path.join(self.dir.name, "queue.db"), lease_seconds=60, max_attempts=2)
+        self.queue.populate([1, 2, 3], {1: 10, 2: 30, 3: 20})
+
+    def test_claim_and_complete(self):
+        """Patients are claimed most expensive first, once, until all are done."""
+        self.assertEqual(self.queue.claim("a"), [2])
+        self.assertEqual(self.queue.claim("b", n=5), [3, 1])
+        self.assertEqual(self.queue.claim("c"), [])
+        self.queue.complete("a", [2])
+        self.queue.complete("b", [3, 1])
+        self.assertEqual(self.queue.counts(), {"pending": 0, "leased": 0, "done": 3, "failed": 0})
+        self.queue.populate([1, 2, 3, 4])
+        self.assertEqual(self.queue.claim("c", n=5), [4])
+
+    def test_expired_lease_is_reclaimed(self):
+        """A lease that isn't renewed expires, and another worker claims the patient."""
+        self.assertEqual(self.queue.claim("a"), [2])
+        self.now += 59
+        self.assertEqual(self.queue.claim("b"), [3])
+        self.now += 2
+        self.assertEqual(self.queue.claim("b"), [2])
+
+    def test_heartbeat_extends_lease(self):
+        """Heartbeats renew the worker's own leases only."""
+        self.assertEqual(self.queue.claim("a", n=2), [2, 3])
+        self.now += 50
+        self.queue.heartbeat("a", [2])
+        self.queue.heartbeat("b", [3])
+        self.now += 20
+        self.assertEqual(self.queue.claim("b", n=5), [3, 1])
+
+    def test_release(self):
+        """Released patients are pending again, and their claim doesn't count as a failed attempt."""
+        self.assertEqual(self.queue.claim("a", n=2), [2, 3])
+        self.queue.release("a")
+        self.assertEqual(self.queue.counts()["pending"], 3)
+        for _ in range(2):
+            self.assertEqual(self.queue.claim("b"), [2])
+            self.queue.release("b")
+        self.assertEqual(self.queue.claim("b"), [2])
+
+    def test_complete_after_expiry(self):
+        """A worker whose lease expired can still complete the patient, the new lease holder's complete is a no-op."""
+        self.assertEqual(self.queue.claim("a"), [2])
+        self.now += 61
+        self.assertEqual(self.queue.claim("b"), [2])
+        self.queue.complete("a", [2])
+        self.assertEqual(self.queue.counts()["done"], 1)
+        self.queue.heartbeat("b", [2])
+        self.queue.complete("b", [2])
+        self.assertEqual(self.queue.counts(), {"pending": 2, "leased": 0, "done": 1, "failed": 0})
+
+    def test_max_attempts(self):
+        """A patient that fails, or whose lease expires, max_attempts times is marked failed and not claimed again."""
+        self.assertEqual(self.queue.claim("a"), [2])
+        self.assertEqual(self.queue.fail("a", [2]), [])
+        self.assertEqual(self.queue.claim("b"), [2])
+        self.now += 61
+        self.assertEqual(self.queue.claim("c"), [3])
+        self.assertEqual(self.queue.counts(), {"pending": 1, "leased": 1, "done": 0, "failed": 1})
+        self.assertEqual(self.queue.claim("c", n=5), [1])
+
+
+class TestEndpointPool(unittest.TestCase):
+    """
+    Test suite for routing requests across the endpoints of the pool, with a controlled clock.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("src.xllm.endpoints.time", SimpleNamespace(time=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = EndpointPool(["http://a/v1", "http://b/v1", "http://c/v1"], max_failures=2, cooldown=60)
+        self.a, self.b, self.c = self.pool.endpoints
+
+    def test_least_outstanding(self):
+        """Requests go to the endpoint with the fewest outstanding requests, or the preferred one."""
+        self.assertEqual([self.pool.acquire() for _ in range(4)], [self.a, self.b, self.c, self.a])
+        self.pool.release(self.b)
+        self.assertIs(self.pool.acquire(), self.b)
+        self.assertIs(self.pool.acquire(preferred=2), self.c)
+        self.assertIs(self.pool.acquire(exclude=[self.a, self.b]), self.c)
+
+    def test_failover(self):
+        """An endpoint that fails max_failures requests in a row is out of rotation until its cooldown ends."""
+        for _ in range(2):
+            self.pool.release(self.pool.acquire(preferred=0), failed=True)
+        self.assertEqual([self.pool.acquire(preferred=0) for _ in range(2)], [self.b, self.c])
+        self.now += 61
+        self.assertIs(self.pool.acquire(preferred=0), self.a)
+
+        for endpoint, down in zip(self.pool.endpoints, [30, 10, 20]):
+            endpoint.down_until = self.now + down
+        # all endpoints are down, the one that comes back first is used
+        self.assertIs(self.pool.acquire(), self.b)
+
+
+class TestResponseCache(unittest.TestCase):
+    """
+    Test suite for the size bound of the on-disk response cache.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_evicts_least_recently_used(self):
+        """Writes beyond max_bytes evict the least recently used entries until the cache is below 90% of it."""
+        cache = ResponseCache(self.dir.name, max_bytes=10**9)
+        keys = [ResponseCache.make_key(f"prompt {i}", {}, "model", {}) for i in range(6)]
+        for i, key in enumerate(keys[:4]):
+            cache.put(key, "x" * 1000)
+            os.utime(cache._path(key), (i, i))
+        self.assertEqual(cache.get(keys[0]), "x" * 1000)  # now the most recently used one
+
+        entry_size = os.path.getsize(cache._path(keys[0]))
+        cache.max_bytes = int(entry_size * 5.5)
+        with mock.patch.object(cache, "_scan", wraps=cache._scan) as scan:
+            cache.put(keys[4], "x" * 1000)
+            self.assertEqual(scan.call_count, 0)
+            cache.put(keys[5], "x" * 1000)
+            self.assertEqual(scan.call_count, 1)
+
+        self.assertEqual([cache.get(key) is not None for key in keys], [True, False, False, True, True, True])
+        self.assertEqual(cache._size, sum(size for _, size, _ in cache._scan()))
+        self.assertLessEqual(cache._size, cache.max_bytes * 0.9)
+
+
+class TestPartitionByCost(unittest.TestCase):
+    """
+    Test suite for the cost-balanced shard plan.
+    """
+
+    def test_deterministic_and_balanced(self):
+        """The plan doesn't depend on the order of the MRNs, and no shard costs more than needed."""
+        costs = {mrn: cost for mrn, cost in zip(range(1, 11), [50, 10, 40, 10, 30, 20, 20, 5, 5, 10])}
+        costs[11] = 0  # ties by cost are broken by MRN
+        mrns = list(costs) + [12]  # without a cost
+        plan = partition_by_cost(mrns, costs, 3)
+        self.assertEqual(partition_by_cost(mrns[::-1], costs, 3), plan)
+        self.assertEqual(
+            plan,
+            [
+                {"mrns": [1, 2, 10], "cost": 70},
+                {"mrns": [3, 7, 8, 11, 12], "cost": 65},
+                {"mrns": [4, 5, 6, 9], "cost": 65},
+            ],
+        )
+        self.assertEqual(sorted(mrn for shard in plan for mrn in shard["mrns"]), list(range(1, 13)))
+
 
 # This allows the test to be run from the command line
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+import os
+from functools import lru_cache
+from typing import Callable, Optional
+
+import requests
+
+
+def get_server_root(llm_endpoint: str) -> str:
+    """
+    Returns the root url of a llama-server from its OpenAI-compatible endpoint, e.g. http://host:5912/v1 -> http://host:5912
+    """
+    root = llm_endpoint.rstrip("/")
+    return root[: -len("/v1")] if root.endswith("/v1") else root
+
+
+class ServerTokenizer:
+    """
+    Counts tokens with the /tokenize endpoint of a llama-server, i.e. with the tokenizer of the model it serves.
+    Every text is one HTTP request (over a kept-alive connection), so counting many notes is slow and should
+    not run on the event loop; a LocalTokenizer avoids the round trips.
+    """
+
+    def __init__(self, llm_endpoint: str, timeout: float = 30.0):
+        self.url = get_server_root(llm_endpoint) + "/tokenize"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.count_tokens = lru_cache(maxsize=256)(self._count_tokens)
+
+    def _count_tokens(self, text: str) -> int:
+        res = self.session.post(self.url, json={"content": text, "add_special": False}, timeout=self.timeout)
+        res.raise_for_status()
+        return len(res.json()["tokens"])
+
+
+class LocalTokenizer:
+    """
+    Counts tokens with a local Hugging Face tokenizer, given as path to a tokenizer.json or as hub model id
+    (which is then cached in HF_HUB_CACHE). Requires the optional `tokenizers` package.
+    """
+
+    def __init__(self, name_or_path: str):
+        try:
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("LocalTokenizer requires the `tokenizers` package: pip install tokenizers") from e
+
+        if os.path.exists(name_or_path):
+            self.tokenizer = Tokenizer.from_file(name_or_path)
+        else:
+            self.tokenizer = Tokenizer.from_pretrained(name_or_path)
+        self.count_tokens = lru_cache(maxsize=256)(self._count_tokens)
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def get_server_context_size(llm_endpoint: str, timeout: float = 10.0) -> Optional[int]:
+    """
+    Returns the context size per slot of a llama-server (from /props), or None if it can't be determined.
+    """
+    try:
+        res = requests.get(get_server_root(llm_endpoint) + "/props", timeout=timeout)
+        res.raise_for_status()
+        return int(res.json()["default_generation_settings"]["n_ctx"])
+    except Exception as e:
+        print(f"Warning: Could not get the context size from the server ({e}).")
+        return None
+
+
+def get_chunk_token_budget(
+    count_tokens: Callable[[str], int],
+    context_size: int,
+    prompt_overhead: str,
+    max_output_tokens: int,
+    safety_margin: int = 256,
+) -> int:
+    """
+    Returns the max. number of tokens of notes that fit into one request:
+    the context size minus the tokens of everything else in the prompt (instructions, patient meta, schema),
+    the tokens reserved for the output, and a safety margin for the chat template and token merges at note boundaries.
+    """
+    budget = context_size - count_tokens(prompt_overhead) - max_output_tokens - safety_margin
+    if budget <= 0:
+        raise ValueError(
+            f"No room for notes: context size {context_size} is used up by the prompt and {max_output_tokens} output tokens."
+        )
+    return budget
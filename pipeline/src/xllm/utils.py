@@ -1,6 +1,11 @@
 from datetime import datetime
+from functools import lru_cache
+import re
+import json
+import os
+import numpy as np
 import pandas as pd
-from typing import Any, List, TypedDict, Dict, Optional, Union
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, TypedDict, Dict, Optional, Union
 from dataclasses import dataclass
 
 class Chunk(TypedDict):
@@ -23,21 +28,124 @@ class RunResult(TypedDict):
     runs: List[Run]
 
 
-def get_notes(file_location: str):
-    # import using pandas
-    notes = pd.read_csv(file_location, dtype={"NOTE_ID": int, "MRN": int, "NOTE_TEXT": str, "NOTE_DATE": str})
-    assert "NOTE_ID" in notes.columns
-    assert "MRN" in notes.columns
-    assert "NOTE_TEXT" in notes.columns
-    assert "NOTE_DATE" in notes.columns
-    notes = notes.drop_duplicates(subset="NOTE_TEXT").reset_index(drop=True)
+NOTE_COLUMNS = ["NOTE_ID", "MRN", "NOTE_TEXT", "NOTE_DATE"]
+NOTE_TAG_CHARS = len('<note id="">') + len("</note>")
+""" Characters the <note id="..."> wrapper adds to a note in a chunk, besides the note id."""
+NOTES_STORE_INFO = "_store.json"
+""" File in a notes store directory (see convert_notes.py) with the number of MRN buckets."""
+
+
+def is_parquet(file_location: str) -> bool:
+    """ Whether the file is a Parquet file or a directory with a Parquet dataset, e.g. made by convert_notes.py."""
+    return os.path.isdir(file_location) or file_location.endswith(".parquet")
+
+
+def import_parquet():
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Reading Parquet notes requires the `pyarrow` package: pip install pyarrow") from e
+    return pq
+
+
+def get_notes(
+    file_location: str,
+    mrns: Optional[Iterable[int]] = None,
+    chunksize: int = 100_000,
+    text_lengths_only: bool = False,
+):
+    """
+    Reads the notes CSV in blocks of chunksize rows and keeps only the notes of the given mrns (all if None),
+    so memory scales with the requested mrns instead of the cohort.
+    Notes with the same text are dropped, keeping the first one in the file. This is checked across all
+    mrns (by a 64-bit hash of the text, not the text itself), so the notes of an mrn don't depend on which
+    other mrns are requested.
+    If text_lengths_only, NOTE_TEXT is replaced by NOTE_LENGTH, the length of the stripped text.
+    Returns the notes sorted by MRN and NOTE_DATE.
+
+    If file_location is a Parquet store (see is_parquet), it is read with get_notes_parquet instead.
+    """
+    if is_parquet(file_location):
+        return get_notes_parquet(file_location, mrns, text_lengths_only)
+
+    mrn_filter = pd.Index(list(mrns)) if mrns is not None else None
+
+    blocks = []
+    hashes = []
+    for block in pd.read_csv(
+        file_location,
+        usecols=NOTE_COLUMNS,
+        dtype={"NOTE_ID": int, "MRN": int, "NOTE_TEXT": str, "NOTE_DATE": str},
+        chunksize=chunksize,
+    ):
+        hashes.append(pd.util.hash_pandas_object(block["NOTE_TEXT"], index=False).to_numpy())
+        if mrn_filter is not None:
+            block = block[block["MRN"].isin(mrn_filter)]
+        if text_lengths_only:
+            block = block.assign(NOTE_LENGTH=block["NOTE_TEXT"].str.strip().str.len()).drop(columns="NOTE_TEXT")
+        blocks.append(block)
+
+    columns = [column for column in NOTE_COLUMNS if not (text_lengths_only and column == "NOTE_TEXT")]
+    if text_lengths_only:
+        columns.append("NOTE_LENGTH")
+    if len(blocks) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # keep the first occurrence of every text in the whole file (the index of the blocks is the row in the file)
+    is_first = ~pd.Series(np.concatenate(hashes)).duplicated().to_numpy()
+    notes = pd.concat(blocks)
+    notes = notes[is_first[notes.index.to_numpy()]].reset_index(drop=True)
     notes = notes.sort_values(["MRN", "NOTE_DATE"]).reset_index(drop=True)
     return notes
 
 
+def get_notes_parquet(
+    file_location: str,
+    mrns: Optional[Iterable[int]] = None,
+    text_lengths_only: bool = False,
+):
+    """
+    Reads the notes of the given mrns (all if None) from a notes store written by convert_notes.py, which is
+    already deduplicated and sorted. Only the MRN buckets of the mrns are opened, and within them only the row
+    groups whose MRN range contains one of the mrns (predicate pushdown). The files are memory mapped.
+    If text_lengths_only, only the stored NOTE_LENGTH is read instead of NOTE_TEXT.
+    Returns the same DataFrame as reading the CSV with get_notes, plus the stored NOTE_DATE_KEY (the parsed
+    NOTE_DATE, see variables.parse_date_keys) if the store has it and not text_lengths_only.
+    """
+    pq = import_parquet()
+
+    columns = [column for column in NOTE_COLUMNS if not (text_lengths_only and column == "NOTE_TEXT")]
+    if text_lengths_only:
+        columns.append("NOTE_LENGTH")
+    elif "NOTE_DATE_KEY" in pq.ParquetDataset(file_location).schema.names:
+        # stores written before the date keys were added don't have them
+        columns.append("NOTE_DATE_KEY")
+
+    filters = None
+    if mrns is not None:
+        mrn_list = sorted({int(mrn) for mrn in mrns})
+        if len(mrn_list) == 0:
+            return pd.DataFrame(columns=columns)
+        filters = [("MRN", "in", mrn_list)]
+        info_path = os.path.join(file_location, NOTES_STORE_INFO)
+        if os.path.isdir(file_location) and os.path.exists(info_path):
+            with open(info_path, "r", encoding="utf-8") as f:
+                n_buckets = json.load(f)["buckets"]
+            filters.append(("MRN_BUCKET", "in", sorted({mrn % n_buckets for mrn in mrn_list})))
+
+    table = pq.read_table(file_location, columns=columns, filters=filters, memory_map=True)
+    notes = table.to_pandas()
+    # the store keeps the order of get_notes within an MRN, the stable sort only restores the order of the buckets
+    notes = notes.sort_values(["MRN", "NOTE_DATE"]).reset_index(drop=True)
+    return notes[columns]
+
+
 def get_patient_meta(file_location: str):
     # import using pandas
-    meta = pd.read_csv(file_location)
+    if is_parquet(file_location):
+        meta = import_parquet().read_table(file_location, memory_map=True).to_pandas()
+    else:
+        meta = pd.read_csv(file_location)
     assert "MRN" in meta.columns
     assert "LAST_NAME" in meta.columns
     assert "FIRST_NAME" in meta.columns
@@ -75,58 +183,94 @@ def get_patient_meta_prompt(meta: PatientMeta) -> str:
 
 
 
-def chunk_notes(notes: pd.DataFrame, chunk_max_chars: int) -> List[MRNChunks]:
+def get_mrn_bounds(mrns: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Returns the (start, end) row ranges of each mrn in an array of mrns sorted by mrn.
+    """
+    bounds = [0, *(np.flatnonzero(mrns[1:] != mrns[:-1]) + 1).tolist(), len(mrns)]
+    return list(zip(bounds[:-1], bounds[1:])) if len(mrns) > 0 else []
+
+
+def get_chunk_bounds(sizes: List[int], chunk_max_size: int) -> List[int]:
+    """
+    Packs notes of the given sizes greedily into chunks of at most chunk_max_size: a new chunk starts
+    when the next note doesn't fit (a note larger than a chunk gets a chunk of its own).
+    Returns the index of the first note of each chunk, followed by len(sizes).
+    """
+    chunk_starts = [0]
+    chunk_size = 0
+    for i, size in enumerate(sizes):
+        if chunk_size + size > chunk_max_size and chunk_size > 0:
+            chunk_starts.append(i)
+            chunk_size = 0
+        chunk_size += size
+    chunk_starts.append(len(sizes))
+    return chunk_starts
+
+
+def iter_chunk_notes(
+    notes: pd.DataFrame,
+    chunk_max_chars: int,
+    chunk_max_tokens: Optional[int] = None,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> Iterator[MRNChunks]:
     """
     Creates chunks of notes for each mrn, where each chunk has at most chunk_max_chars characters.
+    If chunk_max_tokens and count_tokens are given, chunks are limited to chunk_max_tokens tokens instead,
+    counting the tokens of each (wrapped) note with count_tokens.
     Notes are never split across chunks.
-    Returns an array of dicts with MRN and an array of chunks. Each chunk is a dict with text and source_note_ids.
+    Yields a dict with MRN and an array of chunks per mrn, as soon as its chunks are done.
+    Each chunk is a dict with text and source_note_ids.
     """
     assert "NOTE_ID" in notes.columns
     assert "MRN" in notes.columns
     assert "NOTE_TEXT" in notes.columns
 
+    use_tokens = chunk_max_tokens is not None and count_tokens is not None
+    chunk_max_size = chunk_max_tokens if use_tokens else chunk_max_chars
+
     # sort notes by MRN
     notes = notes.sort_values("MRN").reset_index(drop=True)
-
-    result = []
-    curr_mrn = None
-    curr_chunks = []
-    curr_chunk_text = ""
-    curr_chunk_note_ids = []
-
-    for i, row in notes.iterrows():
-        note = row["NOTE_TEXT"].strip()
-        note_id = row["NOTE_ID"]
-        note_wrapped = f'<note id="{note_id}">{note}</note>'
-
-        if curr_mrn is None:
-            curr_mrn = row["MRN"]
-
-        is_last_note = i == notes.shape[0] - 1
-        is_new_mrn = row["MRN"] != curr_mrn
-        fits_current_chunk = len(curr_chunk_text) + len(note_wrapped) <= chunk_max_chars
-
-        if is_new_mrn or (not fits_current_chunk and len(curr_chunk_text) > 0):
-            curr_chunks.append(
-                {"text": curr_chunk_text, "source_note_ids": curr_chunk_note_ids}
-            )
-            if is_new_mrn:
-                result.append({"MRN": curr_mrn, "chunks": curr_chunks})
-                curr_chunks = []
-            curr_chunk_text = ""
-            curr_chunk_note_ids = []
-            curr_mrn = row["MRN"]
-
-        curr_chunk_text += note_wrapped
-        curr_chunk_note_ids.append(note_id)
-
-        if is_last_note:
-            curr_chunks.append(
-                {"text": curr_chunk_text, "source_note_ids": curr_chunk_note_ids}
-            )
-            result.append({"MRN": curr_mrn, "chunks": curr_chunks})
-
-    return result
+    if notes.shape[0] == 0:
+        return
+
+    note_ids = notes["NOTE_ID"].to_numpy()
+    mrns = notes["MRN"].to_numpy()
+    texts = notes["NOTE_TEXT"]
+
+    # only the notes of the current mrn are wrapped and measured, so the first mrn is yielded right away
+    # (with a token budget, measuring means tokenizing every note)
+    for start, end in get_mrn_bounds(mrns):
+        ids = note_ids[start:end].tolist()
+        wrapped = [
+            f'<note id="{note_id}">{text}</note>'
+            for note_id, text in zip(ids, texts.iloc[start:end].str.strip().tolist())
+        ]
+        if use_tokens:
+            sizes = [count_tokens(note) for note in wrapped]  # type: ignore
+        else:
+            sizes = [len(note) for note in wrapped]
+
+        chunk_starts = get_chunk_bounds(sizes, chunk_max_size)
+        yield {
+            "MRN": int(mrns[start]),
+            "chunks": [
+                {"text": "".join(wrapped[lo:hi]), "source_note_ids": [int(note_id) for note_id in ids[lo:hi]]}
+                for lo, hi in zip(chunk_starts[:-1], chunk_starts[1:])
+            ],
+        }
+
+
+def chunk_notes(
+    notes: pd.DataFrame,
+    chunk_max_chars: int,
+    chunk_max_tokens: Optional[int] = None,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> List[MRNChunks]:
+    """
+    Returns the chunks of all mrns at once, see iter_chunk_notes.
+    """
+    return list(iter_chunk_notes(notes, chunk_max_chars, chunk_max_tokens, count_tokens))
 
 
 # def extract_variables[T](
@@ -262,6 +406,23 @@ def strip_titles_and_refs(schema: dict) -> dict:
     return resolve(schema)
 
 
+DATE_FORMATS = [
+    '%Y-%m-%d',  # YYYY-MM-DD
+    '%m/%d/%Y',  # mm/dd/yyyy
+    '%Y-%m',     # YYYY-MM (defaults to the 1st day of the month)
+    '%Y',        # YYYY (defaults to Jan 1st)
+]
+""" Date formats normalize_date tries, ordered from most specific to least specific. This order is important to parse correctly."""
+
+FAST_DATE_PATTERNS = [
+    (re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})"), (1, 2, 3)),
+    (re.compile(r"([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})"), (3, 1, 2)),
+    (re.compile(r"([0-9]{4})-([0-9]{2})"), (1, 2, None)),
+    (re.compile(r"([0-9]{4})"), (1, None, None)),
+]
+""" The common spellings of DATE_FORMATS as (pattern, groups of year, month and day), matched without strptime."""
+
+
 def normalize_date(date_str: Optional[str]) -> Optional[str]:
     """
     Parses partial ISO (YYYY, YYYY-MM, YYYY-MM-DD) and american dates(mm/dd/yyyy) 
@@ -271,20 +432,32 @@ def normalize_date(date_str: Optional[str]) -> Optional[str]:
     "2021-05" -> "2021-05-01"
     "05/31/2022" -> "2022-05-31"
     Invalid or unsupported formats will return None.
+    Results are cached, since the same strings are normalized over and over.
     """
-    # A list of date formats to try, ordered from most specific to least specific.
-    # This order is important to parse correctly.
-    formats_to_try = [
-        '%Y-%m-%d',  # YYYY-MM-DD
-        '%m/%d/%Y',  # mm/dd/yyyy
-        '%Y-%m',     # YYYY-MM (defaults to the 1st day of the month)
-        '%Y',        # YYYY (defaults to Jan 1st)
-    ]
-
     if not date_str:
         return None
+    return _normalize_date(date_str)
+
 
-    for fmt in formats_to_try:
+@lru_cache(maxsize=65536)
+def _normalize_date(date_str: str) -> Optional[str]:
+    # fast path: the usual spellings, checked with a regex and the datetime constructor
+    for pattern, (year_group, month_group, day_group) in FAST_DATE_PATTERNS:
+        match = pattern.fullmatch(date_str)
+        if match is None:
+            continue
+        year = int(match.group(year_group))
+        month = int(match.group(month_group)) if month_group else 1
+        day = int(match.group(day_group)) if day_group else 1
+        if year >= 1000:
+            try:
+                return datetime(year, month, day).strftime('%Y-%m-%d')
+            except ValueError:
+                pass
+        # anything unusual is left to strptime, which decides exactly as before
+        break
+
+    for fmt in DATE_FORMATS:
         try:
             # Attempt to parse the string with the current format
             parsed_date = datetime.strptime(date_str, fmt)
@@ -296,4 +469,14 @@ def normalize_date(date_str: Optional[str]) -> Optional[str]:
             continue
     
     # If the loop completes without returning, no format matched.
-    return None
\ No newline at end of file
+    return None
+
+
+def normalize_dates(values: Iterable[Optional[str]], default: Optional[str] = None) -> List[Optional[str]]:
+    """
+    normalize_date for a whole list, Series or array of dates: every distinct value is normalized once.
+    Missing values (None, NaN) and dates that can't be normalized become default.
+    """
+    codes, uniques = pd.factorize(pd.Series(list(values), dtype=object))
+    normalized = [normalize_date(value) for value in uniques] + [None]  # code -1 is a missing value
+    return [default if date is None else date for date in np.array(normalized, dtype=object)[codes].tolist()]
@@ -3,6 +3,8 @@ from typing import (
     Any,
     Callable,
     Dict,
+    FrozenSet,
+    Iterable,
     List,
     Optional,
     TypeVar,
@@ -12,10 +14,13 @@ from typing import (
     get_args,
 )
 from dataclasses import dataclass
-from pydantic import BaseModel, ConfigDict, Field, create_model
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, create_model
 import json
 from enum import Enum
 from pydantic import field_validator
+from src.xllm.utils import strip_titles_and_refs
 
 
 def get_type_json_name(var_type):
@@ -42,21 +47,50 @@ def get_type_json_name(var_type):
             })
         return {"type": "object", "values": fields}
 
+UNKNOWN_DATE_KEY = 0
+""" Sort key of a date that couldn't be parsed, lower than the key of every PartialDate."""
+
+
 class PartialDate:
     """
     A partial date is a date that is not fully specified. For example, "2023-10" is a partial date.
+
+    Dates are immutable and ordered by their integer key year * 10000 + month * 100 + day, where a missing
+    month or day counts as 0: a partial date sorts before all more precise dates within its year (or month),
+    and equal dates compare equal.
     """
 
-    year: int 
-    month: Optional[int] = None
-    day: Optional[int] = None
+    __slots__ = ("year", "month", "day", "key")
+
+    year: int
+    month: Optional[int]
+    day: Optional[int]
+    key: int
 
     def __init__(
         self, year: int, month: Optional[int] = None, day: Optional[int] = None
     ):
-        self.year = year
-        self.month = month
-        self.day = day
+        object.__setattr__(self, "year", year)
+        object.__setattr__(self, "month", month)
+        object.__setattr__(self, "day", day)
+        object.__setattr__(self, "key", year * 10000 + (month or 0) * 100 + (day or 0))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PartialDate is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("PartialDate is immutable")
+
+    def __reduce__(self):
+        return (PartialDate, (self.year, self.month, self.day))
+
+    @classmethod
+    def from_key(cls, key: int) -> Optional["PartialDate"]:
+        """ The date of a sort key, None for UNKNOWN_DATE_KEY."""
+        if key == UNKNOWN_DATE_KEY:
+            return None
+        year, month, day = key // 10000, key // 100 % 100, key % 100
+        return cls(year, month or None, day or None)
 
     @classmethod
     def parse(cls, date_str: str) -> Optional["PartialDate"]:
@@ -103,112 +137,50 @@ class PartialDate:
 
     def __eq__(self, other):
         if isinstance(other, PartialDate):
-            return (
-                self.year == other.year
-                and self.month == other.month
-                and self.day == other.day
-            )
+            return self.key == other.key
         return False
 
     def __hash__(self):
-        return hash((self.year, self.month, self.day))
+        return hash(self.key)
 
     def __lt__(self, other):
         if isinstance(other, PartialDate):
-            if self.year != other.year:
-                return self.year < other.year
-            if not self.month and not other.month:
-                return False
-            if self.month is None:
-                return True
-            if other.month is None:
-                return False
-            if self.month != other.month:
-                return self.month < other.month
-            if not self.day and not other.day:
-                return False
-            if self.day is None:
-                return True
-            if other.day is None:
-                return False
-            if self.day != other.day:
-                return self.day < other.day
-        return False
+            return self.key < other.key
+        return NotImplemented
 
     def __le__(self, other):
         if isinstance(other, PartialDate):
-            if self.year != other.year:
-                return self.year < other.year
-            if not self.month and not other.month:
-                return False
-            if self.month is None:
-                return True
-            if other.month is None:
-                return False
-            if self.month != other.month:
-                return self.month < other.month
-            if not self.day and not other.day:
-                return False
-            if self.day is None:
-                return True
-            if other.day is None:
-                return False
-            if self.day != other.day:
-                return self.day < other.day
-        return False
+            return self.key <= other.key
+        return NotImplemented
 
     def __gt__(self, other):
         if isinstance(other, PartialDate):
-            if self.year != other.year:
-                return self.year > other.year
-            if not self.month and not other.month:
-                return False
-            if self.month is None:
-                return True
-            if other.month is None:
-                return False
-            if self.month != other.month:
-                return self.month > other.month
-            if not self.day and not other.day:
-                return False
-            if self.day is None:
-                return True
-            if other.day is None:
-                return False
-            if self.day != other.day:
-                return self.day > other.day
-        return False
+            return self.key > other.key
+        return NotImplemented
 
     def __ge__(self, other):
         if isinstance(other, PartialDate):
-            if self.year != other.year:
-                return self.year > other.year
-            if not self.month and not other.month:
-                return False
-            if self.month is None:
-                return True
-            if other.month is None:
-                return False
-            if self.month != other.month:
-                return self.month > other.month
-            if not self.day and not other.day:
-                return False
-            if self.day is None:
-                return True
-            if other.day is None:
-                return False
-            if self.day != other.day:
-                return self.day > other.day
-        return False
+            return self.key >= other.key
+        return NotImplemented
+
+
+DATE_PATTERN = r"^(\d+)(?:-(\d+))?(?:-(\d+))?$"
 
-    def __ne__(self, other):
-        if isinstance(other, PartialDate):
-            return (
-                self.year != other.year
-                or self.month != other.month
-                or self.day != other.day
-            )
-        return True
+
+def parse_date_keys(dates: pd.Series) -> np.ndarray:
+    """
+    Parses a whole column of date strings into PartialDate keys at once, like PartialDate.parse on each of them.
+    Dates that can't be parsed (or aren't strings) get UNKNOWN_DATE_KEY.
+    """
+    parts = dates.astype(object).str.extract(DATE_PATTERN)
+    year, month, day = (pd.to_numeric(parts[i], errors="coerce").to_numpy(dtype=float) for i in range(3))
+
+    valid = (year >= 1900) & (year <= 2999)
+    valid &= np.isnan(month) | ((month >= 1) & (month <= 12))
+    valid &= np.isnan(day) | ((day >= 1) & (day <= 31))
+    # a day needs a month (guaranteed by the pattern)
+    keys = np.nan_to_num(year) * 10000 + np.nan_to_num(month) * 100 + np.nan_to_num(day)
+    return np.where(valid, keys, UNKNOWN_DATE_KEY).astype(np.int64)
 
 
 class MedicalFact[T](BaseModel):
@@ -232,17 +204,24 @@ class MedicalFact[T](BaseModel):
 
     @classmethod
     def with_type(cls, value_type: Type[T]):
-        class _TypedFact(cls):
-            value: value_type
+        # one subclass per value type, so the record classes of all variable sets share them
+        if (cls, value_type) not in _TYPED_FACTS:
+            class _TypedFact(cls):
+                value: value_type
+
+            _TYPED_FACTS[(cls, value_type)] = _TypedFact
+        return _TYPED_FACTS[(cls, value_type)]
 
-        return _TypedFact
+
+_TYPED_FACTS: Dict[Any, Type[MedicalFact]] = {}
 
 T = TypeVar("T", bound=Union[str, int, float, bool, Enum, List[Any]])
 V = TypeVar("V", bound=Union[str, int, float, bool, Enum, List[Any]])
 
 @dataclass
 class ChunkValue[T]:
-    date: PartialDate
+    date: Optional[PartialDate]
+    """ Date of the note the value was extracted from, None if it couldn't be parsed."""
     value: T
 
     @classmethod
@@ -274,27 +253,38 @@ class ChunkValue[T]:
             element for chunk in chunks for element in chunk.value
         ))
 
+    @staticmethod
+    def date_keys(chunks: List["ChunkValue[V]"]) -> np.ndarray:
+        """ The sort keys of the chunks' dates, UNKNOWN_DATE_KEY for chunks without a date."""
+        return np.fromiter(
+            (chunk.date.key if chunk.date is not None else UNKNOWN_DATE_KEY for chunk in chunks),
+            dtype=np.int64,
+            count=len(chunks),
+        )
+
     @classmethod
     def get_most_recent(cls, chunks: List["ChunkValue[V]"]) -> Optional[V]:
         """
-        Returns the value of the most recent ChunkValue object based on the date.
+        Returns the value of the most recent ChunkValue object based on the date (the first one if tied).
+        Chunks without a date are only used if no chunk has one.
         """
         if not chunks:
             return None
 
-        most_recent_chunk = max(chunks, key=lambda chunk: chunk.date)
-        return most_recent_chunk.value
+        return chunks[int(np.argmax(cls.date_keys(chunks)))].value
     
     @classmethod
     def get_least_recent(cls, chunks: List["ChunkValue[V]"]) -> Optional[V]:
         """
-        Returns the value of the least recent ChunkValue object based on the date.
+        Returns the value of the least recent ChunkValue object based on the date (the first one if tied).
+        Chunks without a date are only used if no chunk has one.
         """
         if not chunks:
             return None
 
-        least_recent_chunk = min(chunks, key=lambda chunk: chunk.date)
-        return least_recent_chunk.value
+        keys = cls.date_keys(chunks)
+        keys = np.where(keys == UNKNOWN_DATE_KEY, np.iinfo(np.int64).max, keys)
+        return chunks[int(np.argmin(keys))].value
 
 
 @dataclass
@@ -317,6 +307,11 @@ class LMVariable[T]:
     redcap_id: Optional[str] = None
     to_redcap: Optional[Callable[[T], Union[str, int, float]]] = None
     is_date: Optional[bool] = False
+    query_terms: Optional[List[str]] = None
+    """
+    Optional lowercase word prefixes that a note must contain to possibly mention this variable.
+    Used to skip chunks that can't be relevant for an active Stage II variable. Without terms, no chunk is skipped.
+    """
 
     def to_json(self) -> Dict[str, Any]:
         return {
@@ -594,6 +589,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["pers_cancer_hx"] is not None and CancerTypes.colorectal in resolved["pers_cancer_hx"] ,
         type=str,
         prompt="What was the date of diagnosis for colorectal cancer?",
+        query_terms=["colorectal", "colon", "rectal", "rectum", "crc", "cancer", "carcinoma", "adenocarcinoma", "malignan", "tumor", "oncolog", "diagnos"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="date_dx_crc",
         to_redcap=lambda x: str(x) if x else "",
@@ -605,6 +601,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["pers_cancer_hx"] is not None and CancerTypes.colorectal in resolved["pers_cancer_hx"] ,
         type=CancerTherapyType,
         prompt="What type of therapy was used for colorectal cancer?",
+        query_terms=["colorectal", "colon", "rectal", "rectum", "crc", "cancer", "carcinoma", "adenocarcinoma", "malignan", "tumor", "oncolog", "chemo", "folfox", "capox", "radiation", "radiotherapy", "resection", "colectomy", "surgery"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="type_therapy_crc",
         to_redcap=lambda x: 1
@@ -623,6 +620,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["pers_cancer_hx"] is not None and CancerTypes.colorectal in resolved["pers_cancer_hx"] ,
         type=bool,
         prompt="Is the patient in remission from colorectal cancer?",
+        query_terms=["colorectal", "colon", "rectal", "rectum", "crc", "cancer", "carcinoma", "adenocarcinoma", "malignan", "tumor", "oncolog", "remission", "ned", "recurren", "surveillance"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="in_remission",
         to_redcap=lambda x: 1 if x else 0,
@@ -633,6 +631,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["pers_cancer_hx"] is not None and CancerTypes.colorectal in resolved["pers_cancer_hx"] ,
         type=StageCRC,
         prompt="What is the stage of the patient's colorectal cancer?",
+        query_terms=["colorectal", "colon", "rectal", "rectum", "crc", "cancer", "carcinoma", "adenocarcinoma", "malignan", "tumor", "oncolog", "stage", "tnm", "metasta", "node", "nodal"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="stage_ca_crc",
         to_redcap=lambda x: 1
@@ -657,6 +656,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["pers_cancer_hx"] is not None and len(resolved["pers_cancer_hx"]) > 0 and CancerTypes.colorectal not in resolved["pers_cancer_hx"],
         type=str,
         prompt="What is the date of remission from non-colorectal cancer?",
+        query_terms=["cancer", "carcinoma", "malignan", "tumor", "lymphoma", "leukemia", "melanoma", "sarcoma", "oncolog", "metasta", "remission", "ned", "recurren"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="date_of_remission",
         to_redcap=lambda x: str(x) if x else "",
@@ -668,6 +668,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["pers_cancer_hx"] is not None and len(resolved["pers_cancer_hx"]) > 0 and CancerTypes.colorectal not in resolved["pers_cancer_hx"],
         type=CancerTherapyType,
         prompt="What type of therapy was used for non-colorectal cancer?",
+        query_terms=["cancer", "carcinoma", "malignan", "tumor", "lymphoma", "leukemia", "melanoma", "sarcoma", "oncolog", "metasta", "chemo", "radiation", "radiotherapy", "resection", "surgery", "ectomy"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="type_therapy_ncrc",
         to_redcap=lambda x: 1
@@ -686,6 +687,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["pers_cancer_hx"] is not None and len(resolved["pers_cancer_hx"]) > 0 and CancerTypes.colorectal not in resolved["pers_cancer_hx"],
         type=bool,
         prompt="Is the patient in remission from non-colorectal cancer?",
+        query_terms=["cancer", "carcinoma", "malignan", "tumor", "lymphoma", "leukemia", "melanoma", "sarcoma", "oncolog", "metasta", "remission", "ned", "recurren", "surveillance"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="in_remission_ncrc",
         to_redcap=lambda x: 1 if x else 0,
@@ -718,6 +720,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["ibd_type"] == IBDType.ulcerative_colitis,
         type=MontrealExtentUC,
         prompt="What is the Montreal classification of extent of UC? E1=Involvement limited to the rectum (proximal extent of inflammation is distal to the rectosigmoid junction), E2=Involvement limited to a portion of the colorectum distal to the splenic flexure, E3=Involvement extends proximal to the splenic flexure",
+        query_terms=["uc", "ulcerative", "colitis", "pancolitis", "proctitis", "proctosigmoiditis", "splenic", "rectosigmoid", "extent", "montreal", "e1", "e2", "e3"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="montreal_ext_enrol_encnter",
         to_redcap=lambda x: 1
@@ -734,6 +737,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["ibd_type"] == IBDType.unclassified,
         type=MontrealExtentIBDU,
         prompt="What is the extent of IBD-U?",
+        query_terms=["ibd", "indeterminate", "unclassified", "colitis", "pancolitis", "proctitis", "splenic", "extent", "montreal", "e1", "e2", "e3"],
         resolver=lambda x: ChunkValue.get_least_recent(x),
         redcap_id="montreal_ext_enrol_ibdu",
         to_redcap=lambda x: 1
@@ -750,6 +754,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["ibd_type"] == IBDType.crohns_disease,
         type=CrohnsColitisExtent,
         prompt="What is the extent of the patient's Crohn's Colitis?",
+        query_terms=["crohn", "colitis", "colonic", "pancolonic", "extent", "remission", "colonoscopy"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="crohn_colitis_baseline",
         to_redcap=lambda x: 1
@@ -772,6 +777,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["ibd_type"] == IBDType.crohns_disease,
         type=CrohnsBehaviour,
         prompt="What is the patient's behaviour state?",
+        query_terms=["crohn", "strictur", "stenosis", "fistul", "penetrat", "abscess", "phlegmon", "behavio", "b1", "b2", "b3"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="behaviour",
         to_redcap=lambda x: 1
@@ -809,6 +815,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["ibd_type"] == IBDType.crohns_disease,
         type=List[CrohnsDiseaseLocation],
         prompt="What is the most recently reported location of crohns in the patient?",
+        query_terms=["crohn", "ileal", "ileum", "ileitis", "ileocolonic", "ileocolitis", "colonic", "jejun", "duoden", "gastroduoden", "esophag", "upper", "location", "l1", "l2", "l3", "l4"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="disease_location",
         to_redcap=lambda x: 
@@ -865,6 +872,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["prior_dyspl"],
         type=str,
         prompt="When was the date of surgery for dysplasia or cancer? (format: YYYY-MM-DD)",
+        query_terms=["dysplas", "neoplas", "lgd", "hgd", "polyp", "adenoma", "cancer", "colectomy", "proctocolectomy", "resection", "surgery", "surgical"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="date_surg_dys_crc",
         to_redcap=lambda x: str(x) if x else "",
@@ -876,6 +884,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["prior_dyspl"],
         type=NeoplasiaFindings,
         prompt="What is the type of dysplasia?",
+        query_terms=["dysplas", "neoplas", "lgd", "hgd", "polyp", "adenoma", "indefinite", "grade"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="type_prior_dys",
         to_redcap=lambda x: 1
@@ -892,6 +901,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["prior_dyspl"],
         type=bool,
         prompt="Were any surgeries for dysplasia conducted at or prior to enrollment?",
+        query_terms=["dysplas", "neoplas", "lgd", "hgd", "polyp", "adenoma", "colectomy", "proctocolectomy", "resection", "surgery", "surgical", "emr", "esd"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="sur_dys",
         to_redcap=lambda x: 1 if x else 0,
@@ -911,6 +921,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=str,
         prompt="What was the date of diagnosis for PSC? (format: YYYY-MM-DD)",
+        query_terms=["psc", "sclerosing", "cholangit", "diagnos"],
         # resolve to the most frequently reported value, NOT the one with the most recent date :
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="date_dgnsis_psc",
@@ -923,6 +934,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=str,
         prompt="What was the date of the patient's first encounter for PSC? (format: YYYY-MM-DD)",
+        query_terms=["psc", "sclerosing", "cholangit", "hepatolog", "visit", "consult"],
         resolver=lambda x: sortStringsAsDates(x) if x else None,
         redcap_id="psc_dt_mt",
         to_redcap=lambda x: str(x) if x else "",
@@ -934,6 +946,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=PSCExtent,
         prompt="What is the extent of the PSC?",
+        query_terms=["psc", "sclerosing", "cholangit", "intrahepatic", "extrahepatic", "hepatic", "bile", "biliary", "duct", "mrcp", "ercp"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="psc_extent",
         to_redcap=lambda x: 1
@@ -950,6 +963,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=FrequencyEnum,
         prompt="Has the patient ever had a history of cholangitis? (1=Never, 2=Once, 3=Two or more, 99=Unknown)",
+        query_terms=["cholangit"],
         resolver=lambda x: ChunkValue.get_most_recent(x),
         redcap_id="psc_hx_chlgitis2",
         to_redcap=lambda x: 1 if x == FrequencyEnum.never else
@@ -963,6 +977,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Does the patient have a history of bile duct stricture?",
+        query_terms=["strictur", "stenosis", "bile", "biliary", "duct", "ercp", "stent", "dilat"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_bile",
         to_redcap=lambda x: 1 if x else 0,
@@ -974,6 +989,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Has the patient had a history of variceal bleeding?",
+        query_terms=["varice", "variceal", "varix", "bleed", "hemorrhag", "banding", "ligation"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_var_bled",
         to_redcap=lambda x: 1 if x else 0,
@@ -986,6 +1002,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Does the patient have a history of ascites?",
+        query_terms=["ascites", "ascitic", "paracentesis"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_absc",
         to_redcap=lambda x: 1 if x else 0,
@@ -997,6 +1014,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Does the patient have a history of SBP?",
+        query_terms=["sbp", "peritonitis", "paracentesis"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_sbp2",
         to_redcap=lambda x: 1 if x else 0,
@@ -1007,6 +1025,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Has there been any history of encephalopathy?",
+        query_terms=["encephalopath", "hepatic", "confusion", "lactulose", "rifaximin", "asterixis"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_encl",
         to_redcap=lambda x: 1 if x else 0,
@@ -1017,6 +1036,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Does the patient have a history of HCC?",
+        query_terms=["hcc", "hepatocellular", "hepatoma", "liver"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_hcc2",
         to_redcap=lambda x: 1 if x else 0,
@@ -1028,6 +1048,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Has the patient received Radiation or RFA treatment?",
+        query_terms=["radiation", "radiotherapy", "radiofrequency", "rfa", "ablation"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_radiation",
         to_redcap=lambda x: 1 if x else 0,
@@ -1039,6 +1060,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="What is the patient's history of cholangiocarcinoma?",
+        query_terms=["cholangiocarcinoma", "cca", "cholangiocellular", "biliary", "ca19"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_cholcanc",
         to_redcap=lambda x: 1 if x else 0,
@@ -1050,6 +1072,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved:  resolved["psc_hx"],
         type=str,
         prompt="What is the date of the cholangiocarcinoma diagnosis? (format: YYYY-MM-DD)",
+        query_terms=["cholangiocarcinoma", "cca", "cholangiocellular", "biliary", "ca19"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="psc_cholcanc2",
         to_redcap=lambda x: str(x) if x else "",
@@ -1062,6 +1085,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="What is the patient's history of liver transplant?",
+        query_terms=["transplant", "olt", "oltx", "lt", "allograft", "graft"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_liv_trsn",
         to_redcap=lambda x: 1 if x else 0,
@@ -1072,6 +1096,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=str,
         prompt="What is the date of the patient's OLT? (format: YYYY-MM-DD)",
+        query_terms=["transplant", "olt", "oltx", "lt", "allograft", "graft"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="psc_olt_dt",
         to_redcap=lambda x: str(x) if x else "",
@@ -1084,6 +1109,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Does the patient have a history of liver or bile duct surgery?",
+        query_terms=["surgery", "surgical", "resection", "hepatectomy", "hepaticojejunostomy", "choledoch", "whipple", "transplant", "bile", "biliary", "liver"],
         resolver=lambda x: any(v.value for v in x),
         redcap_id="psc_hx_liv_surg",
         to_redcap=lambda x: 1 if x else 0,
@@ -1095,6 +1121,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=str,
         prompt="What was the date of the patient's liver or bile duct surgery? (format: YYYY-MM-DD)",
+        query_terms=["surgery", "surgical", "resection", "hepatectomy", "hepaticojejunostomy", "choledoch", "whipple", "transplant", "bile", "biliary", "liver"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="psc_olt_dt2_d28",
         to_redcap=lambda x: str(x) if x else "",
@@ -1106,6 +1133,7 @@ LM_VARIABLES: Dict[str, LMVariable] = {
         is_active=lambda resolved: resolved["psc_hx"],
         type=bool,
         prompt="Is the patient currently on dialysis?",
+        query_terms=["dialysis", "hemodialysis", "esrd", "renal", "kidney"],
         resolver=lambda x: ChunkValue.get_most_frequent(x),
         redcap_id="psc_dialysis2",
         to_redcap=lambda x: 1 if x else 0,
@@ -1128,6 +1156,32 @@ def create_medical_record_class(variables: Dict[str, LMVariable]) -> Type[BaseMo
     return create_model("MedicalRecord", **fields, __base__=BaseModel)
 
 
+@dataclass(frozen=True)
+class RecordSchema:
+    cls: Type[BaseModel]
+    """ The MedicalRecord class, used as response format."""
+    clean_schema: Dict[str, Any]
+    """ Its JSON schema without titles and refs."""
+    schema_str: str
+    """ The serialized clean schema, as embedded in the prompt."""
+
+
+_RECORD_SCHEMAS: Dict[FrozenSet[str], RecordSchema] = {}
+
+
+def get_record_schema(var_ids: Iterable[str]) -> RecordSchema:
+    """
+    Returns the record class and schema for the variables with the given ids, with the fields in the order
+    of LM_VARIABLES. They are built once per set of ids, since only a few sets of active variables occur.
+    """
+    key = frozenset(var_ids)
+    if key not in _RECORD_SCHEMAS:
+        cls = create_medical_record_class({var_id: var for var_id, var in LM_VARIABLES.items() if var_id in key})
+        clean_schema = strip_titles_and_refs(TypeAdapter(cls).json_schema())
+        _RECORD_SCHEMAS[key] = RecordSchema(cls=cls, clean_schema=clean_schema, schema_str=json.dumps(clean_schema))
+    return _RECORD_SCHEMAS[key]
+
+
 ###########################
 ## 🧮 Computed Variables ##
 ###########################
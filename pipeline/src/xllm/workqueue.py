@@ -0,0 +1,156 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+class WorkQueue:
+    """
+    Coordinator-free queue of per-patient work items in a SQLite file on the shared filesystem.
+
+    Workers claim patients by taking a lease on them, renew the lease with heartbeats while they work,
+    and mark them done once the patient is journaled. A lease that isn't renewed (e.g. because the worker
+    crashed or was preempted) expires, and the patient is handed out again by the next claim.
+    Claims hand out the most expensive patients first, so the long ones don't end up last.
+    A patient that failed (or whose lease expired) max_attempts times is marked failed instead of handed out
+    again, so a patient that always fails doesn't crash every worker in turn.
+
+    Every operation is a short transaction. The rollback journal (not WAL) is used, since WAL needs
+    shared memory that network filesystems don't provide.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 600.0, timeout: float = 60.0, max_attempts: int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS items (
+                    mrn INTEGER PRIMARY KEY,
+                    cost INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """ Runs the statements in one transaction that holds the write lock from the start."""
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def populate(self, mrns: List[int], costs: Optional[Dict[int, int]] = None):
+        """
+        Adds the patients that aren't in the queue yet. Every worker can call this, existing items are kept.
+        """
+        costs = costs or {}
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (mrn, cost) VALUES (?, ?)",
+                [(int(mrn), int(costs.get(mrn, 0))) for mrn in mrns],
+            )
+
+    def claim(self, worker: str, n: int = 1) -> List[int]:
+        """
+        Leases up to n patients to the worker: pending ones, and ones whose lease expired.
+        Returns their MRNs, an empty list if there's nothing left to claim.
+        Expired leases of patients that were already claimed max_attempts times are marked failed instead.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._fail_exhausted(conn, "status = 'leased' AND lease_until < ?", (now,))
+            mrns = [
+                row[0]
+                for row in conn.execute(
+                    """
+                    SELECT mrn FROM items
+                    WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?)
+                    ORDER BY cost DESC, mrn
+                    LIMIT ?
+                    """,
+                    (now, n),
+                )
+            ]
+            conn.executemany(
+                "UPDATE items SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE mrn = ?",
+                [(worker, now + self.lease_seconds, mrn) for mrn in mrns],
+            )
+        return mrns
+
+    def heartbeat(self, worker: str, mrns: List[int]):
+        """ Renews the worker's leases on the patients it's still working on."""
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE items SET lease_until = ? WHERE mrn = ? AND status = 'leased' AND worker = ?",
+                [(time.time() + self.lease_seconds, int(mrn), worker) for mrn in mrns],
+            )
+
+    def complete(self, worker: str, mrns: List[int]):
+        """
+        Marks the patients as done. Also accepted if the lease expired in the meantime, since the result is journaled.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE items SET status = 'done', worker = ?, lease_until = NULL WHERE mrn = ?",
+                [(worker, int(mrn)) for mrn in mrns],
+            )
+
+    def fail(self, worker: str, mrns: List[int]) -> List[int]:
+        """
+        Hands patients the worker failed on back to the queue, or marks them failed if they were claimed
+        max_attempts times. Returns the MRNs marked failed.
+        """
+        placeholders = ",".join("?" * len(mrns))
+        with self._transaction() as conn:
+            failed = self._fail_exhausted(
+                conn, f"status = 'leased' AND worker = ? AND mrn IN ({placeholders})", (worker, *map(int, mrns))
+            )
+            conn.executemany(
+                "UPDATE items SET status = 'pending', worker = NULL, lease_until = NULL WHERE mrn = ? AND status = 'leased' AND worker = ?",
+                [(int(mrn), worker) for mrn in mrns],
+            )
+        return failed
+
+    def release(self, worker: str):
+        """
+        Hands the patients still leased by the worker back to the queue, e.g. on a clean shutdown.
+        Their claim doesn't count as an attempt, since they didn't fail.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET status = 'pending', worker = NULL, lease_until = NULL, attempts = attempts - 1 WHERE status = 'leased' AND worker = ?",
+                (worker,),
+            )
+
+    def _fail_exhausted(self, conn: sqlite3.Connection, condition: str, params: tuple) -> List[int]:
+        """ Marks the items matching the condition that were claimed max_attempts times as failed, returns their MRNs."""
+        failed = [
+            row[0]
+            for row in conn.execute(f"SELECT mrn FROM items WHERE {condition} AND attempts >= ?", (*params, self.max_attempts))
+        ]
+        conn.executemany(
+            "UPDATE items SET status = 'failed', worker = NULL, lease_until = NULL WHERE mrn = ?", [(mrn,) for mrn in failed]
+        )
+        for mrn in failed:
+            print(f"Warning: Patient {mrn} failed {self.max_attempts} times, marking it failed in the work queue.")
+        return failed
+
+    def counts(self) -> Dict[str, int]:
+        """ Returns the number of patients per status (pending, leased, done, failed)."""
+        with self._transaction() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ("pending", "leased", "done", "failed")}
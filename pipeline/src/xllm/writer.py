@@ -0,0 +1,76 @@
+import gzip
+import json
+import os
+from typing import Any, IO
+
+
+class JsonlWriter:
+    """
+    Writes records one JSON line at a time, so records can be dropped from memory as soon as they are written.
+    The output is gzip-compressed if the path ends in .gz.
+
+    Lines go to a temporary file next to the path, which replaces the path on close(). A shard that dies
+    while writing leaves no partial output behind: its patients are in the journal and written again on restart.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        """ Number of records written so far."""
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file: IO[str] = (
+            gzip.open(self._tmp_path, "wt", encoding="utf-8")
+            if path.endswith(".gz")
+            else open(self._tmp_path, "w", encoding="utf-8")
+        )
+
+    def write(self, record: Any):
+        self._file.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def write_lines(self, lines: str):
+        """ Writes records that are already serialized as JSON lines, e.g. DataFrame.to_json(orient="records", lines=True)."""
+        if not lines:
+            return
+        self._file.write(lines if lines.endswith("\n") else lines + "\n")
+        self.count += lines.count("\n") + (0 if lines.endswith("\n") else 1)
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def discard(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self) -> "JsonlWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class JsonArrayWriter(JsonlWriter):
+    """
+    Writes records one at a time as a JSON array, with one record per line and no indentation.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._file.write("[")
+
+    def write(self, record: Any):
+        self._file.write(("\n" if self.count == 0 else ",\n") + json.dumps(record))
+        self.count += 1
+
+    def write_lines(self, lines: str):
+        for line in lines.splitlines():
+            if line.strip():
+                self.write(json.loads(line))
+
+    def close(self):
+        self._file.write("\n]\n" if self.count > 0 else "]\n")
+        super().close()